@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Limit the number of transfers in each stage of the transfer process."""
+# Copyright 2017  University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function  # for python 2
+
+from collections import deque
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.logger import Logger
+
+from statemachine import cached_fields, transition_txn, transitioned
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+# Results of attempting to admit a transfer
+_ADMITTED = 'admitted'
+_INVALID = 'invalid'
+_STAGE_FULL = 'stage full'
+_HOST_FULL = 'host full'
+_LOCKED = 'locked'
+
+_RECLAIM_INTERVAL = 60
+"""Interval in seconds at which stale transfers are reclaimed."""
+
+
+def reclaim_stale_txn(txn, from_status, to_status, timeout):
+    """Return transfers which have been in a stage too long (in a txn).
+
+    Transfers whose status has been to_status for longer than the timeout
+    (e.g. as the service was restarted, or the stager never reported
+    completion) are returned to from_status, freeing their slots in the
+    stage so that they can be admitted again.  The rows are locked while
+    they are updated, so that a completion reported concurrently either
+    takes effect first or is ignored.
+
+    Arguments:
+    txn -- Database transaction
+    from_status -- Status of transfers waiting to enter the stage
+    to_status -- Status of transfers occupying the stage
+    timeout -- Time in seconds after which transfers are reclaimed
+
+    Return value:
+    A list of the IDs of the transfers reclaimed.
+    """
+    txn.execute("SELECT transfer_id FROM transfers WHERE status = %%s AND "
+                "time_%s < NOW() - INTERVAL %%s SECOND FOR UPDATE"
+                % to_status.lower(), [to_status, int(timeout)])
+    transfer_ids = [row[0] for row in txn.fetchall()]
+    if transfer_ids:
+        txn.executemany("UPDATE transfers SET status = %s WHERE "
+                        "transfer_id = %s AND status = %s",
+                        [[from_status, transfer_id, to_status]
+                         for transfer_id in transfer_ids])
+    return transfer_ids
+
+
+class AdmissionController (object):
+    """Admit transfers to a stage while enforcing limits on its occupancy.
+
+    The number of transfers occupying a stage is the number of rows in the
+    transfers table with the status of that stage.  Admitting a transfer
+    means changing its status to that of the stage, which is done while
+    holding a MySQL named lock so that concurrent admissions cannot exceed
+    the limits.  As a result the limits hold across all service instances
+    sharing the database, survive restarts, and slots cannot be leaked:
+    a slot is freed as soon as the status of the transfer changes again.
+
+    A limit may also be placed on the number of transfers occupying the
+    stage for any single destination host.
+
+    Transfers waiting to be admitted are retried when notify() is called
+    (i.e. when a local transfer leaves the stage), and also at a regular
+    interval to account for slots freed by other service instances.
+
+    If a timeout is given, transfers which occupy the stage for longer than
+    it (e.g. because the completion of a task was never reported) are
+    returned to from_status and passed to requeue, so that they don't hold
+    their slots forever.
+    """
+
+    def __init__(self, dbpool, from_status, to_status, limit,
+                 host_limit=None, retry_interval=5, returning=None,
+                 timeout=None, requeue=None):
+        """Initialize the admission controller for a stage.
+
+        Arguments:
+        dbpool -- Global shared database connection pool
+        from_status -- Status transfers must have to be admitted
+        to_status -- Status of transfers occupying the stage
+        limit -- Maximum number of transfers occupying the stage
+        host_limit -- Maximum number of transfers occupying the stage for
+          any one destination host, or None for no limit
+        retry_interval -- Interval in seconds at which waiting transfers
+          are retried
+        returning -- List of columns of the transfers table needed by the
+          stage, which are returned on admission
+        timeout -- Time in seconds after which transfers occupying the stage
+          are reclaimed, or None to never reclaim them
+        requeue -- Function called with a list of the IDs of reclaimed
+          transfers to request that they be admitted again, which may return
+          a deferred
+        """
+        self._log = Logger()
+        self._dbpool = dbpool
+        self._from_status = from_status
+        self._to_status = to_status
+        self._limit = int(limit)
+        self._host_limit = int(host_limit) if host_limit else None
+        self._retry_interval = float(retry_interval)
+        self._returning = returning or []
+        self._lock_name = 'transfer_admission_%s' % to_status
+        self._waiting = deque()
+        self._call = None
+        self._running = False
+        self._rerun = False
+        self._timeout = int(timeout) if timeout else None
+        self._requeue = requeue
+        if self._timeout is not None:
+            reactor.callLater(_RECLAIM_INTERVAL, self._reclaim)
+
+    def admit(self, transfer_id):
+        """Wait until there is space in the stage and admit a transfer.
+
+        Return value (via deferred):
+        A dictionary of the columns listed in returning if the transfer was
+        admitted, or None if it didn't have the status required for
+        admission (e.g. if it was a duplicate request).
+        """
+        d = Deferred()
+        self._waiting.append((transfer_id, d))
+        self.notify()
+        return d
+
+    def notify(self):
+        """Retry admission of waiting transfers as space may be available."""
+        if self._running:
+            self._rerun = True
+            return
+        self._schedule(0)
+
+    def _schedule(self, delay):
+        """Schedule an attempt to admit waiting transfers."""
+        if self._call is not None and self._call.active():
+            if self._call.getTime() <= reactor.seconds() + delay:
+                return
+            self._call.cancel()
+        self._call = reactor.callLater(delay, self._process)
+
+    def _try_admit(self, txn, transfer_id, returning):
+        """Admit a transfer if there is space for it (run in a transaction).
+
+        The transaction is committed before the lock is released so that
+        other instances counting the occupancy of the stage will see the
+        transfer.
+
+        Return value:
+        A tuple of the result of the attempt and, if admitted, a dictionary
+        of the columns in returning.
+        """
+        txn.execute("SELECT GET_LOCK(%s, 10)", [self._lock_name])
+        if not txn.fetchone()[0]:
+            return _LOCKED, None
+        try:
+            txn.execute("SELECT status, destination_host FROM transfers "
+                        "WHERE transfer_id = %s", [transfer_id])
+            row = txn.fetchone()
+            if row is None or row[0] != self._from_status:
+                return _INVALID, None
+            txn.execute("SELECT COUNT(*) FROM transfers WHERE status = %s",
+                        [self._to_status])
+            if txn.fetchone()[0] >= self._limit:
+                return _STAGE_FULL, None
+            if self._host_limit is not None:
+                txn.execute("SELECT COUNT(*) FROM transfers WHERE status = %s "
+                            "AND destination_host = %s",
+                            [self._to_status, row[1]])
+                if txn.fetchone()[0] >= self._host_limit:
+                    return _HOST_FULL, None
+            returned = transition_txn(txn, transfer_id, self._from_status,
+                                      self._to_status, returning=returning)
+            txn.execute("COMMIT")
+            if returned is None:
+                return _INVALID, None
+            return _ADMITTED, returned
+        finally:
+            txn.execute("SELECT RELEASE_LOCK(%s)", [self._lock_name])
+
+    @inlineCallbacks
+    def _process(self):
+        """Attempt to admit waiting transfers in the order they arrived.
+
+        Transfers whose destination host is at its limit are skipped over,
+        whereas processing stops once the stage itself is full.
+        """
+        self._running = True
+        self._rerun = False
+        still_waiting = deque()
+        try:
+            while self._waiting:
+                transfer_id, d = self._waiting.popleft()
+                cached = cached_fields(transfer_id, self._returning)
+                try:
+                    result, returned = yield self._dbpool.runInteraction(
+                        self._try_admit, transfer_id,
+                        None if cached is not None else self._returning)
+                except Exception, e:
+                    self._log.error('Error admitting transfer %s to %s'
+                                    % (transfer_id, self._to_status))
+                    self._log.error(str(e))
+                    d.errback(e)
+                    continue
+                if result == _ADMITTED:
+                    returned.update(cached or {})
+                    transitioned(transfer_id, self._to_status,
+                                 returned=returned)
+                    d.callback(returned)
+                elif result == _INVALID:
+                    d.callback(None)
+                elif result == _HOST_FULL:
+                    still_waiting.append((transfer_id, d))
+                else:
+                    still_waiting.append((transfer_id, d))
+                    break
+        finally:
+            still_waiting.extend(self._waiting)
+            self._waiting = still_waiting
+            self._running = False
+
+        if self._waiting:
+            self._schedule(0 if self._rerun else self._retry_interval)
+
+    @inlineCallbacks
+    def _reclaim(self):
+        """Reclaim transfers which have occupied the stage for too long."""
+        try:
+            transfer_ids = yield self._dbpool.runInteraction(
+                reclaim_stale_txn, self._from_status, self._to_status,
+                self._timeout)
+            if transfer_ids:
+                self._log.warn('Returning %s transfers which have been %s for '
+                               'over %s seconds to %s'
+                               % (len(transfer_ids), self._to_status,
+                                  self._timeout, self._from_status))
+                for transfer_id in transfer_ids:
+                    transitioned(transfer_id, self._from_status)
+                self.notify()
+                if self._requeue is not None:
+                    yield self._requeue(transfer_ids)
+        except Exception, e:
+            self._log.error('Error reclaiming stale transfers from %s'
+                            % self._to_status)
+            self._log.error(str(e))
+        finally:
+            reactor.callLater(_RECLAIM_INTERVAL, self._reclaim)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Gather requests into batches which are processed together."""
+# Copyright 2017  University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function  # for python 2
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+
+class Batcher (object):
+    """Gather items into batches which are processed by a single call.
+
+    Items are gathered until either the batch is full or the window since
+    the first item of the batch was added has passed, at which point the
+    whole batch is passed to the processing function.  The caller adding
+    each item is given the result for that item once the batch has been
+    processed.
+    """
+
+    def __init__(self, process, max_size=100, window=0.5):
+        """Initialize the batcher.
+
+        Arguments:
+        process -- Function called with a list of items, which returns (or
+          returns a deferred firing with) a list of the results for each
+          item in the same order.  A result which is an exception is raised
+          to the caller who added the item.
+        max_size -- Maximum number of items in a batch
+        window -- Maximum time in seconds for which an item waits for a
+          batch to fill
+        """
+        self._process = process
+        self._max_size = int(max_size)
+        self._window = float(window)
+        self._pending = []
+        self._call = None
+
+    def add(self, item):
+        """Add an item to the current batch.
+
+        Return value (via deferred):
+        The result of processing the item.
+        """
+        d = Deferred()
+        self._pending.append((item, d))
+        if len(self._pending) >= self._max_size:
+            self.flush()
+        elif self._call is None:
+            self._call = reactor.callLater(self._window, self.flush)
+        return d
+
+    def flush(self):
+        """Process the current batch immediately."""
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        def _deliver(results):
+            for (_, d), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+
+        def _fail(failure):
+            for _, d in batch:
+                d.errback(failure)
+
+        d = maybeDeferred(self._process, [item for item, _ in batch])
+        d.addCallbacks(_deliver, _fail)
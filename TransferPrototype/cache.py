@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cache details of transfers in memory."""
+# Copyright 2017  University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function  # for python 2
+
+from collections import OrderedDict
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+TERMINAL_STATUSES = ('SUCCESS', 'ERROR')
+"""Statuses after which a transfer is no longer processed."""
+
+
+class TransferCache (object):
+    """Bounded in-memory cache of transfer records, written through to MySQL.
+
+    Only the fields set when a transfer is submitted are cached, as these
+    never change, so records remain valid even when the same transfer is
+    processed by several instances of the service.  Fields set by later
+    stages (e.g. the staged path) are not cached, as a transfer may be
+    returned to an earlier stage and staged again elsewhere (possibly by
+    another instance).  The status of a transfer is deliberately not
+    cached; it is changed using conditional updates against the DB (see
+    the statemachine module), which is the authority on it.
+
+    Records are added when transfers are submitted, loaded from the DB on a
+    miss, updated as changes are written to the DB and evicted once a
+    transfer reaches a terminal status.  The least recently used records are
+    evicted once the cache is full.
+    """
+
+    SUBMIT_FIELDS = ['product_id', 'destination_path', 'destination_host',
+                     'submitter', 'prepare_activity']
+    """Fields of the transfers table set when a transfer is submitted."""
+
+    FIELDS = SUBMIT_FIELDS
+    """Fields of the transfers table which are cached."""
+
+    def __init__(self, dbpool, max_size=10000):
+        """Initialize the cache.
+
+        Arguments:
+        dbpool -- Global shared database connection pool
+        max_size -- Maximum number of transfers to cache
+        """
+        self._dbpool = dbpool
+        self._max_size = int(max_size)
+        self._records = OrderedDict()
+
+        self.hits = 0
+        """Number of lookups answered from the cache."""
+        self.misses = 0
+        """Number of lookups which required a query of the DB."""
+
+    def _store(self, transfer_id, fields):
+        """Merge fields into a record and mark it most recently used."""
+        record = self._records.pop(transfer_id, {})
+        for field in self.FIELDS:
+            if field in fields:
+                record[field] = fields[field]
+        self._records[transfer_id] = record
+        while len(self._records) > self._max_size:
+            self._records.popitem(last=False)
+
+    def add(self, transfer_id, **fields):
+        """Add a transfer which has just been written to the DB."""
+        self._store(transfer_id, dict((field, fields.get(field))
+                                      for field in self.SUBMIT_FIELDS))
+
+    def set(self, transfer_id, fields):
+        """Record changes to a transfer which have been written to the DB.
+
+        Transfers are evicted once their status becomes terminal.
+        """
+        if fields.get('status') in TERMINAL_STATUSES:
+            self.evict(transfer_id)
+        elif transfer_id in self._records:
+            self._store(transfer_id, fields)
+
+    def evict(self, transfer_id):
+        """Remove a transfer from the cache."""
+        self._records.pop(transfer_id, None)
+
+    def peek(self, transfer_id, fields):
+        """Return cached fields of a transfer without querying the DB.
+
+        Return value:
+        A dictionary of the fields requested, or None if any of them aren't
+        cached.
+        """
+        record = self._records.get(transfer_id)
+        if record is None or any(field not in record for field in fields):
+            return None
+        self.hits += 1
+        self._store(transfer_id, {})
+        return dict((field, record[field]) for field in fields)
+
+    @inlineCallbacks
+    def get(self, transfer_id, fields=None):
+        """Return fields of a transfer, querying the DB if not cached.
+
+        Arguments:
+        transfer_id -- ID of the transfer
+        fields -- List of fields required (defaults to all of FIELDS), which
+          may include fields which aren't cached
+
+        Return value (via deferred):
+        A dictionary of the fields requested, or None if there is no
+        transfer with the ID.
+        """
+        fields = fields or self.FIELDS
+        result = self.peek(transfer_id, fields)
+        if result is not None:
+            returnValue(result)
+
+        self.misses += 1
+        columns = self.FIELDS + [f for f in fields if f not in self.FIELDS]
+        r = yield self._dbpool.runQuery("SELECT " + ", ".join(columns) +
+                                        " FROM transfers WHERE transfer_id = "
+                                        "%s", [transfer_id])
+        if not r:
+            returnValue(None)
+        record = dict(zip(columns, r[0]))
+        self._store(transfer_id, record)
+        returnValue(dict((field, record[field]) for field in fields))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Consume messages from RabbitMQ queues."""
+# Copyright 2017  University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function  # for python 2
+
+from twisted.internet.defer import inlineCallbacks, maybeDeferred
+from twisted.logger import Logger
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+
+class QueueConsumer (object):
+    """Pass messages from a RabbitMQ queue to a handler.
+
+    Up to `prefetch` unacknowledged messages are delivered by the broker at
+    any point in time, and these are processed by `workers` concurrent
+    workers.  Each message is only acknowledged once the deferred returned
+    by the handler has fired, i.e. once the handler has recorded the results
+    of processing it.  Handlers are expected to record failures themselves,
+    so messages are also acknowledged if the handler fails.
+    """
+
+    def __init__(self, pika_conn, queue, handler, prefetch=1, workers=1):
+        """Initialize the consumer.
+
+        Arguments:
+        pika_conn -- Global shared connection for RabbitMQ
+        queue -- Name of the queue to consume messages from
+        handler -- Function called with the body of each message, which may
+          return a deferred
+        prefetch -- Maximum number of unacknowledged messages
+        workers -- Number of messages processed concurrently
+        """
+        self._log = Logger()
+        self._pika_conn = pika_conn
+        self._queue = queue
+        self._handler = handler
+        self._prefetch = int(prefetch)
+        self._workers = int(workers)
+
+    @inlineCallbacks
+    def start(self):
+        """Start consuming messages from the queue."""
+        channel = yield self._pika_conn.channel()
+        yield channel.queue_declare(queue=self._queue, exclusive=False,
+                                    durable=True)
+        yield channel.basic_qos(prefetch_count=self._prefetch)
+        queue, _ = yield channel.basic_consume(queue=self._queue,
+                                               no_ack=False)
+        self._log.info('Consuming from queue %s (prefetch %s, %s workers)'
+                       % (self._queue, self._prefetch, self._workers))
+        for _ in range(self._workers):
+            self._worker(queue)
+
+    @inlineCallbacks
+    def _worker(self, queue):
+        """Process messages from the queue one at a time."""
+        while True:
+            ch, method, properties, body = yield queue.get()
+            if body:
+                try:
+                    yield maybeDeferred(self._handler, body)
+                except Exception, e:
+                    self._log.error('Error handling message %s from queue %s'
+                                    % (body, self._queue))
+                    self._log.error(str(e))
+            yield ch.basic_ack(delivery_tag=method.delivery_tag)
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A minimalist FTS server simulator.
+
+This provides the parts of the interface of the FTS REST client
+(fts3.rest.client.easy) used by the transfer service, answering each call
+after an artificial delay as a slow FTS server would.  Jobs are reported
+as ACTIVE until their duration has passed, and then as FINISHED.
+
+When run as a script it uses the simulator to check that calls made to
+FTS through FTSClient neither block the reactor nor each other, and that
+the web interface of the service (/submitTransfer and /transferStatus)
+remains responsive while FTS is slow.
+"""
+# Copyright 2017 University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function  # for python 2
+
+import argparse
+import json
+import math
+import re
+import sys
+import threading
+import types
+import uuid
+
+from datetime import datetime
+from os.path import dirname, join, realpath
+from time import sleep, time
+from urllib import urlencode
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+
+class DummyFTS (object):
+    """Simulate an FTS server which is slow to respond."""
+
+    def __init__(self, delay=0.5, duration=5.0):
+        """Initialize the simulator.
+
+        Arguments:
+        delay -- Time in seconds taken to answer each call
+        duration -- Time in seconds after which submitted jobs finish
+        """
+        self._delay = float(delay)
+        self._duration = float(duration)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._active = 0
+
+        self.calls = 0
+        """Number of calls answered."""
+        self.max_concurrent = 0
+        """Maximum number of calls which were in progress at once."""
+
+    def _call(self):
+        """Wait for the delay, keeping count of concurrent calls."""
+        with self._lock:
+            self._active += 1
+            self.max_concurrent = max(self.max_concurrent, self._active)
+        try:
+            sleep(self._delay)
+        finally:
+            with self._lock:
+                self._active -= 1
+                self.calls += 1
+
+    def _status(self, job_id, list_files):
+        """Return the status of a job as reported by FTS."""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return {'job_id': job_id, 'http_status': '404 Not Found'}
+        done = time() >= job['submitted'] + self._duration
+        status = {'job_id': job_id, 'reason': None,
+                  'job_state': 'FINISHED' if done else 'ACTIVE'}
+        if list_files:
+            status['files'] = [
+              {'file_id': i, 'source_surl': f['source_surl'],
+               'dest_surl': f['dest_surl'], 'checksum': f.get('checksum'),
+               'filesize': f.get('filesize') or 0, 'reason': None,
+               'file_state': 'FINISHED' if done else 'ACTIVE'}
+              for i, f in enumerate(job['files'])]
+        return status
+
+    # Interface of fts3.rest.client.easy
+
+    def Context(self, endpoint, ucert=None, ukey=None, **kwargs):
+        self._call()
+        return {'endpoint': endpoint}
+
+    def new_transfer(self, source, destination, checksum=None,
+                     filesize=None, **kwargs):
+        return {'source_surl': source, 'dest_surl': destination,
+                'checksum': checksum, 'filesize': filesize}
+
+    def new_job(self, transfers, **kwargs):
+        return {'files': list(transfers), 'params': kwargs}
+
+    def submit(self, context, job, **kwargs):
+        self._call()
+        job_id = str(uuid.uuid4())
+        with self._lock:
+            self._jobs[job_id] = {'files': job['files'], 'submitted': time()}
+        return job_id
+
+    def get_job_status(self, context, job_id, list_files=False):
+        self._call()
+        return self._status(job_id, list_files)
+
+    def get_jobs_statuses(self, context, job_ids, list_files=False):
+        self._call()
+        return [self._status(job_id, list_files) for job_id in job_ids]
+
+    def install(self):
+        """Install the simulator in place of the FTS REST client.
+
+        Must be called before the FTS REST client is first imported.
+        """
+        easy = types.ModuleType('fts3.rest.client.easy')
+        for name in ['Context', 'new_transfer', 'new_job', 'submit',
+                     'get_job_status', 'get_jobs_statuses']:
+            setattr(easy, name, getattr(self, name))
+        client = types.ModuleType('fts3.rest.client')
+        client.easy = easy
+        rest = types.ModuleType('fts3.rest')
+        rest.client = client
+        fts3 = types.ModuleType('fts3')
+        fts3.rest = rest
+        sys.modules.update({'fts3': fts3, 'fts3.rest': rest,
+                            'fts3.rest.client': client,
+                            'fts3.rest.client.easy': easy})
+
+
+class _MemoryCursor (object):
+    """Answer the queries made by the web interface from memory.
+
+    Only the statements used to submit a transfer and report its status
+    are understood: inserting a transfer and selecting the columns of a
+    transfer (or the summary of its files, of which there are none) by ID.
+    """
+
+    def __init__(self, transfers):
+        self._transfers = transfers
+        self._rows = []
+        self.rowcount = 0
+
+    def _columns(self, columns):
+        """Split a list of columns, ignoring commas within parentheses."""
+        parts = ['']
+        depth = 0
+        for c in columns:
+            depth += {'(': 1, ')': -1}.get(c, 0)
+            if c == ',' and depth == 0:
+                parts.append('')
+            else:
+                parts[-1] += c
+        return [part.strip() for part in parts]
+
+    def execute(self, query, args=None):
+        args = list(args or [])
+        self._rows = []
+        insert = re.match(r'INSERT INTO transfers \((.*?)\) VALUES \((.*)\)',
+                          query, re.S)
+        select = re.match(r'SELECT (.*) FROM (\w+) WHERE transfer_id = %s',
+                          query, re.S)
+        if insert:
+            record = {}
+            for column, value in zip(self._columns(insert.group(1)),
+                                     self._columns(insert.group(2))):
+                if value == '%s':
+                    record[column] = args.pop(0)
+                elif value == 'NOW()':
+                    record[column] = datetime.utcnow()
+                else:
+                    record[column] = value.strip("'")
+            self._transfers[record['transfer_id']] = record
+            self.rowcount = 1
+        elif select and select.group(2) == 'transfer_files':
+            if select.group(1).startswith('COUNT(*)'):
+                self._rows = [(0, None, None, None, None)]
+        elif select:
+            record = self._transfers.get(args[0])
+            if record is not None:
+                self._rows = [tuple(record.get(column) for column in
+                                    self._columns(select.group(1)))]
+        else:
+            raise Exception('Unsupported query: %s' % query)
+        self.rowcount = len(self._rows) or self.rowcount
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return list(self._rows)
+
+
+class MemoryDBPool (object):
+    """Stand in for the database connection pool of the service.
+
+    As with adbapi, interactions are run in a dedicated pool of threads.
+    """
+
+    def __init__(self, threads=3):
+        from twisted.internet import reactor
+        from twisted.python.threadpool import ThreadPool
+
+        self._transfers = {}
+        self._lock = threading.Lock()
+        self._threadpool = ThreadPool(1, threads, 'db')
+        self._threadpool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown',
+                                      self._threadpool.stop)
+
+    def runInteraction(self, interaction, *args, **kwargs):
+        from twisted.internet import reactor, threads
+
+        def _interact():
+            with self._lock:
+                return interaction(_MemoryCursor(self._transfers), *args,
+                                   **kwargs)
+        return threads.deferToThreadPool(reactor, self._threadpool,
+                                         _interact)
+
+    def runQuery(self, query, args=None):
+        def _query(txn):
+            txn.execute(query, args)
+            return txn.fetchall()
+        return self.runInteraction(_query)
+
+
+class _Publisher (object):
+    """Stand in for the publisher, confirming messages immediately."""
+
+    def publish(self, queue, body):
+        from twisted.internet.defer import succeed
+        return succeed(None)
+
+
+def main():
+    """Check that calls to a slow FTS server don't block the service.
+
+    Jobs are submitted through FTSClient and their status retrieved while
+    the reactor measures how late a regular timer fires.  Calls which
+    blocked the reactor would delay the timer by the time taken by FTS to
+    answer, and calls which blocked each other would take the time of
+    every call in turn rather than of one call for each thread.
+
+    While the jobs are being submitted, transfers are also submitted to
+    /submitTransfer and their status retrieved from /transferStatus (over
+    HTTPS with a client certificate, with an in-memory stand-in for the
+    database), and the latency of these requests is measured.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__.split('\n')[0])
+    parser.add_argument('--jobs', type=int, default=20,
+                        help='number of jobs to submit (default 20)')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='threads used by FTSClient (default 4)')
+    parser.add_argument('--delay', type=float, default=0.5,
+                        help='seconds taken by FTS to answer (default 0.5)')
+    parser.add_argument('--requests', type=int, default=20,
+                        help='transfers submitted to the web interface '
+                             '(default 20)')
+    args = parser.parse_args()
+
+    fts = DummyFTS(args.delay)
+    fts.install()
+
+    sys.path.append(join(dirname(realpath(__file__)), '..'))
+    from cache import TransferCache
+    from ftsclient import FTSClient
+    from transferstatus import TransferStatus
+    from transfersubmit import TransferSubmit
+    from twisted.internet import reactor, ssl, task
+    from twisted.internet.defer import gatherResults, inlineCallbacks, \
+        returnValue
+    from twisted.web.client import Agent, FileBodyProducer, readBody
+    from twisted.web.http_headers import Headers
+    from twisted.web.iweb import IPolicyForHTTPS
+    from twisted.web.resource import Resource
+    from twisted.web.server import Site
+    from util import load_allowed_DNs
+    from zope.interface import implementer
+    from StringIO import StringIO
+
+    # The simulator ignores the credentials, but FTSClient checks the
+    # modification times of the files
+    credentials = realpath(__file__)
+    client = FTSClient(['https://fts.invalid:8446', credentials,
+                        credentials], args.threads)
+    tick = 0.01
+    lag = {'last': None, 'max': 0.0}
+
+    def _tick():
+        now = time()
+        if lag['last'] is not None:
+            lag['max'] = max(lag['max'], now - lag['last'] - tick)
+        lag['last'] = now
+
+    # Serve the web interface using a certificate for localhost, and
+    # authenticate to it using a client certificate
+    server_cert = ssl.KeyPair.generate().selfSignedCert(1, CN=u'localhost')
+    client_cert = ssl.KeyPair.generate().selfSignedCert(
+        2, CN=u'dummy-fts-client')
+    load_allowed_DNs('/CN=dummy-fts-client')
+    dbpool = MemoryDBPool()
+    root = Resource()
+    root.putChild('submitTransfer',
+                  TransferSubmit(dbpool, TransferCache(dbpool), 'staging',
+                                 _Publisher()))
+    root.putChild('transferStatus', TransferStatus(dbpool))
+    port = reactor.listenSSL(0, Site(root), server_cert.options(client_cert),
+                             interface='127.0.0.1')
+    base_url = 'https://127.0.0.1:%s/' % port.getHost().port
+
+    @implementer(IPolicyForHTTPS)
+    class _Policy (object):
+        def creatorForNetloc(self, hostname, port):
+            return ssl.optionsForClientTLS(u'localhost',
+                                           trustRoot=server_cert,
+                                           clientCertificate=client_cert)
+    agent = Agent(reactor, _Policy())
+
+    @inlineCallbacks
+    def _request(method, path, params):
+        """Make a request to the web interface, returning its latency."""
+        start = time()
+        if method == 'POST':
+            response = yield agent.request(
+                'POST', base_url + path,
+                Headers({'Content-Type':
+                         ['application/x-www-form-urlencoded']}),
+                FileBodyProducer(StringIO(urlencode(params))))
+        else:
+            response = yield agent.request(
+                'GET', base_url + path + '?' + urlencode(params))
+        body = yield readBody(response)
+        if response.code >= 300:
+            raise Exception('%s %s failed (%s): %s'
+                            % (method, path, response.code, body))
+        returnValue((time() - start, json.loads(body)))
+
+    @inlineCallbacks
+    def _use_endpoints():
+        """Submit transfers and retrieve their status one at a time."""
+        latencies = []
+        for i in range(args.requests):
+            latency, result = yield _request(
+                'POST', 'submitTransfer',
+                {'product_id': 'product-%s' % i,
+                 'destination_path': 'gsiftp://dst/product-%s' % i})
+            latencies.append(latency)
+            latency, status = yield _request(
+                'GET', 'transferStatus',
+                {'transfer_id': result['transfer_id']})
+            if status['status'] != 'SUBMITTED':
+                raise Exception('Unexpected status: %s' % status)
+            latencies.append(latency)
+        returnValue((time(), latencies))
+
+    @inlineCallbacks
+    def _run():
+        fts3 = sys.modules['fts3.rest.client.easy']
+        # Let each thread of the pool create its context, and make a first
+        # connection to the web interface
+        yield gatherResults([client.get_jobs_statuses([])
+                             for _ in range(args.threads)])
+        yield _request('GET', 'transferStatus', {'transfer_id': 'none'}) \
+            .addErrback(lambda _: None)
+        timer = task.LoopingCall(_tick)
+        timer.start(tick)
+
+        start = time()
+        submitting = gatherResults(
+            [client.submit([fts3.new_transfer('gsiftp://src/%s' % i,
+                                              'gsiftp://dst/%s' % i)])
+             for i in range(args.jobs)])
+        used, latencies = yield _use_endpoints()
+        job_ids = yield submitting
+        submitted = time() - start
+        overlapped = used < start + submitted
+
+        start = time()
+        yield gatherResults([client.get_job_status(job_id, list_files=True)
+                             for job_id in job_ids])
+        polled = time() - start
+        timer.stop()
+
+        rounds = int(math.ceil(float(args.jobs) / args.threads))
+        print('Submitted %s jobs in %.2fs and retrieved their status in '
+              '%.2fs (%.2fs if concurrent, %.2fs if serial)'
+              % (args.jobs, submitted, polled, rounds * args.delay,
+                 args.jobs * args.delay))
+        print('Calls in progress at once: %s (of %s threads)'
+              % (fts.max_concurrent, args.threads))
+        print('Longest delay of the reactor: %.3fs (FTS delay %.2fs)'
+              % (lag['max'], args.delay))
+        print('Requests to the web interface while submitting to FTS: %s, '
+              'longest %.3fs, average %.3fs%s'
+              % (len(latencies), max(latencies),
+                 sum(latencies) / len(latencies),
+                 '' if overlapped else ' (finished after FTS; increase '
+                                       '--jobs)'))
+        ok = (fts.max_concurrent == min(args.threads, args.jobs) and
+              lag['max'] < args.delay / 2 and
+              max(submitted, polled) < (rounds + 1) * args.delay and
+              max(latencies) < args.delay / 2)
+        print('OK' if ok else 'FAILED')
+        returnValue(ok)
+
+    def _finish(ok):
+        result['ok'] = ok
+        reactor.stop()
+
+    def _error(failure):
+        failure.printTraceback()
+        reactor.stop()
+
+    result = {'ok': False}
+    reactor.callWhenRunning(
+        lambda: _run().addCallbacks(_finish, _error))
+    reactor.run()
+    sys.exit(0 if result['ok'] else 1)
+
+
+if __name__ == '__main__':
+    main()
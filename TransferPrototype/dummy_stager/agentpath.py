@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Make the modules of the transfer agent importable by the stager.
+
+The checksum cache and work queue are shared with the transfer agent.
+Importing this module adds the directory of the transfer agent to the
+module search path, so that they can then be imported as usual.
+"""
+# Copyright 2017 University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+
+from os.path import dirname, join, realpath
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+AGENT_DIR = join(dirname(dirname(realpath(__file__))), 'transferagent')
+if AGENT_DIR not in sys.path:
+    sys.path.append(AGENT_DIR)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Copy the files of products in parallel using in-kernel copies."""
+# Copyright 2017 University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function  # for python 2
+
+import ctypes
+import errno
+import fcntl
+import os
+import shutil
+import threading
+
+from multiprocessing.pool import ThreadPool
+from os.path import join
+from time import time
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+_FICLONE = 0x40049409
+"""ioctl creating a reflink of a file (Linux, e.g. on Btrfs and XFS)."""
+
+_UNSUPPORTED = (errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                errno.EINVAL, errno.EPERM, errno.EMLINK)
+"""Errors indicating that a method of copying can't be used."""
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_copy_file_range = getattr(_libc, 'copy_file_range', None)
+if _copy_file_range is not None:
+    _copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                 ctypes.c_int, ctypes.c_void_p,
+                                 ctypes.c_size_t, ctypes.c_uint]
+    _copy_file_range.restype = ctypes.c_ssize_t
+_sendfile = getattr(_libc, 'sendfile', None)
+if _sendfile is not None:
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                          ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+
+
+class _Unsupported (Exception):
+    """Raised when a method of copying can't be used for a file."""
+
+    pass
+
+
+def _check(result):
+    """Raise an error if a call to libc failed."""
+    if result < 0:
+        err = ctypes.get_errno()
+        if err in _UNSUPPORTED:
+            raise _Unsupported(os.strerror(err))
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class CopyEngine (object):
+    """Copy directory trees using a pool of workers.
+
+    Files are copied in parallel, each using the cheapest method supported
+    by the filesystems involved, in order of preference:
+
+    * reflink -- the copy shares the blocks of the source (copy on write)
+    * copy_file_range -- the data is copied in the kernel in chunks
+    * sendfile -- as for copy_file_range, for older kernels
+    * link -- the copy is a hard link to the source
+    * read -- the data is read and written in chunks
+
+    Methods which fail as unsupported for a pair of devices aren't tried
+    again for later files on those devices.
+    """
+
+    METHODS = ['reflink', 'copy_file_range', 'sendfile', 'link', 'read']
+    """Methods used to copy files, in order of preference."""
+
+    def __init__(self, workers=8, chunk_size=67108864):
+        """Initialize the copy engine.
+
+        Arguments:
+        workers -- Number of files copied in parallel
+        chunk_size -- Size of the chunks in which data is copied
+        """
+        self._pool = ThreadPool(int(workers))
+        self._chunk_size = int(chunk_size)
+        self._unsupported = {}
+        self._lock = threading.Lock()
+
+    def _reflink(self, src, dst):
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            except IOError, e:
+                if e.errno in _UNSUPPORTED:
+                    raise _Unsupported(str(e))
+                raise
+
+    def _copy_file_range(self, src, dst):
+        if _copy_file_range is None:
+            raise _Unsupported('copy_file_range is not available')
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            while _check(_copy_file_range(fsrc.fileno(), None, fdst.fileno(),
+                                          None, self._chunk_size, 0)):
+                pass
+
+    def _sendfile(self, src, dst):
+        if _sendfile is None:
+            raise _Unsupported('sendfile is not available')
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            while _check(_sendfile(fdst.fileno(), fsrc.fileno(), None,
+                                   self._chunk_size)):
+                pass
+
+    def _link(self, src, dst):
+        try:
+            os.link(src, dst)
+        except OSError, e:
+            if e.errno in _UNSUPPORTED:
+                raise _Unsupported(str(e))
+            raise
+
+    def _read(self, src, dst):
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst, self._chunk_size)
+
+    def _copy_file(self, task):
+        """Copy a file, returning the method used and its size."""
+        src, dst, devices = task
+        with self._lock:
+            unsupported = set(self._unsupported.get(devices, ()))
+        for method in self.METHODS:
+            if method in unsupported:
+                continue
+            try:
+                getattr(self, '_' + method)(src, dst)
+            except _Unsupported:
+                with self._lock:
+                    self._unsupported.setdefault(devices, set()).add(method)
+                if os.path.lexists(dst):
+                    os.unlink(dst)
+                continue
+            if method != 'link':
+                shutil.copystat(src, dst)
+            return method, os.path.getsize(dst)
+        raise Exception('Unable to copy %s to %s' % (src, dst))
+
+    def copy(self, src, dst):
+        """Copy a directory tree.
+
+        Symbolic links (to files or directories) are recreated as links
+        with the same target rather than followed, as by shutil.copytree
+        with symlinks=True, so links to a parent directory can't make the
+        copy recurse and links leading out of the tree don't copy what
+        they point to.
+
+        Arguments:
+        src -- Directory to copy
+        dst -- Path of the copy, which mustn't exist
+
+        Return value:
+        A dictionary of statistics of the copy: the number of 'files',
+        'links' and 'bytes' copied, the 'seconds' taken, the 'rate' in bytes
+        per second and the number of files copied using each of the
+        'methods'.
+        """
+        start = time()
+        dst_dev = None
+        files = []
+        links = 0
+        for dir, dirnames, filenames in os.walk(src):
+            target = os.path.normpath(join(dst,
+                                           os.path.relpath(dir, src)))
+            os.mkdir(target)
+            shutil.copystat(dir, target)
+            if dst_dev is None:
+                dst_dev = os.stat(target).st_dev
+            src_dev = os.stat(dir).st_dev
+            for name in dirnames + filenames:
+                path = join(dir, name)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), join(target, name))
+                    links += 1
+                elif name in filenames:
+                    files.append((path, join(target, name),
+                                  (src_dev, dst_dev)))
+
+        stats = {'files': 0, 'links': links, 'bytes': 0, 'methods': {}}
+        for method, size in self._pool.imap_unordered(self._copy_file,
+                                                      files):
+            stats['files'] += 1
+            stats['bytes'] += size
+            stats['methods'][method] = stats['methods'].get(method, 0) + 1
+        stats['seconds'] = time() - start
+        stats['rate'] = stats['bytes'] / max(stats['seconds'], 1e-6)
+        return stats
@@ -24,20 +24,25 @@ from __future__ import print_function  # for python 2
 import ConfigParser
 import json
 import os
-import shutil
-import string
 import sys
 import requests
 import uuid
 
 from klein import Klein
+from multiprocessing.pool import ThreadPool
 from OpenSSL import crypto
 from os.path import dirname, exists, expanduser, join, realpath
 from socket import gethostname as hostname
-from twisted.internet import endpoints, reactor, ssl, threads
+from twisted.internet import endpoints, reactor, ssl
 from twisted.python import log
 from twisted.web.server import Site
 
+# The checksum cache and work queue are shared with the transfer agent
+import agentpath  # noqa: F401 (adds the transfer agent to the path)
+from checksumcache import ChecksumCache
+from copyengine import CopyEngine
+from workqueue import QueueFull, WorkQueue, respond_busy
+
 __author__ = "David Aikema, <david.aikema@uct.ac.za>"
 
 # Init Klein and logging
@@ -69,23 +74,101 @@ stager_key = configData.get('credentials', 'key')
 config_dns = configData.get('auth', 'permitted')
 allowedDNs = filter(lambda x: x != '', config_dns.splitlines())
 
+# Manifest settings (the manifest of a staged product is written next to it,
+# in a file with the same name and this suffix)
+MANIFEST_SUFFIX = '.manifest'
+manifest_options = {
+  'checksum_cache': '~/.transfer_checksums.sqlite',
+  'max_entries': 1000000,
+  'read_size': 4 * 1024 * 1024,
+  'workers': 4,
+}
+for option in manifest_options:
+    if configData.has_option('manifest', option):
+        manifest_options[option] = configData.get('manifest', option)
+checksums = ChecksumCache(expanduser(manifest_options['checksum_cache']),
+                          manifest_options['max_entries'],
+                          manifest_options['read_size'])
+manifest_pool = ThreadPool(int(manifest_options['workers']))
+
+# Copy settings (used when staging directory products)
+copy_options = {
+  'workers': 8,
+  'chunk_size': 64 * 1024 * 1024,
+}
+for option in copy_options:
+    if configData.has_option('copy', option):
+        copy_options[option] = configData.get('copy', option)
+copy_engine = CopyEngine(copy_options['workers'],
+                         copy_options['chunk_size'])
+
+# Bounded queues of work, each done by its own pool of threads: staging
+# (disk I/O, with checksums computed by the manifest workers) and callbacks
+# to the transfer service
+queue_options = {
+  'io_workers': 4,
+  'io_max_queued': 100,
+  'callback_workers': 4,
+}
+for option in queue_options:
+    if configData.has_option('queues', option):
+        queue_options[option] = configData.get('queues', option)
+io_queue = WorkQueue('io', queue_options['io_workers'],
+                     queue_options['io_max_queued'])
+callback_queue = WorkQueue('callback', queue_options['callback_workers'])
+
+
+def _write_manifest(staged_path):
+    """Write a manifest of the files of a staged product.
+
+    The manifest contains a line of JSON for each file with its path
+    (relative to staged_path), size, modification time and checksum,
+    followed by a line reporting the number of files.  Checksums are
+    computed in parallel by a bounded pool of workers.  The manifest is
+    written to a temporary file which is renamed once complete, so that
+    partial manifests are never served.  Checksums are taken from the
+    checksum cache where possible, which holds those of earlier stagings of
+    the same (hard linked) files.
+    """
+    prefix = len(join(staged_path, ''))
+    paths = []
+    for dir, _, filenames in os.walk(staged_path):
+        paths += [join(dir, filename) for filename in filenames]
+
+    manifest = staged_path.rstrip(os.sep) + MANIFEST_SUFFIX
+    with open(manifest + '.tmp', 'w') as f:
+        for path, (size, mtime, checksum) in \
+                checksums.describe_many(paths, manifest_pool):
+            f.write(json.dumps({'path': path[prefix:], 'size': size,
+                                'mtime': mtime, 'checksum': checksum}) +
+                    "\n")
+        f.write(json.dumps({'success': True, 'count': len(paths)}) + "\n")
+    os.rename(manifest + '.tmp', manifest)
 
-def _process_staging_request(transfer_id, product_id, callback):
-    """Process a staging request."""
-    log.msg("_process_staging_request (%s, %s)"
-            % (product_id, callback))
+
+def _stage_product(transfer_id, product_id):
+    """Stage a product, returning the report of its completion."""
+    log.msg("_stage_product (%s, %s)" % (transfer_id, product_id))
 
     src_path = os.path.join(staging_src_dir, product_id)
     dst_path = os.path.join(staging_dst_dir, str(uuid.uuid1()))
 
     # Do the copy
     stagingError = None
+    copy_msg = ''
     log.msg("About to link %s to %s" % (src_path, dst_path))
     try:
         os.mkdir(dst_path)
         dst_file = os.path.join(dst_path, str(product_id))
         if os.path.isdir(src_path):
-            shutil.copytree(src_path, dst_file)
+            stats = copy_engine.copy(src_path, dst_file)
+            methods = ', '.join('%s %s' % (count, method) for method, count
+                                in sorted(stats['methods'].items()))
+            copy_msg = (' (%s files, %s links, %s bytes in %.1fs at %.1f '
+                        'MB/s; %s)' % (stats['files'], stats['links'],
+                                       stats['bytes'], stats['seconds'],
+                                       stats['rate'] / 1e6, methods))
+            log.msg('Copied product %s%s' % (product_id, copy_msg))
         elif os.path.isfile(src_path):
             os.link(src_path, dst_file)
         else:
@@ -93,52 +176,81 @@ def _process_staging_request(transfer_id, product_id, callback):
     except Exception, e:
         stagingError = e
 
-    # Function to report results
-    def _handle_reporting_error(failure, product_id, callback):
-        failure.trap(Exception)
-        log.err("Error reporting staging results for product %s to %s"
-                % (product_id, callback))
-        log.err(str(failure))
+    # Record the sizes and checksums of the staged files
+    if stagingError is None:
+        try:
+            _write_manifest(dst_path)
+        except Exception, e:
+            log.err('Error writing manifest for product %s: %s'
+                    % (product_id, str(e)))
 
     if stagingError is not None:
         # Report error
         msg = ('Error copying product ID %s from %s to %s' %
                (product_id, src_path, dst_path))
         log.err(msg)
-        log.err(str(e))
+        log.err(str(stagingError))
         success = False
     else:
-        msg = 'Product %s staged successfully to %s' % (product_id, dst_path)
+        msg = ('Product %s staged successfully to %s%s'
+               % (product_id, dst_path, copy_msg))
         success = True
-    result = threads.deferToThread(requests.post,
-                                   callback,
-                                   data={'transfer_id': transfer_id,
-                                         'product_id': product_id,
-                                         'success': success,
-                                         'staged_to': hostname(),
-                                         'path': dst_path,
-                                         'msg': msg},
-                                   cert=(stager_cert, stager_key))
-    result.addCallback(lambda r: log.msg("Staging of product %s "
-                                         "reported (result: %s)"
-                                         % (product_id, r.status_code)))
-    result.addErrback(lambda e: _handle_reporting_error(e, product_id,
-                                                        callback))
+    return {'transfer_id': transfer_id, 'product_id': product_id,
+            'success': success, 'staged_to': hostname(), 'path': dst_path,
+            'msg': msg}
 
 
-@app.route('/')
-def root(request):
-    """Called when a staging request has been received.
+def _report_completions(completions, callback):
+    """Report the completion of staging tasks to the transfer service.
 
-    Required params:
-    transfer_id -- (Transfer service) identifier for the transfer being staged
-    product_id -- Product ID to be staged
-    callback -- URI of a transfer service URL to be called upon completion
-        of the staging tasks
+    A single completion is reported using form parameters, whereas several
+    are reported together as a JSON array.
     """
-    request.setHeader('Content-Type', 'application/json')
+    product_ids = ', '.join(c['product_id'] for c in completions)
+    try:
+        if len(completions) == 1:
+            r = requests.post(callback, data=completions[0],
+                              cert=(stager_cert, stager_key))
+        else:
+            r = requests.post(callback, data=json.dumps(completions),
+                              headers={'Content-Type': 'application/json'},
+                              cert=(stager_cert, stager_key))
+        log.msg("Staging of product(s) %s reported (result: %s)"
+                % (product_ids, r.status_code))
+    except Exception, e:
+        log.err("Error reporting staging results for product(s) %s to %s"
+                % (product_ids, callback))
+        log.err(str(e))
 
-    # Extract certificate DN & verify authorization
+
+def _process_staging_batch(transfers):
+    """Process a batch of staging requests (or a single request).
+
+    A tape-backed stager would order the recalls of a batch by tape and
+    position on tape; the products are staged here in order of product ID.
+
+    Return value:
+    A list of the reports of the completion of each transfer.
+    """
+    log.msg("_process_staging_batch (%s transfers)" % len(transfers))
+    return [_stage_product(transfer_id, product_id)
+            for transfer_id, product_id
+            in sorted(transfers, key=lambda t: t[1])]
+
+
+def _queue_staging(transfers, callback):
+    """Queue staging requests, reporting their completions together.
+
+    Raises QueueFull if too many requests are queued.
+    """
+    d = io_queue.submit(_process_staging_batch, transfers)
+    d.addCallback(lambda completions: callback_queue.submit(
+        _report_completions, completions, callback))
+    d.addErrback(log.err)
+
+
+def _authorized(request):
+    """Check that the client certificate of a request is authorized."""
     cert = request.transport.getPeerCertificate()
     basename = cert.get_subject()
     for i in range(0, cert.get_extension_count()):
@@ -149,7 +261,27 @@ def root(request):
     components = basename.get_components()
     components = map(lambda (x, y): '%s=%s' % (x, y), components)
     baseDN = '/' + '/'.join(components)
-    if baseDN not in allowedDNs:
+    return baseDN in allowedDNs
+
+
+@app.route('/')
+def root(request):
+    """Called when a staging request has been received.
+
+    Required params:
+    transfer_id -- (Transfer service) identifier for the transfer being staged
+    product_id -- Product ID to be staged
+    callback -- URI of a transfer service URL to be called upon completion
+        of the staging tasks
+
+    If too many requests are queued the request is rejected with the status
+    code 503, and the Retry-After header gives the number of seconds after
+    which to retry.
+    """
+    request.setHeader('Content-Type', 'application/json')
+
+    # Extract certificate DN & verify authorization
+    if not _authorized(request):
         request.setResponseCode(403)
         return json.dumps({'status': 'Unauthorized'})
 
@@ -158,19 +290,91 @@ def root(request):
         transfer_id = request.args.get('transfer_id')[0]
         product_id = request.args.get('product_id')[0]
         callback = request.args.get('callback')[0]
-    except Exception, e:
-        # log.err(str(e))
+    except Exception:
         request.setResponseCode(400)
         return json.dumps({'status': 'Invalid parameters. A transfer_id, '
                            'product_id, and callback must be specified'})
 
     # Process request in separate thread
-    reactor.callInThread(_process_staging_request, transfer_id, product_id,
-                         callback)
+    try:
+        _queue_staging([(transfer_id, product_id)], callback)
+    except QueueFull:
+        return respond_busy(request, io_queue)
     return json.dumps({'status': 'Request for product ID %s queued'
                       % product_id})
 
 
+@app.route('/status')
+def status(request):
+    """Return the state of the queues of work of the stager as JSON."""
+    request.setHeader('Content-Type', 'application/json')
+    if not _authorized(request):
+        request.setResponseCode(403)
+        return json.dumps({'status': 'Unauthorized'})
+    return json.dumps({'queues': {'io': io_queue.status(),
+                                  'callback': callback_queue.status()}})
+
+
+@app.route('/stageBatch')
+def stage_batch(request):
+    """Called when a batch of staging requests has been received.
+
+    Required params:
+    transfers -- JSON list of objects containing the transfer_id and
+        product_id of each transfer to stage
+    callback -- URI of a transfer service URL to be called upon completion
+        of the staging of each transfer
+
+    Returns JSON containing a list of results for each transfer, reporting
+    whether it was queued, along with a message.  If too many requests are
+    queued the whole batch is rejected with the status code 503, and the
+    Retry-After header gives the number of seconds after which to retry.
+    """
+    request.setHeader('Content-Type', 'application/json')
+
+    if not _authorized(request):
+        request.setResponseCode(403)
+        return json.dumps({'status': 'Unauthorized'})
+
+    try:
+        transfers = json.loads(request.args.get('transfers')[0])
+        callback = request.args.get('callback')[0]
+        if not isinstance(transfers, list):
+            raise ValueError('transfers must be a list')
+    except Exception:
+        request.setResponseCode(400)
+        return json.dumps({'status': 'Invalid parameters. A list of '
+                           'transfers and a callback must be specified'})
+
+    queued = []
+    results = []
+    for transfer in transfers:
+        try:
+            transfer_id = str(transfer['transfer_id'])
+            product_id = str(transfer['product_id'])
+        except Exception:
+            results.append({'transfer_id': transfer.get('transfer_id')
+                            if isinstance(transfer, dict) else None,
+                            'queued': False,
+                            'msg': 'A transfer_id and product_id must be '
+                                   'specified'})
+            continue
+        queued.append((transfer_id, product_id))
+        results.append({'transfer_id': transfer_id, 'queued': True,
+                        'msg': 'Request for product ID %s queued'
+                               % product_id})
+
+    # Process the batch in a separate thread
+    if queued:
+        try:
+            _queue_staging(queued, callback)
+        except QueueFull:
+            return respond_busy(request, io_queue)
+    return json.dumps({'status': 'Queued %s of %s requests'
+                       % (len(queued), len(transfers)),
+                       'transfers': results})
+
+
 # Setup SSL
 def _load_cert_function(x):
     return crypto.load_certificate(crypto.FILETYPE_PEM, x)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Stream changes to the state of transfers to clients."""
+# Copyright 2017  University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function  # for python 2
+
+import json
+
+from collections import deque
+from datetime import datetime
+from time import time
+from twisted.internet import task
+from twisted.logger import Logger
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from util import check_auth, match_against_admin
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+log = Logger()
+
+_recent = deque(maxlen=1000)
+"""Recently published events, replayed to clients which reconnect."""
+_last_id = int(time() * 1000)
+"""ID of the most recently published event (based on the clock, so that
+IDs continue to increase when the service is restarted)."""
+_watchers = {}
+"""Callbacks watching individual transfers, keyed by transfer ID."""
+_watchers_all = set()
+"""Callbacks watching all transfers."""
+
+
+def publish_event(transfer_id, status, **details):
+    """Publish a change to the state of a transfer to all watchers.
+
+    This should be called once the change has been written to the DB.
+    Events are only delivered to clients connected to this instance of the
+    service.
+
+    Arguments:
+    transfer_id -- ID of the transfer
+    status -- New status of the transfer
+    details -- Additional fields to include in the event (e.g. extra_status)
+    """
+    global _last_id
+
+    _last_id += 1
+    event = dict(details)
+    event.update({'id': _last_id, 'transfer_id': transfer_id,
+                  'status': status,
+                  'time': datetime.utcnow().isoformat()})
+    _recent.append(event)
+    for callback in list(_watchers.get(transfer_id, ())) + \
+            list(_watchers_all):
+        try:
+            callback(event)
+        except Exception, e:
+            log.error('Error delivering event for transfer %s: %s'
+                      % (transfer_id, str(e)))
+
+
+def subscribe(callback, transfer_ids=None, last_id=None):
+    """Call a function with each event published for a set of transfers.
+
+    Arguments:
+    callback -- Function called with each event (a dictionary)
+    transfer_ids -- IDs of the transfers to watch, or None for all
+    last_id -- ID of the last event received by the client; more recent
+      events which are still retained are delivered immediately
+    """
+    if last_id is not None:
+        for event in list(_recent):
+            if event['id'] > last_id and \
+                    (transfer_ids is None or
+                     event['transfer_id'] in transfer_ids):
+                callback(event)
+
+    if transfer_ids is None:
+        _watchers_all.add(callback)
+    else:
+        for transfer_id in transfer_ids:
+            _watchers.setdefault(transfer_id, set()).add(callback)
+
+
+def unsubscribe(callback, transfer_ids=None):
+    """Stop calling a function subscribed using subscribe()."""
+    if transfer_ids is None:
+        _watchers_all.discard(callback)
+        return
+    for transfer_id in transfer_ids:
+        callbacks = _watchers.get(transfer_id)
+        if callbacks is not None:
+            callbacks.discard(callback)
+            if not callbacks:
+                del _watchers[transfer_id]
+
+
+class TransferEvents (Resource):
+    """Stream changes to the state of transfers as server-sent events.
+
+    Events are delivered from memory as the stages of the transfer process
+    update the transfers table, so clients watching transfers don't require
+    any database queries beyond checking their authorization when they
+    connect.
+
+    Mounted at /transferEvents.
+    """
+
+    isLeaf = True
+
+    max_ids = 1000
+    """Maximum number of transfers which may be watched by a client."""
+
+    keepalive_interval = 30
+    """Interval in seconds at which comments are sent to idle clients."""
+
+    def __init__(self, dbpool):
+        """Initialize the transfer event stream REST interface.
+
+        Arguments:
+        dbpool -- shared database connection pool
+        """
+        Resource.__init__(self)
+        self.dbpool = dbpool
+        self.log = Logger()
+        self._clients = set()
+        self._keepalive = task.LoopingCall(self._send_keepalive)
+
+    def _error(self, request, code, msg):
+        """Set the response code and return a JSON error message."""
+        request.setResponseCode(code)
+        return json.dumps({'error': True, 'msg': msg}) + "\n"
+
+    def _send_keepalive(self):
+        """Send a comment to all clients to keep their connections open."""
+        for request in list(self._clients):
+            request.write(":\n\n")
+
+    def render_GET(self, request):
+        """Process GET request for a stream of transfer events.
+
+        Optional parameters:
+        transfer_id -- (may be repeated) ID of a transfer to watch, which
+          must have been submitted using the same certificate.  If not
+          given, all transfers are watched.  Both watching all transfers
+          and watching those of other submitters are only permitted for
+          admin DNs.
+
+        The current status of each watched transfer is sent when the stream
+        is opened.  Each event has an ID, and a client reconnecting with a
+        Last-Event-ID header is sent the events it missed (provided they
+        are still retained in memory).
+
+        Return value:
+        A text/event-stream in which the data of each event is JSON
+        containing the transfer_id, status and time of the change, along
+        with any other details of the change.
+        """
+        x509dn = check_auth(request, None, returnError=False)
+        if not x509dn:
+            return self._error(request, 403, 'Unauthorized')
+
+        privileged = match_against_admin(x509dn)
+        transfer_ids = request.args.get('transfer_id')
+        if transfer_ids is None and not privileged:
+            return self._error(request, 400, 'No transfer ID specified')
+        if transfer_ids is not None and len(transfer_ids) > self.max_ids:
+            return self._error(request, 400, 'At most %s transfers may be '
+                               'watched at once' % self.max_ids)
+
+        last_id = request.getHeader('Last-Event-ID')
+        try:
+            last_id = int(last_id) if last_id else None
+        except ValueError:
+            last_id = None
+
+        def _send(event):
+            request.write("id: %s\ndata: %s\n\n"
+                          % (event['id'], json.dumps(event)))
+
+        def _start_stream(rows):
+            """Send the current state of the transfers and subscribe."""
+            if transfer_ids is not None:
+                if len(rows) < len(set(transfer_ids)):
+                    request.setResponseCode(404)
+                    found = set(row[0] for row in rows)
+                    missing = [t for t in transfer_ids if t not in found]
+                    request.write(json.dumps({
+                      'error': True,
+                      'msg': "transfer_id(s) not found or not submitted by "
+                             "'%s': %s" % (x509dn, ', '.join(missing))
+                    }) + "\n")
+                    request.finish()
+                    return
+
+            request.setHeader('Content-Type', 'text/event-stream')
+            request.setHeader('Cache-Control', 'no-cache')
+            request.write("retry: 5000\n\n")
+            if last_id is None:
+                for transfer_id, status in rows:
+                    request.write("data: %s\n\n"
+                                  % json.dumps({'transfer_id': transfer_id,
+                                                'status': status}))
+
+            watched = None if transfer_ids is None else set(transfer_ids)
+            subscribe(_send, watched, last_id)
+            self._clients.add(request)
+            if not self._keepalive.running:
+                self._keepalive.start(self.keepalive_interval, now=False)
+
+            def _closed(result):
+                unsubscribe(_send, watched)
+                self._clients.discard(request)
+                if not self._clients and self._keepalive.running:
+                    self._keepalive.stop()
+            request.notifyFinish().addBoth(_closed)
+
+        def _report_db_error(e):
+            """Report error if issue encountered checking authorization."""
+            self.log.error(e)
+            request.setResponseCode(500)
+            request.write(json.dumps({'error': True, 'msg': 'An unknown '
+                                      'database error occurred'}) + "\n")
+            request.finish()
+
+        if transfer_ids is None:
+            _start_stream([])
+            return NOT_DONE_YET
+
+        # Check that the transfers exist and were submitted by the client
+        query = ("SELECT transfer_id, status FROM transfers WHERE "
+                 "transfer_id IN (%s)" % ", ".join(["%s"] * len(transfer_ids)))
+        values = list(transfer_ids)
+        if not privileged:
+            query += " AND submitter = %s"
+            values.append(x509dn)
+        d = self.dbpool.runQuery(query, values)
+        d.addCallback(_start_stream)
+        d.addErrback(_report_db_error)
+        return NOT_DONE_YET
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Asynchronous interface to the FTS REST client."""
+# Copyright 2017  University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function  # for python 2
+
+import fts3.rest.client.easy as fts3
+import os
+import threading
+
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+
+class FTSClient (object):
+    """Make calls to the FTS server without blocking the reactor.
+
+    The FTS REST client only offers blocking calls, so these are all run in
+    a dedicated thread pool of bounded size.  This ensures that slow
+    responses from FTS neither block the reactor nor exhaust the reactor's
+    default thread pool, which is shared with other parts of the service.
+    All public methods return deferreds.
+
+    Each thread in the pool keeps a long-lived FTS context, so that the
+    credentials are loaded and the endpoint discovered only once rather
+    than for every request, and so that connections to the FTS server can be
+    kept alive.  A context is discarded and recreated if a call using it
+    fails or if the certificate or key have been modified (e.g. when a proxy
+    certificate is renewed).
+    """
+
+    def __init__(self, fts_params, max_threads=4):
+        """Initialize the FTS client and start its thread pool.
+
+        Arguments:
+        fts_params -- A list of parameters to initialize the FTS service
+            [URI of FTS server, path to certificate, path to key]
+        max_threads -- Maximum number of concurrent requests to FTS
+        """
+        self._fts_params = fts_params
+        self._contexts = threading.local()
+        self._threadpool = ThreadPool(minthreads=1,
+                                      maxthreads=int(max_threads),
+                                      name='fts')
+        self._threadpool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown',
+                                      self._threadpool.stop)
+
+    def _run(self, f, *args, **kwargs):
+        """Run a blocking function in the FTS thread pool.
+
+        The function is called with the thread's FTS context as its first
+        argument, followed by the arguments passed in.
+        """
+        def _call():
+            try:
+                return f(self._context(), *args, **kwargs)
+            except Exception:
+                self._contexts.context = None
+                raise
+        return threads.deferToThreadPool(reactor, self._threadpool, _call)
+
+    def _credentials_stamp(self):
+        """Return the modification times of the certificate and key."""
+        stamp = []
+        for path in self._fts_params[1:]:
+            try:
+                stamp.append(os.stat(path).st_mtime)
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _context(self):
+        """Return the FTS context of the current thread.
+
+        Must be called from the thread pool.
+        """
+        stamp = self._credentials_stamp()
+        cached = getattr(self._contexts, 'context', None)
+        if cached is None or cached[0] != stamp:
+            self._contexts.context = (stamp, fts3.Context(*self._fts_params))
+        return self._contexts.context[1]
+
+    def submit(self, transfers, **job_params):
+        """Submit a new FTS job and return its FTS ID.
+
+        Arguments:
+        transfers -- A list of transfers created by fts3.new_transfer
+        job_params -- Additional parameters passed to fts3.new_job
+        """
+        def _submit(context):
+            job = fts3.new_job(transfers, **job_params)
+            return fts3.submit(context, job)
+        return self._run(_submit)
+
+    def get_job_status(self, fts_id, list_files=False):
+        """Return the status of a single FTS job."""
+        def _get_job_status(context):
+            return fts3.get_job_status(context, fts_id,
+                                       list_files=list_files)
+        return self._run(_get_job_status)
+
+    def get_jobs_statuses(self, fts_ids, batch_size=50):
+        """Retrieve the status of several FTS jobs in batched requests.
+
+        Arguments:
+        fts_ids -- A list of FTS job IDs
+        batch_size -- Maximum number of job IDs queried per request
+
+        Return value (via deferred):
+        A dictionary mapping FTS job IDs to the job status reported by FTS
+        (without the listing of files).
+        """
+        def _get_jobs_statuses(context):
+            statuses = {}
+            for i in range(0, len(fts_ids), batch_size):
+                batch = fts_ids[i:i + batch_size]
+                result = fts3.get_jobs_statuses(context, batch)
+                # FTS returns a single object rather than a list for one ID
+                if isinstance(result, dict):
+                    result = [result]
+                for job in result:
+                    if 'job_id' in job and 'job_state' in job:
+                        statuses[job['job_id']] = job
+            return statuses
+        return self._run(_get_jobs_statuses)
@@ -20,272 +20,997 @@ from __future__ import print_function  # for python 2
 import fts3.rest.client.easy as fts3
 import json
 import os
-import pika
-import requests
-import twisted
 
 from os.path import basename
-from time import sleep
-from twisted.internet import reactor, threads
-from twisted.internet.defer import DeferredSemaphore, inlineCallbacks, \
+from time import time
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList, inlineCallbacks, \
                                    returnValue
-from twisted.internet.task import LoopingCall
 from twisted.logger import Logger
 
+from admission import AdmissionController
+from consumer import QueueConsumer
+from ftsclient import FTSClient
+from scheduler import PairScheduler
+from statemachine import transition, transition_txn, transitioned
+
 __author__ = "David Aikema, <david.aikema@uct.ac.za>"
 
+_SUBMISSION_TIMEOUT = 3600
+"""Seconds after which a submission to FTS is considered interrupted."""
+
+_MAX_FAILED_FILES = 20
+"""Maximum number of failed files whose reasons are stored for a job."""
+
+_FAILED_JOB_STATES = ('FAILED', 'FINISHEDDIRTY', 'CANCELED')
+"""States of FTS jobs which have ended without transferring all files."""
+
+
+def _summarize_fts_job(fts_job_status):
+    """Summarize the status of an FTS job for storage in the DB.
+
+    Rather than storing the full listing of files, the state of the job is
+    stored along with the number of files in each state, the total and
+    transferred bytes and the reasons for (a bounded number of) failures.
+
+    Parameters:
+    fts_job_status -- Status of the job (including files) reported by FTS
+
+    Return value:
+    The summary encoded as compact JSON.
+    """
+    files = fts_job_status.get('files') or []
+    counts = {}
+    for f in files:
+        counts[f.get('file_state')] = counts.get(f.get('file_state'), 0) + 1
+    failed = [{'file': basename(str(f.get('source_surl', ''))),
+               'reason': f.get('reason')}
+              for f in files if f.get('file_state') == 'FAILED']
+    summary = {
+      'job_state': fts_job_status.get('job_state'),
+      'reason': fts_job_status.get('reason'),
+      'files': counts,
+      'bytes': sum(f.get('filesize') or 0 for f in files),
+      'bytes_done': sum(f.get('filesize') or 0 for f in files
+                        if f.get('file_state') == 'FINISHED'),
+      'failed': failed[:_MAX_FAILED_FILES],
+    }
+    return json.dumps(summary, sort_keys=True, separators=(',', ':'))
+
+
+def _file_changes(job, fts_job_status):
+    """Determine which files of an FTS job have changed.
+
+    Parameters:
+    job -- The record of the job being tracked
+    fts_job_status -- Status of the job (including files) reported by FTS
+
+    Return value:
+    A dictionary of the (state, size, reason) of each file which has
+    changed since the files of the job were last written to the DB, keyed
+    by FTS file ID.
+    """
+    changes = {}
+    for f in fts_job_status.get('files') or []:
+        state = (f.get('file_state'), f.get('filesize') or 0, f.get('reason'))
+        if job['files'].get(f.get('file_id')) != state:
+            changes[f.get('file_id')] = state
+    return changes
+
+
+def _track_fts_job(fts_id, transfer_id, started=None, pair=None,
+                   scheduled=False, retries=0):
+    """Start tracking an FTS job so that its status will be polled.
+
+    Parameters:
+    fts_id -- ID of the FTS job
+    transfer_id -- ID of the transfer the FTS job belongs to
+    started -- Time at which the job was submitted to FTS (defaults to now)
+    pair -- Tuple of the source and destination hosts of the transfer
+    scheduled -- Whether the job holds a slot from the pair scheduler, which
+      must be released once the job has ended
+    retries -- Number of times failed files of the transfer have already
+      been resubmitted to FTS
+    """
+    global _fts_jobs
+    global _poll_min
+
+    now = time()
+    _fts_jobs[fts_id] = {
+      'transfer_id': transfer_id,
+      'started': float(started) if started else now,
+      'tracked': now,
+      'state': None,
+      'bytes': 0,
+      'bytes_done': 0,
+      'interval': _poll_min,
+      'due': now + _poll_min,
+      'pair': pair,
+      'scheduled': scheduled,
+      'details': None,
+      'files': {},
+      'listed': 0.0,
+      'retries': int(retries or 0),
+      'retrying': False,
+    }
+
+
+def _observe_fts_job(job, fts_job_status):
+    """Record the details of an FTS job and report if it has progressed.
+
+    Parameters:
+    job -- The record of the job being tracked
+    fts_job_status -- Status of the job (including files) reported by FTS
+
+    Return value:
+    True if the state of the job or the amount of data transferred has
+    changed since the job was last observed.
+    """
+    files = fts_job_status.get('files', [])
+    size = sum(f.get('filesize') or 0 for f in files)
+    done = sum(f.get('filesize') or 0 for f in files
+               if f.get('file_state') == 'FINISHED')
+    progressed = (fts_job_status['job_state'] != job['state'] or
+                  done != job['bytes_done'])
+    job['state'] = fts_job_status['job_state']
+    job['bytes'] = size
+    job['bytes_done'] = done
+    return progressed
+
+
+def _failed_files(fts_job_status):
+    """Return the files of an FTS job which failed to be transferred."""
+    return [f for f in fts_job_status.get('files') or []
+            if f.get('file_state') == 'FAILED']
+
+
+@inlineCallbacks
+def _list_files(url, localpath):
+    """Retrieve the list of files of a staged product from a transfer agent.
+
+    The listing is requested as newline-delimited JSON and parsed as it is
+    received, so that the whole response is never held in memory.  Agents
+    which don't support streaming reply with a single JSON document, which
+    is also accepted.  If the stager wrote a manifest of the product, the
+    agent serves it in place of listing the directory, and it includes the
+    checksum of each file.
+
+    Parameters:
+    url -- URL of the /files interface of the transfer agent
+    localpath -- Path of the staged product on the transfer node
+
+    Return value (via deferred):
+    A list of tuples of the path of each file relative to the product, its
+    size in bytes and its checksum (None if not known).
+    """
+    global _http_client
+
+    files = []
+    listing = {}
+
+    def _add_line(line):
+        if not line.strip() or 'result' in listing:
+            return
+        entry = json.loads(line)
+        if 'path' in entry:
+            files.append((entry['path'], entry.get('size'),
+                          entry.get('checksum')))
+        elif not entry.get('success'):
+            raise Exception(entry.get('msg', 'Error listing files'))
+        elif 'files' in entry:
+            listing['result'] = [(path, None, None)
+                                 for path in entry['files']]
+        else:
+            listing['result'] = files
+
+    status = yield _http_client.post_lines(url, _add_line,
+                                           {'dir': localpath},
+                                           {'Accept': 'application/x-ndjson'})
+    if status != 200:
+        raise Exception('The transfer agent reported an error - status was '
+                        '%s' % status)
+    if 'result' not in listing:
+        raise Exception('Incomplete list of files received')
+    returnValue(listing['result'])
+
+
+def _next_poll_interval(job, progressed, now):
+    """Determine how long to wait before polling an FTS job again.
+
+    Jobs which have made progress are polled again at the minimum interval,
+    whereas the interval is doubled (up to the maximum interval) for jobs
+    which haven't, so that long transfers are polled less often as they
+    age.  If the throughput of previous transfers is known, a job is also
+    polled again around the time at which it is expected to complete.
+    """
+    global _fts_throughput
+    global _poll_max
+    global _poll_min
+
+    if progressed:
+        interval = _poll_min
+    else:
+        interval = min(job['interval'] * 2, _poll_max)
+
+    if _fts_throughput and job['bytes']:
+        expected = job['started'] + job['bytes'] / _fts_throughput
+        if expected > now:
+            interval = min(interval, max(expected - now, _poll_min))
+    return interval
+
+
+@inlineCallbacks
+def _resync_fts_jobs():
+    """Synchronize the jobs being tracked with transfers in the DB.
+
+    This picks up transfers which entered the TRANSFERRING state without
+    being tracked (e.g. following a restart) and stops tracking those which
+    are no longer in that state.
+
+    Transfers which were admitted to the TRANSFERRING state but never
+    received an FTS ID (e.g. because the service was restarted while
+    submitting them to FTS) are returned to the PREPARINGDONE state and
+    queued to be transferred again.
+    """
+    global _dbpool
+    global _fts_jobs
+    global _fts_resync_due
+    global _poll_max
+    global _publisher
+    global _scheduler
+    global _transfer_queue
+
+    def _reset_interrupted(txn):
+        """Return interrupted submissions to PREPARINGDONE."""
+        txn.execute("SELECT transfer_id FROM transfers WHERE status = "
+                    "'TRANSFERRING' AND fts_id IS NULL AND time_transferring "
+                    "< NOW() - INTERVAL %s SECOND", [_SUBMISSION_TIMEOUT])
+        transfer_ids = [row[0] for row in txn.fetchall()]
+        if transfer_ids:
+            txn.executemany("UPDATE transfers SET status = 'PREPARINGDONE' "
+                            "WHERE transfer_id = %s AND status = "
+                            "'TRANSFERRING' AND fts_id IS NULL",
+                            [[transfer_id] for transfer_id in transfer_ids])
+        return transfer_ids
+
+    interrupted = yield _dbpool.runInteraction(_reset_interrupted)
+    if interrupted:
+        _log.info('Queueing %s transfers whose submission to FTS was '
+                  'interrupted to be transferred again' % len(interrupted))
+        for transfer_id in interrupted:
+            transitioned(transfer_id, 'PREPARINGDONE')
+        yield _publisher.publish_many(_transfer_queue, interrupted)
+
+    query_time = time()
+    r = yield _dbpool.runQuery("SELECT transfer_id, fts_id, "
+                               "UNIX_TIMESTAMP(time_transferring), "
+                               "stager_hostname, destination_host, "
+                               "fts_retries FROM transfers WHERE "
+                               "status='TRANSFERRING' AND fts_id IS NOT NULL")
+    current = set()
+    for transfer_id, fts_id, started, source, destination, retries in r:
+        current.add(fts_id)
+        if fts_id not in _fts_jobs:
+            _track_fts_job(fts_id, transfer_id, started,
+                           (source, destination), retries=retries)
+            _fts_jobs[fts_id]['due'] = query_time
+    for fts_id in set(_fts_jobs) - current:
+        # Jobs being retried are left to _retry_fts_job
+        if _fts_jobs[fts_id]['tracked'] < query_time and \
+                not _fts_jobs[fts_id]['retrying']:
+            job = _fts_jobs.pop(fts_id)
+            if job['scheduled']:
+                _scheduler.release(job['pair'])
+    _fts_resync_due = query_time + _poll_max
+
 
 # FTS Updater
-# (scans FTS server at a regular interval, updating the status of tasks)
+# (polls the FTS server for the status of jobs as they become due)
 @inlineCallbacks
 def _FTSUpdater():
-    """Contact FTS to update the status of transfers in TRANSFERRING state."""
+    """Contact FTS to update the status of transfers in TRANSFERRING state.
+
+    Only jobs which are due to be polled are queried.  The status of these
+    jobs is retrieved using batched queries to FTS, and details of
+    individual files are only retrieved for jobs whose state has changed
+    since the last time they were polled, or for active jobs whose files
+    haven't been retrieved within the maximum polling interval (so that
+    their progress is still reported).  A failure to retrieve the files of
+    one job doesn't affect the others.  The failed
+    files of jobs which fail are resubmitted to FTS (see _retry_fts_job)
+    while the retry budget of the transfer allows.  The details of
+    a job are only written to the DB when its summary differs from the one
+    last written, and likewise only files whose state has changed are
+    updated in the transfer_files table.  All resulting database updates
+    are written in a single interaction.
+    """
     global _log
     global _dbpool
-    global _fts_params
-    global _sem_fts
-
-    _log.info("Running FTS updater")
+    global _fts_client
+    global _fts_jobs
+    global _fts_resync_due
+    global _fts_throughput
+    global _admission
+    global _poll_max
+    global _retry_delay
+    global _retry_max
+    global _scheduler
+    global _status_batch_size
+
+    now = time()
+    if now >= _fts_resync_due:
+        try:
+            yield _resync_fts_jobs()
+        except Exception, e:
+            _log.error('Error retrieving list of in transferring stage from '
+                       'DB')
+            _log.error(str(e))
 
-    # Initialize FTS context
-    try:
-        fts_context = fts3.Context(*_fts_params)
-    except Exception, e:
-        _log.error('Exception creating FTS context in _FTSUpdater')
-        _log.error(str(e))
+    # Jobs may stop being tracked while the updater waits for FTS or the DB
+    # (e.g. once they have been retried), so the records of the due jobs
+    # are kept and only those which are still tracked are updated
+    jobs = dict((fts_id, job) for fts_id, job in _fts_jobs.items()
+                if job['due'] <= now and not job['retrying'])
+    due = jobs.keys()
+    if not due:
         returnValue(None)
+    _log.info("Running FTS updater for %s transfers" % len(due))
 
-    # Retrieve list of transfers currently submitted to FTS from DB
+    # Retrieve the state of the jobs, then the file listings of those jobs
+    # whose state has changed (or whose listing is stale)
     try:
-        r = yield _dbpool.runQuery("SELECT transfer_id, fts_id FROM transfers "
-                                   "WHERE status='TRANSFERRING'")
+        statuses = yield _fts_client.get_jobs_statuses(due,
+                                                       _status_batch_size)
     except Exception, e:
-        _log.error('Error retrieving list of in transferring stage from DB')
+        _log.error('Error retrieving status of transfers from FTS')
         _log.error(str(e))
-        returnValue(None)
-
-    if r is None:
-        _log.debug('FTS Updater found no transfers in the transferring state')
-        returnValue(None)
-
-    # for each transfer get FTS status
-    transfersUpdated = 0
-    for transfer in r:
+        statuses = {}
+    changed = [fts_id for fts_id in due if fts_id in statuses and
+               (statuses[fts_id]['job_state'] != jobs[fts_id]['state'] or
+                (statuses[fts_id]['job_state'] == 'ACTIVE' and
+                 now - jobs[fts_id]['listed'] >= _poll_max))]
+    results = yield DeferredList(
+        [_fts_client.get_job_status(fts_id, list_files=True)
+         for fts_id in changed], consumeErrors=True)
+    details = {}
+    for fts_id, (success, result) in zip(changed, results):
+        if success:
+            details[fts_id] = result
+            jobs[fts_id]['listed'] = now
+        else:
+            _log.error('Error retrieving files of FTS job %s' % fts_id)
+            _log.error(str(result.value))
+
+    # Work out the updates to make to the database
+    updates = []
+    finished = []
+    retries = []
+    summaries = {}
+    file_changes = {}
+    for fts_id, fts_job_status in details.items():
+        if _fts_jobs.get(fts_id) is not jobs[fts_id]:
+            del details[fts_id]
+            continue
+        transfer_id = jobs[fts_id]['transfer_id']
+        state = fts_job_status['job_state']
+        summary = summaries[fts_id] = _summarize_fts_job(fts_job_status)
+        changes = _file_changes(jobs[fts_id], fts_job_status)
+        if changes:
+            file_changes[fts_id] = changes
+        if state == 'FINISHED':
+            _log.info('Transfer %s successfully completed using FTS'
+                      % transfer_id)
+            updates.append(('SUCCESS', summary, transfer_id))
+            finished.append(fts_id)
+        elif state in _FAILED_JOB_STATES and state != 'CANCELED' and \
+                jobs[fts_id]['retries'] < _retry_max and \
+                _failed_files(fts_job_status):
+            _log.info('FTS job %s of transfer %s has failed; retrying its '
+                      'failed files' % (fts_id, transfer_id))
+            if summary != jobs[fts_id]['details']:
+                updates.append(('TRANSFERRING', summary, transfer_id))
+            retries.append(fts_id)
+        elif state in _FAILED_JOB_STATES:
+            _log.info('Transfer %s has failed during the transfer stage'
+                      % transfer_id)
+            updates.append(('ERROR', summary, transfer_id))
+            finished.append(fts_id)
+        elif summary != jobs[fts_id]['details']:
+            updates.append(('TRANSFERRING', summary, transfer_id))
+
+    def _write_updates(txn):
+        """Write the status of all updated transfers and files to the DB."""
+        applied = [transition_txn(txn, transfer_id, 'TRANSFERRING', status,
+                                  {'fts_details': fts_details}) is not None
+                   for status, fts_details, transfer_id in updates]
+        rows = [[state, size, reason, jobs[fts_id]['transfer_id'], file_id]
+                for fts_id, changes in file_changes.items()
+                for file_id, (state, size, reason) in changes.items()]
+        if rows:
+            txn.executemany("UPDATE transfer_files SET state = %s, size = "
+                            "GREATEST(size, %s), reason = %s WHERE "
+                            "transfer_id = %s AND fts_file_id = %s", rows)
+        return applied
+
+    if updates or file_changes:
         try:
-            transfer_id = transfer[0]
-            fts_id = transfer[1]
-            fts_job_status = fts3.get_job_status(fts_context, fts_id,
-                                                 list_files=True)
-
-            # Compare and update
-            state = fts_job_status['job_state']
-
-            if state == 'FINISHED':
-                _log.info('Transfer %s successfully completed using FTS'
-                          % transfer_id)
-                yield _dbpool.runQuery("UPDATE transfers SET status = "
-                                       "'SUCCESS', fts_details = %s WHERE "
-                                       "transfer_id = %s",
-                                       [str(fts_job_status), transfer_id])
-                yield _sem_fts.release()
-                transfersUpdated += 1
-            elif state == 'FAILED':
-                _log.info('Transfer %s has failed during the transfer stage'
-                          % transfer_id)
-                yield _dbpool.runQuery("UPDATE transfers SET status = "
-                                       "'ERROR', fts_details = %s WHERE "
-                                       "transfer_id = %s",
-                                       [str(fts_job_status), transfer_id])
-                yield _sem_fts.release()
-                transfersUpdated += 1
-            else:
-                yield _dbpool.runQuery("UPDATE transfers SET fts_details = %s "
-                                       "WHERE transfer_id = %s",
-                                       [str(fts_job_status), transfer_id])
-                transfersUpdated += 1
+            applied = yield _dbpool.runInteraction(_write_updates)
         except Exception, e:
             _log.error('Error updating status for transfers in FTS manager')
             _log.error(str(e))
-            returnValue(None)
-    if transfersUpdated > 0:
+            updates = []
+            details = {}
+            finished = []
+            retries = []
+            file_changes = {}
+        else:
+            updates = [u for u, a in zip(updates, applied) if a]
+
+    # Only record changes once they have been written to the DB, then
+    # decide when each job should next be polled
+    for status, fts_details, transfer_id in updates:
+        transitioned(transfer_id, status, {'fts_details': fts_details})
+    now = time()
+    written = set(transfer_id for _, _, transfer_id in updates)
+    for fts_id in due:
+        job = jobs[fts_id]
+        if _fts_jobs.get(fts_id) is not job or job['retrying']:
+            continue
+        if fts_id in summaries and job['transfer_id'] in written:
+            job['details'] = summaries[fts_id]
+        job['files'].update(file_changes.get(fts_id, {}))
+        progressed = (fts_id in details and
+                      _observe_fts_job(job, details[fts_id]))
+        job['interval'] = _next_poll_interval(job, progressed, now)
+        job['due'] = now + job['interval']
+
+    for fts_id in retries:
+        job = jobs[fts_id]
+        if _fts_jobs.get(fts_id) is not job or job['retrying']:
+            continue
+        job['retrying'] = True
+        job['due'] = float('inf')
+        _scheduler.record(job['pair'], job['bytes'], now - job['started'],
+                          False)
+        delay = _retry_delay * 2 ** job['retries']
+        reactor.callLater(delay, _retry_fts_job, fts_id, details[fts_id])
+
+    for fts_id in finished:
+        if _fts_jobs.get(fts_id) is not jobs[fts_id]:
+            continue
+        job = _fts_jobs.pop(fts_id)
+        elapsed = now - job['started']
+        if job['state'] == 'FINISHED' and job['bytes'] > 0 and elapsed > 0:
+            throughput = job['bytes'] / elapsed
+            if _fts_throughput is None:
+                _fts_throughput = throughput
+            else:
+                _fts_throughput = 0.8 * _fts_throughput + 0.2 * throughput
+        _scheduler.record(job['pair'], job['bytes'], elapsed,
+                          job['state'] == 'FINISHED')
+        if job['scheduled']:
+            _scheduler.release(job['pair'])
+    if finished:
+        _admission.notify()
+
+    if updates:
         _log.debug('FTS Updater updated the status of %s transfers that were '
-                   'in the TRANSFERRING state' % transfersUpdated)
+                   'in the TRANSFERRING state' % len(updates))
+
+
+def _end_fts_job(fts_id, transfer_id, msg):
+    """Stop tracking a job whose transfer couldn't be retried, failing it.
+
+    Parameters:
+    fts_id -- ID of the FTS job
+    transfer_id -- ID of the transfer the FTS job belongs to
+    msg -- Reason for the failure, recorded as the extra_status
+    """
+    global _admission
+    global _fts_jobs
+    global _scheduler
+
+    job = _fts_jobs.pop(fts_id, None)
+    if job is not None and job['scheduled']:
+        _scheduler.release(job['pair'])
+    d = transition(transfer_id, 'TRANSFERRING', 'ERROR',
+                   {'extra_status': msg})
+    d.addBoth(lambda _: _admission.notify())
+    return d
 
 
 @inlineCallbacks
-def _start_fts_transfer(transfer_id):
-    """Submit transfer request for transfer to FTS server and update DB."""
+def _retry_fts_job(fts_id, fts_job_status):
+    """Resubmit the failed files of an FTS job to FTS as a new job.
+
+    The new job replaces the failed one as the FTS job of the transfer, and
+    the records of the failed files in the transfer_files table are linked
+    to the new job.  Files which were transferred by earlier jobs aren't
+    transferred again, so the transfer succeeds once the new job has
+    finished.
+
+    The retry is claimed in the DB (by incrementing fts_retries while the
+    transfer still has the failed job) before anything is submitted to FTS,
+    so that only one instance of the service resubmits the files even if
+    several of them notice the failure.
+
+    Parameters:
+    fts_id -- ID of the failed FTS job
+    fts_job_status -- Status of the failed job (including files)
+    """
     global _log
     global _dbpool
-    global _fts_params
-    global _prepare_creds
+    global _fts_client
+    global _fts_jobs
+    global _retry_max
+    global _scheduler
+
+    job = _fts_jobs.get(fts_id)
+    if job is None or not job['retrying']:
+        # The transfer has left the TRANSFERRING state in the meantime
+        returnValue(None)
+    transfer_id = job['transfer_id']
+    failed = _failed_files(fts_job_status)
+    retries = job['retries'] + 1
+
+    def _untrack():
+        """Stop tracking the failed job, which has been superseded."""
+        if _fts_jobs.get(fts_id) is job:
+            del _fts_jobs[fts_id]
+            if job['scheduled']:
+                _scheduler.release(job['pair'])
+
+    def _claim_retry(txn):
+        """Count the retry against the transfer if it has the failed job."""
+        txn.execute("UPDATE transfers SET fts_retries = %s WHERE "
+                    "transfer_id = %s AND status = 'TRANSFERRING' AND "
+                    "fts_id = %s AND fts_retries = %s",
+                    [retries, transfer_id, fts_id, job['retries']])
+        return txn.rowcount == 1
 
     try:
-        fts_context = fts3.Context(*_fts_params)
+        claimed = yield _dbpool.runInteraction(_claim_retry)
     except Exception, e:
-        _log.error('Exception creating FTS context in _start_fts_transfer')
+        _log.error('Error claiming retry of transfer %s' % transfer_id)
         _log.error(str(e))
-        ds = "Failed to create FTS context when setting up transfer"
-        _dbpool.runQuery("UPDATE transfers SET status='ERROR', "
-                         "extra_status = %s WHERE transfer_id = %s",
-                         [ds, transfer_id])
+        yield _end_fts_job(fts_id, transfer_id, 'Error updating transfer '
+                           'status before FTS resubmission')
+        returnValue(None)
+    if not claimed:
+        _log.info('Not resubmitting failed files of transfer %s as FTS job '
+                  '%s has already been retried or the transfer has changed'
+                  % (transfer_id, fts_id))
+        _untrack()
         returnValue(None)
 
-    # Get information about the transfer from the database
-    r = yield _dbpool.runQuery("SELECT stager_path, stager_hostname, "
-                               "destination_path FROM transfers WHERE "
-                               "transfer_id = %s",
-                               [transfer_id])
-    if r is None:
-        _log.error('Invalid transfer_id %s received by FTS transfer service'
+    try:
+        transfers = [fts3.new_transfer(f['source_surl'], f['dest_surl'],
+                                       checksum=f.get('checksum'),
+                                       filesize=f.get('user_filesize'))
+                     for f in failed]
+        verify = any(f.get('checksum') for f in failed)
+        new_id = yield _fts_client.submit(transfers, verify_checksum=verify)
+        new_status = yield _fts_client.get_job_status(new_id,
+                                                      list_files=True)
+    except Exception, e:
+        _log.error('Error resubmitting failed files of transfer %s to FTS'
                    % transfer_id)
+        _log.error(str(e))
+        yield _end_fts_job(fts_id, transfer_id,
+                           'Error resubmitting failed files to FTS')
+        returnValue(None)
+
+    summary = _summarize_fts_job(new_status)
+    fields = {'fts_id': new_id, 'fts_details': summary,
+              'fts_retries': retries}
+    new_files = dict((f.get('source_surl'), f)
+                     for f in new_status.get('files') or [])
+    rows = []
+    for f in failed:
+        new_file = new_files.get(f['source_surl'], {})
+        rows.append([new_file.get('file_id'),
+                     new_file.get('file_state') or 'SUBMITTED',
+                     transfer_id, f.get('file_id')])
+
+    def _record_retry(txn):
+        """Link the transfer and its failed files to the new FTS job."""
+        txn.execute("SELECT fts_id, fts_retries FROM transfers WHERE "
+                    "transfer_id = %s FOR UPDATE", [transfer_id])
+        row = txn.fetchone()
+        if row is None or tuple(row) != (fts_id, retries):
+            return None
+        updated = transition_txn(txn, transfer_id, 'TRANSFERRING', None,
+                                 fields)
+        if updated is not None:
+            txn.executemany("UPDATE transfer_files SET fts_file_id = %s, "
+                            "state = %s, reason = NULL WHERE transfer_id = %s "
+                            "AND fts_file_id = %s", rows)
+        return updated
+
+    try:
+        updated = yield _dbpool.runInteraction(_record_retry)
+    except Exception, e:
+        _log.error('Error recording retry of transfer %s' % transfer_id)
+        _log.error(str(e))
+        yield _end_fts_job(fts_id, transfer_id, 'Error updating transfer '
+                           'status following FTS resubmission')
+        returnValue(None)
+    if updated is None:
+        _log.error('Transfer %s changed while its failed files were being '
+                   'resubmitted to FTS as job %s' % (transfer_id, new_id))
+        _untrack()
         returnValue(None)
+    transitioned(transfer_id, None, fields)
+    _log.info('Resubmitted %s failed files of transfer %s to FTS as job %s '
+              '(retry %s of %s)' % (len(failed), transfer_id, new_id,
+                                    retries, _retry_max))
+
+    # Track the new job in place of the failed one
+    if _fts_jobs.get(fts_id) is job:
+        del _fts_jobs[fts_id]
+    _track_fts_job(new_id, transfer_id, pair=job['pair'],
+                   scheduled=job['scheduled'], retries=retries)
+    _fts_jobs[new_id]['details'] = summary
+    _fts_jobs[new_id]['files'] = _file_changes(_fts_jobs[new_id], new_status)
+    _observe_fts_job(_fts_jobs[new_id], new_status)
+    _schedule_fts_updater()
+
+
+def _run_fts_updater():
+    """Run the FTS updater, scheduling the next run once it has finished."""
+    global _fts_updater_running
+
+    def _finished(result):
+        global _fts_updater_running
+        _fts_updater_running = False
+        _schedule_fts_updater()
+        return result
+
+    _fts_updater_running = True
+    d = _FTSUpdater()
+    d.addErrback(lambda f: _log.failure('Unhandled error in FTS updater', f))
+    d.addBoth(_finished)
+
+
+def _schedule_fts_updater():
+    """Schedule the FTS updater to run when the next job is due.
+
+    If the FTS updater is currently running then it will reschedule itself
+    once it has finished.
+    """
+    global _fts_jobs
+    global _fts_resync_due
+    global _fts_updater_call
+    global _fts_updater_running
+
+    if _fts_updater_running:
+        return
+
+    due = min([job['due'] for job in _fts_jobs.values()] + [_fts_resync_due])
+    delay = max(due - time(), 0)
+    if _fts_updater_call is not None and _fts_updater_call.active():
+        if _fts_updater_call.getTime() <= reactor.seconds() + delay:
+            return
+        _fts_updater_call.cancel()
+    _fts_updater_call = reactor.callLater(delay, _run_fts_updater)
+
+
+@inlineCallbacks
+def _fts_state_listener():
+    """Listen for FTS job state change messages.
+
+    Jobs for which messages are received are polled immediately, allowing
+    their completion to be handled without waiting for their next scheduled
+    poll.  Messages are expected to be JSON documents containing a job_id
+    field, as published by the FTS messaging system.
+    """
+    global _log
+    global _fts_jobs
+    global _fts_state_queue
+    global _pika_conn
+
+    channel = yield _pika_conn.channel()
+    yield channel.queue_declare(queue=_fts_state_queue, exclusive=False,
+                                durable=True)
+    queue, _ = yield channel.basic_consume(queue=_fts_state_queue,
+                                           no_ack=True)
+
+    while True:
+        ch, method, properties, body = yield queue.get()
+        try:
+            # FTS terminates its messages with an EOT character
+            fts_id = json.loads(body.rstrip('\x04'))['job_id']
+        except Exception, e:
+            _log.error('Invalid FTS state message received: %s' % str(e))
+            continue
+        # Jobs being retried are polled again once they have been retried
+        job = _fts_jobs.get(fts_id)
+        if job is not None and not job['retrying']:
+            job['due'] = time()
+            _schedule_fts_updater()
+
+
+@inlineCallbacks
+def _start_fts_transfer(transfer_id, transfer, pair):
+    """Submit transfer request for transfer to FTS server and update DB.
+
+    Parameters:
+    transfer_id -- ID of the transfer to start
+    transfer -- Dictionary containing the stager_path, stager_hostname and
+      destination_path of the transfer
+    pair -- Tuple of the source and destination hosts of the transfer, for
+      which a slot has been acquired from the pair scheduler
+
+    Return value (via deferred):
+    The FTS ID of the job, or None if the transfer couldn't be submitted.
+    """
+    global _log
+    global _dbpool
+    global _fts_client
 
     # Create the transfer request
-    localpath = str(r[0][0])
-    src = 'gsiftp://%s%s' % (r[0][1], str(r[0][0]).rstrip(os.sep))
-    dst = '%s/%s' % (str(r[0][2]).rstrip('/'), basename(r[0][0]))
+    localpath = str(transfer['stager_path'])
+    src = 'gsiftp://%s%s' % (transfer['stager_hostname'],
+                             localpath.rstrip(os.sep))
+    dst = '%s/%s' % (str(transfer['destination_path']).rstrip('/'),
+                     basename(localpath))
     _log.info("About to transfer '%s' to '%s' for transfer %s" %
               (src, dst, transfer_id))
 
     # Retrieve a list of file to add from the transfer agent running on the
     # transfer server
-    transfer_host = 'https://%s:8444/files' % r[0][1]
+    transfer_host = 'https://%s:8444/files' % transfer['stager_hostname']
     try:
-        r = yield threads.deferToThread(requests.post, transfer_host,
-                                        data={'dir': localpath},
-                                        cert=(_prepare_creds))
-        body = json.loads(r.text)
-        if r.status_code != 200:
-            raise Exception(body['msg'])
-
-        files = body['files']
+        files = yield _list_files(transfer_host, localpath)
     except Exception, e:
         _log.error('Error retrieving file list for transfer %s from %s'
                     % (transfer_id, transfer_host))
         _log.error(str(e))
-        _dbpool.runQuery("UPDATE transfers SET status='ERROR', extra_status = "
-                         "%s WHERE transfer_id = %s", [str(e), transfer_id])
+        yield transition(transfer_id, 'TRANSFERRING', 'ERROR',
+                         {'extra_status': str(e)})
+        _admission.notify()
+        returnValue(None)
 
-    # Setup the list of transfers and submit to FTS
+    # Setup the list of transfers and submit to FTS, which verifies the
+    # checksums of the files if these are known
     try:
         transfers = []
-        for file in files:
+        for file, size, checksum in files:
             transfers.append(fts3.new_transfer(src + '/' + file,
-                                               dst + '/' + file))
-
-        fts_job = fts3.new_job(transfers)
-        fts_id = fts3.submit(fts_context, fts_job)
-        fts_job_status = fts3.get_job_status(fts_context, fts_id,
-                                             list_files=True)
+                                               dst + '/' + file,
+                                               checksum=checksum,
+                                               filesize=size))
+
+        verify = any(checksum for _, _, checksum in files)
+        fts_id = yield _fts_client.submit(transfers, verify_checksum=verify)
+        fts_job_status = yield _fts_client.get_job_status(fts_id,
+                                                          list_files=True)
     except Exception, e:
         _log.error('Error submitting transfer %s to FTS' % transfer_id)
         _log.error(str(e))
         ds = "Error submitting transfer to FTS"
-        _dbpool.runQuery("UPDATE transfers SET status='ERROR', extra_status = "
-                         "%s WHERE transfer_id = %s", [ds, transfer_id])
+        yield transition(transfer_id, 'TRANSFERRING', 'ERROR',
+                         {'extra_status': ds})
+        _admission.notify()
         returnValue(None)
 
-    # Update transfer status, add FTS ID & FTS status
+    # Add FTS ID & FTS status (the status is already TRANSFERRING), and
+    # record the files of the transfer
+    summary = _summarize_fts_job(fts_job_status)
+    fields = {'fts_id': fts_id, 'fts_details': summary}
+    fts_files = dict((f.get('source_surl'), f)
+                     for f in fts_job_status.get('files') or [])
+    rows = []
+    for index, (file, size, _) in enumerate(files):
+        f = fts_files.get(src + '/' + file, {})
+        if size is None:
+            size = f.get('filesize') or 0
+        rows.append([transfer_id, index, file, size,
+                     f.get('file_state') or 'SUBMITTED', f.get('file_id')])
+
+    def _record_submission(txn):
+        """Record the FTS job and the files of the transfer in the DB."""
+        updated = transition_txn(txn, transfer_id, 'TRANSFERRING', None,
+                                 fields)
+        if updated is not None and rows:
+            txn.executemany("INSERT INTO transfer_files (transfer_id, "
+                            "file_index, path, size, state, fts_file_id) "
+                            "VALUES (%s, %s, %s, %s, %s, %s)", rows)
+        return updated
+
     try:
-        yield _dbpool.runQuery("UPDATE transfers SET status='TRANSFERRING', "
-                               "fts_id = %s, "
-                               "fts_details = %s WHERE transfer_id = %s",
-                               [fts_id, str(fts_job_status), transfer_id])
+        updated = yield _dbpool.runInteraction(_record_submission)
     except Exception, e:
         _log.error('Error updating status for transfer %s' % transfer_id)
         _log.error(str(e))
         ds = "Error updating transfer status following FTS submission"
-        _dbpool.runQuery("UPDATE transfers SET status='ERROR', extra_status "
-                         "= %s WHERE transfer_id = %s", [ds, transfer_id])
-
+        transition(transfer_id, 'TRANSFERRING', 'ERROR', {'extra_status': ds})
+        _admission.notify()
+        returnValue(None)
+    if updated is None:
+        _log.error('Transfer %s left the TRANSFERRING state while being '
+                   'submitted to FTS as job %s' % (transfer_id, fts_id))
         returnValue(None)
+    transitioned(transfer_id, None, fields)
     _log.info('Transfer database updated; added FTS ID %s for transfer %s'
               % (fts_id, transfer_id))
 
+    # Start polling FTS for the status of the job
+    _track_fts_job(fts_id, transfer_id, pair=pair, scheduled=True)
+    _fts_jobs[fts_id]['details'] = summary
+    _fts_jobs[fts_id]['files'] = _file_changes(_fts_jobs[fts_id],
+                                               fts_job_status)
+    _observe_fts_job(_fts_jobs[fts_id], fts_job_status)
+    _schedule_fts_updater()
+    returnValue(fts_id)
+
 
 @inlineCallbacks
-def _transfer_queue_listener():
-    """Wait for requests to come in via transfer queue.
+def _handle_transfer_request(transfer_id):
+    """Handle a request from the transfer queue.
 
-    Note that only a bounded number of transfers are permitted
+    Requests first wait for a slot for the pair of hosts between which the
+    data is transferred, which the pair scheduler shares fairly between
+    pairs.  Note that only a bounded number of transfers are permitted
     to be in the transferring state at any point in time and this is enforced
-    using a semaphore.
+    using an admission controller.  Admission changes the status of the
+    transfer to TRANSFERRING (its FTS ID is only set once it has been
+    submitted to FTS), and requests for transfers which weren't waiting to
+    be transferred are ignored.
     """
-    global _log
-    global _transfer_queue
-    global _pika_conn
-    global _sem_fts
-
-    channel = yield _pika_conn.channel()
-
-    queue = yield channel.queue_declare(queue=_transfer_queue,
-                                        exclusive=False,
-                                        durable=True)
-    yield channel.basic_qos(prefetch_count=1)
-
-    # Enter loop
-    queue, consumer_tag = yield channel.basic_consume(queue=_transfer_queue,
-                                                      no_ack=False)
-
-    while True:
-        ch, method, properties, body = yield queue.get()
-        if body:
-            yield _sem_fts.acquire()
-            reactor.callFromThread(_start_fts_transfer, body)
-            yield ch.basic_ack(delivery_tag=method.delivery_tag)
-
+    global _admission
+    global _cache
+    global _scheduler
+
+    hosts = yield _cache.get(transfer_id, ['stager_hostname',
+                                           'destination_host'])
+    if hosts is None:
+        _log.info('Ignoring request to transfer %s as it does not exist'
+                  % transfer_id)
+        returnValue(None)
+    pair = (hosts['stager_hostname'], hosts['destination_host'])
 
-def init_fts_manager(pika_conn, dbpool, fts_params, transfer_queue,
-                     concurrent_max, polling_interval, prepare_creds):
+    yield _scheduler.acquire(pair)
+    fts_id = None
+    try:
+        transfer = yield _admission.admit(transfer_id)
+        if transfer is not None:
+            fts_id = yield _start_fts_transfer(transfer_id, transfer, pair)
+        else:
+            _log.info('Ignoring request to transfer %s as it is not waiting '
+                      'to be transferred' % transfer_id)
+    finally:
+        if fts_id is None:
+            _scheduler.release(pair)
+
+
+def init_fts_manager(pika_conn, publisher, dbpool, cache, fts_params,
+                     transfer_queue, concurrent_max, polling_interval,
+                     http_client,
+                     status_batch_size=50, fts_threads=4,
+                     polling_interval_max=300, state_queue=None,
+                     prefetch=None, workers=None, max_per_host=None,
+                     pair_min=1, pair_max=None, retry_max=3, retry_delay=60):
     """Initialize services to manage transfers using FTS.
 
     This involves:
     * Initializing a thread to listen for requests to start
       transfers on the transfer queue
-    * Scheduling a routine to run at a regular interval, querying the
-      FTS server to update the status of transfers in the TRANSFERRING state.
-
-    Note that this function also initializes a semaphore used to enforce a
-    limit on the maximum number of transfer tasks which are permitted to take
-    place in parallel.
+    * Scheduling a routine to query the FTS server to update the status of
+      transfers in the TRANSFERRING state.  Each job is polled at its own
+      interval, which lies between polling_interval and polling_interval_max
+      depending on the progress observed and the expected time of completion
+      of the job.
+    * Optionally initializing a listener for FTS job state change messages,
+      which trigger the affected job to be polled immediately.
+
+    Note that this function also initializes an admission controller used
+    to enforce a limit on the maximum number of transfer tasks which are
+    permitted to take place in parallel across all instances of the service,
+    and a scheduler which shares these between pairs of source and
+    destination hosts, adapting the limit of each pair to its throughput.
 
     Parameters:
     pika_conn -- Global shared connection for RabbitMQ
+    publisher -- Global shared publisher for RabbitMQ
     dbpool -- Global shared database connection pool
+    cache -- Global shared cache of transfer details
     fts_params -- A list of parameters to initialize the FTS service
         [URI of FTS server, path to certificate, path to key]
     transfer_queue -- Name of the RabbitMQ queue to which to listen for
       transfer requests
     concurrent_max -- Maximum number of transfers that are permitted to be
       in the TRANSFERRING stage at any point in time
-    polling_interval -- Interval in seconds between polling attempts of
-      the FTS server to update the status of transfers currently in the
+    polling_interval -- Minimum interval in seconds between polling attempts
+      of the FTS server to update the status of a transfer currently in the
       TRANSFERRING state
-    prepare_creds -- A tuple containing filenames of a certificate and key
-      used to authenticate with the transfer agent
+    http_client -- Globally shared HTTPClient, which authenticates to the
+      transfer agent using the prepare certificate
+    status_batch_size -- Maximum number of FTS jobs whose status is
+      retrieved in a single request to the FTS server
+    fts_threads -- Size of the thread pool used to make (blocking) calls to
+      the FTS server, which bounds the number of concurrent FTS requests
+    polling_interval_max -- Maximum interval in seconds between polling
+      attempts for a transfer.  This is also the interval at which the
+      list of transfers in the TRANSFERRING state is read from the DB.
+    state_queue -- Name of a RabbitMQ queue on which FTS job state change
+      messages are received, or None if these are not available
+    prefetch -- Maximum number of unacknowledged messages delivered from the
+      transfer queue (defaults to the number of workers)
+    workers -- Number of transfer requests handled concurrently (defaults to
+      four times concurrent_max, so that requests for several pairs of hosts
+      are available to the scheduler)
+    max_per_host -- Maximum number of transfers to any one destination host
+      permitted to be in the TRANSFERRING state (None for no limit)
+    pair_min -- Minimum number of concurrent transfers for each pair of
+      source and destination hosts
+    pair_max -- Maximum (and initial) number of concurrent transfers for
+      each pair of source and destination hosts (defaults to
+      concurrent_max)
+    retry_max -- Maximum number of times the failed files of a transfer are
+      resubmitted to FTS before the transfer fails
+    retry_delay -- Delay in seconds before the first resubmission of failed
+      files, which doubles for each subsequent resubmission
     """
     global _log
+    global _admission
+    global _cache
     global _dbpool
-    global _fts_params
+    global _fts_client
+    global _fts_jobs
+    global _fts_resync_due
+    global _fts_state_queue
+    global _fts_throughput
+    global _fts_updater_call
+    global _fts_updater_running
     global _pika_conn
-    global _prepare_creds
+    global _poll_max
+    global _poll_min
+    global _http_client
+    global _publisher
+    global _retry_delay
+    global _retry_max
+    global _scheduler
+    global _status_batch_size
     global _transfer_queue
-    global _sem_fts
 
     _log = Logger()
 
     _pika_conn = pika_conn
+    _publisher = publisher
     _dbpool = dbpool
-    _fts_params = fts_params
-    _prepare_creds = prepare_creds
+    _cache = cache
+    _fts_client = FTSClient(fts_params, fts_threads)
+    _fts_jobs = {}
+    _fts_resync_due = 0
+    _fts_state_queue = state_queue
+    _fts_throughput = None
+    _fts_updater_call = None
+    _fts_updater_running = False
+    _poll_max = float(polling_interval_max)
+    _poll_min = float(polling_interval)
+    _http_client = http_client
+    _retry_delay = float(retry_delay)
+    _retry_max = int(retry_max)
+    _status_batch_size = int(status_batch_size)
     _transfer_queue = transfer_queue
-    _sem_fts = DeferredSemaphore(int(concurrent_max))
+    _admission = AdmissionController(dbpool, 'PREPARINGDONE', 'TRANSFERRING',
+                                     concurrent_max, max_per_host,
+                                     returning=['stager_path',
+                                                'stager_hostname',
+                                                'destination_path'])
+    _scheduler = PairScheduler(pair_min, pair_max or concurrent_max)
 
     # Start queue listener
-    reactor.callFromThread(_transfer_queue_listener)
-
-    # Run a task at a regular interval to update the status of
-    # submitted transfers
-    fts_updater_runner = LoopingCall(_FTSUpdater)
-    fts_updater_runner.start(int(polling_interval))
+    workers = workers or 4 * int(concurrent_max)
+    consumer = QueueConsumer(pika_conn, transfer_queue,
+                             _handle_transfer_request, prefetch or workers,
+                             workers)
+    reactor.callFromThread(consumer.start)
+
+    # Start polling FTS for the status of submitted transfers
+    reactor.callFromThread(_schedule_fts_updater)
+
+    # Start listening for FTS job state change messages
+    if state_queue is not None:
+        reactor.callFromThread(_fts_state_listener)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Make HTTPS requests to the stager and transfer agents."""
+# Copyright 2017  University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function  # for python 2
+
+from collections import namedtuple
+from email.utils import mktime_tz, parsedate_tz
+from StringIO import StringIO
+from time import time
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredSemaphore, \
+                                   inlineCallbacks, returnValue
+from twisted.internet.task import deferLater
+from twisted.internet.protocol import Protocol
+from twisted.internet.ssl import Certificate, PrivateCertificate, \
+                                 optionsForClientTLS
+from twisted.web.client import Agent, FileBodyProducer, \
+                               HTTPConnectionPool, PartialDownloadError, \
+                               ResponseDone, readBody
+from twisted.web.http_headers import Headers
+from twisted.logger import Logger
+from twisted.web.iweb import IPolicyForHTTPS
+from urllib import urlencode
+from urlparse import urlparse
+from zope.interface import implementer
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+HTTPResponse = namedtuple('HTTPResponse', ['status_code', 'text'])
+"""Status code and body of a response to a request."""
+
+_BUSY_CODES = (429, 503)
+"""Status codes of responses from busy servers, which may be retried."""
+
+_DEFAULT_RETRY_AFTER = 5
+"""Seconds to wait before retrying if a busy server doesn't say."""
+
+
+def _retry_after(response):
+    """Return the seconds to wait given by the Retry-After of a response."""
+    values = response.headers.getRawHeaders('Retry-After') or []
+    if not values:
+        return _DEFAULT_RETRY_AFTER
+    try:
+        return max(0, int(values[0]))
+    except ValueError:
+        date = parsedate_tz(values[0])
+        if date is None:
+            return _DEFAULT_RETRY_AFTER
+        return max(0, mktime_tz(date) - time())
+
+
+class _Busy (object):
+    """Result of a request rejected by a busy server."""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+
+@implementer(IPolicyForHTTPS)
+class _ClientCertificatePolicy (object):
+    """Verify servers and authenticate using an X.509 client certificate.
+
+    The certificate and key are loaded once, and the same TLS options are
+    used for all connections to a host.
+    """
+
+    def __init__(self, creds):
+        """Load the client certificate.
+
+        Arguments:
+        creds -- A tuple containing the filenames of a certificate (which may
+          be followed by its chain) and key, or None
+        """
+        self._client_cert = None
+        self._extra_options = {}
+        self._options = {}
+        if creds is None:
+            return
+
+        with open(creds[0]) as f:
+            pem = f.read()
+        with open(creds[1]) as f:
+            key = f.read()
+        marker = '-----BEGIN CERTIFICATE-----'
+        certs = [marker + c for c in pem.split(marker)[1:]]
+        self._client_cert = PrivateCertificate.loadPEM(certs[0] + key)
+        if len(certs) > 1:
+            self._extra_options['extraCertChain'] = [
+                Certificate.loadPEM(c).original for c in certs[1:]]
+
+    def creatorForNetloc(self, hostname, port):
+        """Return the TLS options used to connect to a host."""
+        if (hostname, port) not in self._options:
+            self._options[(hostname, port)] = optionsForClientTLS(
+                hostname.decode('ascii'),
+                clientCertificate=self._client_cert,
+                extraCertificateOptions=self._extra_options)
+        return self._options[(hostname, port)]
+
+
+class _LineProtocol (Protocol):
+    """Pass each line of the body of a response to a function.
+
+    The finished deferred fires once the whole body has been processed, and
+    cancelling it aborts the response.  The progress function is called
+    whenever data is received.
+    """
+
+    def __init__(self, callback, progress):
+        self._callback = callback
+        self._progress = progress
+        self.finished = Deferred(self._cancel)
+        self._buffer = ''
+
+    def _cancel(self, _):
+        """Stop receiving the body of the response."""
+        if self.transport is not None:
+            self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        """Split the data received into lines."""
+        if self.finished.called:
+            return
+        self._progress()
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        try:
+            for line in lines:
+                self._callback(line)
+        except Exception, e:
+            self.finished.errback(e)
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        """Process the final line once the body has been received."""
+        if self.finished.called:
+            return
+        if not reason.check(ResponseDone):
+            self.finished.errback(reason)
+            return
+        try:
+            if self._buffer:
+                self._callback(self._buffer)
+        except Exception, e:
+            self.finished.errback(e)
+        else:
+            self.finished.callback(None)
+
+
+class HTTPClient (object):
+    """Make HTTPS requests using persistent connections.
+
+    Connections to each host are kept open and reused for later requests,
+    so that a TLS handshake (including client certificate authentication)
+    is only needed when a new connection is made, rather than for every
+    request.  The number of requests in progress to any one host is
+    limited, and requests which make no progress for too long are
+    cancelled.  Requests
+    rejected by busy servers (with the status code 429 or 503) are retried
+    after the delay given by the Retry-After header of the response.
+
+    A client is created for each set of credentials used by the service,
+    and shared by all the parts of the service which use those credentials.
+    """
+
+    def __init__(self, creds=None, max_per_host=8, timeout=60,
+                 connect_timeout=30, idle_timeout=240, max_retry_wait=300):
+        """Initialize the client.
+
+        Arguments:
+        creds -- A tuple containing the filenames of a certificate and key
+          used to authenticate, or None
+        max_per_host -- Maximum number of requests in progress (and of open
+          connections) to any one host
+        timeout -- Time in seconds after which a request is cancelled if no
+          response has been received (or, for responses processed one line
+          at a time, if no further data has been received)
+        connect_timeout -- Time in seconds after which an attempt to connect
+          is abandoned
+        idle_timeout -- Time in seconds after which idle connections are
+          closed
+        max_retry_wait -- Maximum total time in seconds for which a request
+          is delayed by busy servers before their response is returned
+        """
+        self._log = Logger()
+        self._max_per_host = int(max_per_host)
+        self._max_retry_wait = float(max_retry_wait)
+        self._timeout = float(timeout)
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = self._max_per_host
+        self._pool.cachedConnectionTimeout = float(idle_timeout)
+        self._agent = Agent(reactor, _ClientCertificatePolicy(creds),
+                            connectTimeout=float(connect_timeout),
+                            pool=self._pool)
+        self._limits = {}
+
+    def _limit(self, url):
+        """Return the semaphore limiting the requests to a host."""
+        netloc = urlparse(url).netloc
+        if netloc not in self._limits:
+            self._limits[netloc] = DeferredSemaphore(self._max_per_host)
+        return self._limits[netloc]
+
+    def _attempt(self, url, data, headers, handle_response, retry):
+        """Make a POST request, cancelling it if it stops making progress.
+
+        The response is passed to handle_response along with a function
+        which postpones the timeout, which may be called as the body of the
+        response is received.  If retry is set and the server is busy, the
+        body of the response is discarded and a _Busy is returned instead.
+        """
+        headers = Headers(dict((k, [v]) for k, v in (headers or {}).items()))
+        headers.setRawHeaders('Content-Type',
+                              ['application/x-www-form-urlencoded'])
+        body = FileBodyProducer(StringIO(urlencode(data or {})))
+
+        def _handle(response):
+            if not retry or response.code not in _BUSY_CODES:
+                return handle_response(response, _progress)
+            d = readBody(response)
+            d.addErrback(lambda f: f.trap(PartialDownloadError))
+            d.addCallback(lambda _: _Busy(_retry_after(response)))
+            return d
+
+        d = self._agent.request('POST', url, headers, body)
+        d.addCallback(_handle)
+        timer = reactor.callLater(self._timeout, d.cancel)
+
+        def _progress():
+            if timer.active():
+                timer.reset(self._timeout)
+
+        def _done(result):
+            if timer.active():
+                timer.cancel()
+            return result
+        d.addBoth(_done)
+        return d
+
+    @inlineCallbacks
+    def _request(self, url, data, headers, handle_response):
+        """Make a POST request, retrying while the server is busy."""
+        waited = 0
+        while True:
+            result = yield self._attempt(url, data, headers, handle_response,
+                                         waited < self._max_retry_wait)
+            if not isinstance(result, _Busy):
+                returnValue(result)
+            delay = max(1, min(result.delay, self._max_retry_wait - waited))
+            self._log.info('%s is busy; retrying in %.0f seconds'
+                           % (url, delay))
+            yield deferLater(reactor, delay, lambda: None)
+            waited += delay
+
+    def post(self, url, data=None, headers=None):
+        """Make a POST request.
+
+        Arguments:
+        url -- URL to which to make the request
+        data -- Dictionary of form parameters to send
+        headers -- Dictionary of additional headers to send
+
+        Return value (via deferred):
+        An HTTPResponse containing the status code and body of the response.
+        """
+        def _read(response, progress):
+            def _partial(failure):
+                # Bodies without a length are reported as partial downloads
+                failure.trap(PartialDownloadError)
+                return failure.value.response
+
+            d = readBody(response)
+            d.addErrback(_partial)
+            d.addCallback(lambda body: HTTPResponse(response.code, body))
+            return d
+
+        return self._limit(url).run(self._request, url, data, headers,
+                                    _read)
+
+    def post_lines(self, url, callback, data=None, headers=None):
+        """Make a POST request, processing the response one line at a time.
+
+        This allows large responses (e.g. newline-delimited JSON) to be
+        processed as they are received.  The timeout of the client applies
+        to the time between receiving parts of the response rather than to
+        the whole request, so long responses aren't cut short.  If the
+        callback raises an exception the request is aborted.
+
+        Arguments:
+        url -- URL to which to make the request
+        callback -- Function called with each line of the body
+        data -- Dictionary of form parameters to send
+        headers -- Dictionary of additional headers to send
+
+        Return value (via deferred):
+        The status code of the response, once the body has been processed.
+        """
+        def _deliver(response, progress):
+            protocol = _LineProtocol(callback, progress)
+            response.deliverBody(protocol)
+            protocol.finished.addCallback(lambda _: response.code)
+            return protocol.finished
+
+        return self._limit(url).run(self._request, url, data, headers,
+                                    _deliver)
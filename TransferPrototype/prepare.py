@@ -17,194 +17,195 @@
 
 from __future__ import print_function  # for python 2
 
-import pika
-import json
-import requests
-
-from twisted.internet import reactor, threads
-from twisted.internet.defer import DeferredSemaphore, inlineCallbacks, \
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList, inlineCallbacks, \
                                    returnValue
 from twisted.logger import Logger
 
+from admission import AdmissionController
+from consumer import QueueConsumer
+from statemachine import transition, transition_txn, transitioned
+
 __author__ = "David Aikema, <david.aikema@uct.ac.za>"
 
 
+def _record_completions(txn, transfer_ids):
+    """Mark transfers whose preprocessing completed as done (in a txn).
+
+    Return value:
+    A list of booleans indicating whether each transfer was updated (i.e.
+    whether it was being prepared).
+    """
+    return [transition_txn(txn, transfer_id, 'PREPARING',
+                           'PREPARINGDONE') is not None
+            for transfer_id in transfer_ids]
+
+
 @inlineCallbacks
-def finish_prepare(transfer_id, success, msg):
-    """Update state to reflect that preprocessing complete.
+def finish_prepare_many(completions):
+    """Update state to reflect that preprocessing of transfers completed.
 
-    This function updates the status of the database to reflect
-    that the transfer has completed, release the semaphore used,
-    add the transfer ID to the transfer queue.
+    The status of all of the transfers is updated in a single transaction
+    (freeing space for other transfers to be prepared), and the transfers
+    are then published to the transfer queue together.
 
     Params:
-    transfer_id
-    success -- A boolean indicating whether or not they were successful
-    msg -- Supplemental info reported by the prepare server
+    completions -- List of dictionaries containing the parameters of
+      finish_prepare for each completion
 
-    Return Value:
-    Boolean value indicating whether or not there were errors processing
-    the request
+    Return Value (via deferred):
+    A list containing a dictionary for each completion with the
+    transfer_id, whether it was successfully processed ('success') and a
+    message.
     """
     global _log
+    global _admission
     global _dbpool
-    global _pika_conn
-    global _sem_prepare
+    global _publisher
     global _transfer_queue
 
-    # Get initial status of request
-    err = None
-    r = yield _dbpool.runQuery("SELECT status from transfers WHERE "
-                               "transfer_id = %s", [transfer_id])
-
-    # If status not 'PREPARING' then there was a problem so return False
-    if r[0][0] != 'PREPARING':
-        returnValue(False)
-
-    # Release semaphore
-    yield _sem_prepare.release()
-
-    # Update status
+    transfer_ids = [c['transfer_id'] for c in completions]
     try:
-        r = yield _dbpool.runQuery("UPDATE transfers SET status = "
-                                   "'PREPARINGDONE' WHERE transfer_id = "
-                                   "%s", [transfer_id])
+        updated = yield _dbpool.runInteraction(_record_completions,
+                                               transfer_ids)
     except Exception, e:
         yield _log.error('Error updating DB to report prepare finished '
-                         'for transfer %s' % transfer_id)
+                         'for transfers %s' % ', '.join(transfer_ids))
         yield _log.error(str(e))
-        err = e
+        returnValue([{'transfer_id': transfer_id, 'success': False,
+                      'msg': 'Error updating database'}
+                     for transfer_id in transfer_ids])
+
+    results = []
+    prepared = []
+    for transfer_id, was_updated in zip(transfer_ids, updated):
+        if was_updated:
+            transitioned(transfer_id, 'PREPARINGDONE')
+            prepared.append(len(results))
+            results.append({'transfer_id': transfer_id, 'success': True,
+                            'msg': 'Prepare completion recorded'})
+        else:
+            results.append({'transfer_id': transfer_id, 'success': False,
+                            'msg': 'Transfer is not being prepared'})
+
+    # Let other transfers into preprocessing
+    if prepared:
+        _admission.notify()
+
+    # Add to transfer queue, publishing all messages before waiting for
+    # them to be confirmed
+    published = yield DeferredList(
+        [_publisher.publish(_transfer_queue, results[i]['transfer_id'])
+         for i in prepared], consumeErrors=True)
+    for i, (ok, value) in zip(prepared, published):
+        if not ok:
+            yield _log.error('Error adding transfer %s to rabbitmq transfer '
+                             'queue' % results[i]['transfer_id'])
+            yield _log.error(str(value.value))
+            results[i].update({'success': False,
+                               'msg': 'Error adding transfer to transfer '
+                                      'queue'})
+    returnValue(results)
 
-    # Add to transfer queue
-    try:
-        send_properties = pika.BasicProperties(content_type='text/plain',
-                                               delivery_mode=1)
-        channel = yield _pika_conn.channel()
-        yield channel.queue_declare(queue=_transfer_queue, exclusive=False,
-                                    durable=True)
-        yield channel.basic_publish('', _transfer_queue, transfer_id,
-                                    send_properties)
-    except Exception, e:
-        yield _log.error('Error adding transfer %s to rabbitmq transfer '
-                         'queue' % transfer_id)
-        yield _log.error(str(e))
-        err = err
-    finally:
-        yield channel.close()
 
-    # Report whether or not an error was encountered
-    returnValue(err is None)
+@inlineCallbacks
+def finish_prepare(transfer_id, success, msg):
+    """Update state to reflect that preprocessing complete.
+
+    This function updates the status of the database to reflect
+    that the transfer has completed (freeing space for another transfer
+    to be prepared) and adds the transfer ID to the transfer queue.  It is
+    equivalent to calling finish_prepare_many with a single completion.
+
+    Params:
+    transfer_id
+    success -- A boolean indicating whether or not they were successful
+    msg -- Supplemental info reported by the prepare server
+
+    Return Value:
+    Boolean value indicating whether or not there were errors processing
+    the request
+    """
+    results = yield finish_prepare_many([{'transfer_id': transfer_id,
+                                          'success': success, 'msg': msg}])
+    returnValue(results[0]['success'])
 
 
 @inlineCallbacks
-def _do_prepare(transfer_id):
+def _do_prepare(transfer_id, prepare_activity, staged_path, staged_hostname):
     """Perform preprocessing for the specified transfer ID.
 
     Params:
     transfer_id -- Identifier of the transfer to prepare
+    prepare_activity -- Preprocessing requested, or None for none
+    staged_path -- Path to which the product was staged
+    staged_hostname -- Host to which the product was staged
     """
     global _log
     global _callback
-    global _creds
-    global _dbpool
+    global _http_client
 
     _log.info('Launching prepare for transfer %s' % transfer_id)
 
-    # Update the status of the job to note that prepare has started
-    try:
-        r = yield _dbpool.runQuery("UPDATE transfers SET status = "
-                                   "'PREPARING' WHERE transfer_id = "
-                                   "%s", [transfer_id])
-    except Exception, e:
-        yield _log.error('Error updating DB to report prepare started '
-                         'for transfer %s' % transfer_id)
-        yield _log.error(str(e))
-        returnValue(False)
-
-    # Retrieve information needed for prepare step to be run
-    try:
-        r = yield _dbpool.runQuery("SELECT prepare_activity, stager_path, "
-                                   "stager_hostname FROM transfers WHERE "
-                                   "transfer_id = %s", [transfer_id])
-        prepare_activity = r[0][0]
-        staged_path = r[0][1]
-        staged_hostname = r[0][2]
-    except Exception, e:
-        yield _log.error('Error retrieving information from DB needed to '
-                         'run prepare step for transfer %s' % transfer_id)
-        yield _log.error(str(e))
-        returnValue(False)
-
     # Submit request for preprocessing if such was requested
     if prepare_activity is not None:
         prepare_uri = 'https://%s:8444/prepare' % staged_hostname
         try:
             params = {'transfer_id': transfer_id, 'dir': staged_path,
                       'prepare': prepare_activity, 'callback': _callback}
-            r = yield threads.deferToThread(requests.post, prepare_uri,
-                                            data=params, cert=_creds)
+            r = yield _http_client.post(prepare_uri, params)
             if int(r.status_code) >= 400:
                 raise Exception('The prepare service reported an error '
-                                '- status was %s' % r.code)
-                yield _dbpool.runQuery("UPDATE transfers SET status = "
-                                       "'ERROR', extra_status = 'Error "
-                                       "preprocessing' WHERE transfer_id "
-                                       "= %s", [transfer_id])
+                                '- status was %s' % r.status_code)
         except Exception, e:
             _log.error('Error contacting prepare service to submit request '
                        'for transfer ID %s' % transfer_id)
             _log.error(str(e))
-            yield _dbpool.runQuery("UPDATE transfers SET status = 'ERROR', "
-                                   "extra_status = 'Error preprocessing' "
-                                   "WHERE transfer_id = %s", [transfer_id])
+            yield transition(transfer_id, 'PREPARING', 'ERROR',
+                             {'extra_status': 'Error preprocessing'})
+            _admission.notify()
 
     # If no prepare step then immediately call finish_prepare
     else:
         msg = "No preprocessing requested for transfer ID %s" % transfer_id
         _log.debug(msg)
-        finish_prepare(transfer_id, True, msg)
+        yield finish_prepare(transfer_id, True, msg)
 
 
 @inlineCallbacks
-def _prepare_queue_listener():
-    """Listen to the prepare queue and direct requests.
-
-    Actual processing of these requests in done in a separate function
-    called from here.  Note that a semaphore is used to ensure that only
-    a fixed number of preprocessing tasks can be in process at any one time.
+def _handle_prepare_request(transfer_id):
+    """Handle a request from the prepare queue.
+
+    Note that an admission controller is used to ensure that only a fixed
+    number of preprocessing tasks can be in process at any one time.
+    Admission changes the status of the transfer to PREPARING and returns
+    the details needed to prepare it, and requests for transfers which
+    weren't waiting to be prepared are ignored.
     """
-    global _log
-    global _pika_conn
-    global _prepare_queue
-    global _sem_prepare
+    global _admission
 
-    channel = yield _pika_conn.channel()
-    queue = yield channel.queue_declare(queue=_prepare_queue,
-                                        exclusive=False,
-                                        durable=True)
-    yield channel.basic_qos(prefetch_count=1)
-
-    queue, _ = yield channel.basic_consume(queue=_prepare_queue,
-                                           no_ack=False)
-
-    while True:
-        ch, method, properties, body = yield queue.get()
-        if body:
-            yield _sem_prepare.acquire()
-            reactor.callFromThread(_do_prepare, body)
-            yield ch.basic_ack(delivery_tag=method.delivery_tag)
+    transfer = yield _admission.admit(transfer_id)
+    if transfer is not None:
+        yield _do_prepare(transfer_id, transfer['prepare_activity'],
+                          transfer['stager_path'], transfer['stager_hostname'])
+    else:
+        _log.info('Ignoring request to prepare %s as it is not waiting to be '
+                  'prepared' % transfer_id)
 
 
-def init_prepare(pika_conn, dbpool, prepare_queue, transfer_queue,
-                 concurrent_max, creds, callback):
+def init_prepare(pika_conn, publisher, dbpool, prepare_queue,
+                 transfer_queue, concurrent_max, http_client, callback,
+                 prefetch=None, workers=None, max_per_host=None,
+                 timeout=None):
     """Init handling of preprocessing products before handling.
 
-    Note that this function initializes a semaphore used to enforce a
-    limit on the maximum number of preprocessing tasks permitted to take
-    place in parallel.
+    Note that this function initializes an admission controller used to
+    enforce a limit on the maximum number of preprocessing tasks permitted
+    to take place in parallel across all instances of the service.
 
     Parameters:
     pika_conn -- Global shared connection for RabbitMQ
+    publisher -- Global shared publisher for RabbitMQ
     dbpool -- Global shared database connection pool
     prepare_queue -- Name of the RabbitMQ queue to which prepare requests
       should be sent.
@@ -212,30 +213,48 @@ def init_prepare(pika_conn, dbpool, prepare_queue, transfer_queue,
       transfer requests
     concurrent_max -- Maximum number of preprocessing tasks permitted to be
       in the PREPARING state at any point in time.
-    creds -- A tuple specifying a (cert, key) with which to contact the
-      prepare service.
+    http_client -- Globally shared HTTPClient, which authenticates to the
+      prepare service using the prepare certificate
     callback -- URL to report results of the prepare operation to
+    prefetch -- Maximum number of unacknowledged messages delivered from the
+      prepare queue (defaults to the number of workers)
+    workers -- Number of prepare requests handled concurrently (defaults to
+      concurrent_max)
+    max_per_host -- Maximum number of transfers to any one destination host
+      permitted to be in the PREPARING state (None for no limit)
+    timeout -- Time in seconds after which transfers in the PREPARING state
+      are returned to the prepare queue (None to never return them)
     """
     global _log
     global _callback
-    global _creds
+    global _http_client
     global _dbpool
     global _pika_conn
     global _prepare_queue
+    global _publisher
     global _transfer_queue
     global _concurrent_max
-    global _sem_prepare
+    global _admission
 
     _log = Logger()
 
     _callback = callback
-    _creds = creds
+    _http_client = http_client
     _dbpool = dbpool
     _pika_conn = pika_conn
     _prepare_queue = prepare_queue
+    _publisher = publisher
     _transfer_queue = transfer_queue
     _concurrent_max = concurrent_max
-    _sem_prepare = DeferredSemaphore(int(concurrent_max))
+    _admission = AdmissionController(
+        dbpool, 'STAGINGDONE', 'PREPARING', concurrent_max, max_per_host,
+        returning=['prepare_activity', 'stager_path', 'stager_hostname'],
+        timeout=timeout,
+        requeue=lambda ids: publisher.publish_many(prepare_queue, ids))
 
     # Start queue listener
-    reactor.callFromThread(_prepare_queue_listener)
+    workers = workers or concurrent_max
+    consumer = QueueConsumer(pika_conn, prepare_queue,
+                             _handle_prepare_request, prefetch or workers,
+                             workers)
+    reactor.callFromThread(consumer.start)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Measure the rate at which messages are published to RabbitMQ.
+
+Messages are published to a scratch queue using the same Publisher as the
+transfer service, and the rate at which the broker confirms them is
+reported for each number of publishing channels.  The queue is deleted
+once the benchmark has finished.
+"""
+# Copyright 2017  University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function  # for python 2
+
+import argparse
+import sys
+
+from pika import ConnectionParameters
+from pika.adapters.twisted_connection import TwistedProtocolConnection
+from time import time
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.protocol import ClientCreator
+
+from publisher import Publisher
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+
+@inlineCallbacks
+def benchmark(hostname, queue, messages, channels):
+    """Publish messages with each number of channels and report the rates.
+
+    Arguments:
+    hostname -- Hostname of the RabbitMQ broker
+    queue -- Name of the scratch queue to publish to
+    messages -- Number of messages published with each number of channels
+    channels -- List of the numbers of channels to publish with
+    """
+    pika_cc = ClientCreator(reactor, TwistedProtocolConnection,
+                            ConnectionParameters())
+    pika_conn = yield pika_cc.connectTCP(hostname, 5672)
+    yield pika_conn.ready
+
+    try:
+        for pool_size in channels:
+            publisher = Publisher(pika_conn, [queue], pool_size)
+            yield publisher.start()
+            bodies = ['benchmark-%s' % i for i in range(messages)]
+            start = time()
+            yield publisher.publish_many(queue, bodies)
+            elapsed = time() - start
+            print('%s channels: %s messages confirmed in %.2fs (%.0f per '
+                  'second)' % (pool_size, publisher.confirmed, elapsed,
+                               publisher.confirmed / max(elapsed, 1e-6)))
+    finally:
+        channel = yield pika_conn.channel()
+        yield channel.queue_delete(queue=queue)
+        pika_conn.close()
+
+
+def main():
+    """Run the benchmark with the options given on the command line."""
+    parser = argparse.ArgumentParser(
+        description='Measure the rate at which messages are published to '
+                    'RabbitMQ')
+    parser.add_argument('--hostname', default='localhost',
+                        help='hostname of the broker (default localhost)')
+    parser.add_argument('--queue', default='publish_benchmark',
+                        help='scratch queue to publish to, which is deleted '
+                             'afterwards (default publish_benchmark)')
+    parser.add_argument('--messages', type=int, default=10000,
+                        help='messages published for each number of '
+                             'channels (default 10000)')
+    parser.add_argument('--channels', type=int, nargs='+',
+                        default=[1, 2, 4, 8],
+                        help='numbers of channels to publish with (default '
+                             '1 2 4 8)')
+    args = parser.parse_args()
+
+    result = {'ok': False}
+
+    def _finish(_):
+        result['ok'] = True
+        reactor.stop()
+
+    def _error(failure):
+        failure.printTraceback()
+        reactor.stop()
+
+    reactor.callWhenRunning(
+        lambda: benchmark(args.hostname, args.queue, args.messages,
+                          args.channels).addCallbacks(_finish, _error))
+    reactor.run()
+    sys.exit(0 if result['ok'] else 1)
+
+
+if __name__ == '__main__':
+    main()
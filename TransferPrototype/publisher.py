@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Publish messages to RabbitMQ queues."""
+# Copyright 2017  University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function  # for python 2
+
+import pika
+
+from pika import spec
+from time import time
+from twisted.internet.defer import Deferred, fail, gatherResults, \
+                                   inlineCallbacks
+from twisted.logger import Logger
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+
+class PublishException (Exception):
+    """Raised when a message could not be published to RabbitMQ."""
+
+    pass
+
+
+class Publisher (object):
+    """Publish messages to RabbitMQ using a pool of long-lived channels.
+
+    The queues used are declared once, when the publisher is started, and
+    publisher confirms are enabled on all channels.  The deferred returned
+    when publishing a message fires once the broker has confirmed that it
+    has taken responsibility for the message.  Messages are published as
+    persistent, so that they survive a restart of the broker.
+
+    A shared publisher is created at startup and used by all parts of the
+    service which add transfers to queues.
+    """
+
+    def __init__(self, pika_conn, queues, pool_size=4):
+        """Initialize the publisher.
+
+        Arguments:
+        pika_conn -- Global shared connection for RabbitMQ
+        queues -- Names of the queues to which messages will be published
+        pool_size -- Number of channels to publish messages with
+        """
+        self._log = Logger()
+        self._pika_conn = pika_conn
+        self._queues = queues
+        self._pool_size = int(pool_size)
+        self._channels = []
+        self._next = 0
+        self._properties = pika.BasicProperties(content_type='text/plain',
+                                                delivery_mode=2)
+
+        self.published = 0
+        """Number of messages published."""
+        self.confirmed = 0
+        """Number of messages confirmed by the broker."""
+        self.started = None
+        """Time at which the publisher was started."""
+
+    @inlineCallbacks
+    def start(self):
+        """Open the channels and declare the queues."""
+        for _ in range(self._pool_size):
+            yield self._open_channel()
+        for queue in self._queues:
+            yield self._channels[0]['channel'].queue_declare(
+                queue=queue, exclusive=False, durable=True)
+        self.started = time()
+
+    @inlineCallbacks
+    def _open_channel(self):
+        """Open a channel, enable confirms and add it to the pool."""
+        channel = yield self._pika_conn.channel()
+        state = {'channel': channel, 'tag': 0, 'pending': {}}
+        channel.add_on_close_callback(
+            lambda *args: self._on_channel_closed(state, *args))
+        channel.confirm_delivery(
+            lambda frame: self._on_confirm(state, frame))
+        self._channels.append(state)
+
+    def _on_confirm(self, state, frame):
+        """Fire the deferreds of messages acked/nacked by the broker."""
+        method = frame.method
+        if method.multiple:
+            tags = [t for t in state['pending'] if t <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        for tag in sorted(tags):
+            d = state['pending'].pop(tag, None)
+            if d is None:
+                continue
+            if isinstance(method, spec.Basic.Ack):
+                self.confirmed += 1
+                d.callback(None)
+            else:
+                d.errback(PublishException('Message rejected by broker'))
+
+    def _on_channel_closed(self, state, channel, reply_code, reply_text):
+        """Fail pending messages of a closed channel and replace it."""
+        self._log.error('Publishing channel closed (%s): %s'
+                        % (reply_code, reply_text))
+        if state in self._channels:
+            self._channels.remove(state)
+        pending, state['pending'] = state['pending'], {}
+        for tag in sorted(pending):
+            pending[tag].errback(PublishException('Channel closed before '
+                                                  'message was confirmed'))
+        if not self._pika_conn.is_closed:
+            d = self._open_channel()
+            d.addErrback(self._log.error)
+
+    def publish(self, queue, body):
+        """Publish a message to a queue.
+
+        Arguments:
+        queue -- Name of the queue to publish to
+        body -- Message to publish
+
+        Return value:
+        A deferred which fires once the message has been confirmed.
+        """
+        if not self._channels:
+            return fail(PublishException('No open channels to publish '
+                                         'with'))
+        self._next = (self._next + 1) % len(self._channels)
+        state = self._channels[self._next]
+        state['tag'] += 1
+        d = Deferred()
+        state['pending'][state['tag']] = d
+        state['channel'].basic_publish('', queue, body, self._properties)
+        self.published += 1
+        return d
+
+    def publish_many(self, queue, bodies):
+        """Publish several messages to a queue.
+
+        Return value:
+        A deferred which fires once all messages have been confirmed.
+        """
+        return gatherResults([self.publish(queue, body) for body in bodies],
+                             consumeErrors=True)
+
+    def rate(self):
+        """Return the average number of messages confirmed per second."""
+        if self.started is None or time() <= self.started:
+            return 0.0
+        return self.confirmed / (time() - self.started)
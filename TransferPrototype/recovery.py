@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Recover the state of transfers when the service is started."""
+# Copyright 2017  University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function  # for python 2
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.logger import Logger
+
+from admission import reclaim_stale_txn
+from statemachine import transitioned
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+
+@inlineCallbacks
+def recover_transfers(dbpool, publisher, staging_queue, prepare_queue,
+                      transfer_queue, staging_timeout=None,
+                      prepare_timeout=None):
+    """Recover transfers left in an intermediate state by a restart.
+
+    Transfers waiting to enter the next stage (SUBMITTED, STAGINGDONE and
+    PREPARINGDONE) are added to the corresponding queue again, as their
+    messages may have been lost.  Each stage ignores requests for transfers
+    which aren't in the state it expects, so any duplicate messages which
+    result from this are harmless.
+
+    Transfers which are part way through staging or preprocessing (STAGING
+    and PREPARING) continue to count against the limit on the number of
+    concurrent tasks in their stage until their status changes.  Those
+    which have been in the stage for longer than its timeout are returned
+    to the status preceding it (SUBMITTED or STAGINGDONE) first, and are
+    then requeued along with the others, as the report of their completion
+    may never arrive.  Transfers which are TRANSFERRING are handled by the
+    FTS manager.
+
+    Parameters:
+    dbpool -- Global shared database connection pool
+    publisher -- Global shared publisher for RabbitMQ
+    staging_queue -- Name of the RabbitMQ queue for staging requests
+    prepare_queue -- Name of the RabbitMQ queue for prepare requests
+    transfer_queue -- Name of the RabbitMQ queue for transfer requests
+    staging_timeout -- Time in seconds after which transfers which are
+      STAGING are returned to SUBMITTED (None to leave them)
+    prepare_timeout -- Time in seconds after which transfers which are
+      PREPARING are returned to STAGINGDONE (None to leave them)
+    """
+    log = Logger()
+
+    for from_status, to_status, timeout in [
+            ('SUBMITTED', 'STAGING', staging_timeout),
+            ('STAGINGDONE', 'PREPARING', prepare_timeout)]:
+        if not timeout:
+            continue
+        reclaimed = yield dbpool.runInteraction(reclaim_stale_txn,
+                                                from_status, to_status,
+                                                timeout)
+        if reclaimed:
+            log.info('Recovery: returning %s transfers which have been %s '
+                     'for over %s seconds to %s'
+                     % (len(reclaimed), to_status, timeout, from_status))
+            for transfer_id in reclaimed:
+                transitioned(transfer_id, from_status)
+
+    requeue = {
+      'SUBMITTED': staging_queue,
+      'STAGINGDONE': prepare_queue,
+      'PREPARINGDONE': transfer_queue,
+    }
+
+    r = yield dbpool.runQuery("SELECT transfer_id, status FROM transfers "
+                              "WHERE status IN ('SUBMITTED', 'STAGINGDONE', "
+                              "'PREPARINGDONE')")
+
+    pending = dict((queue, []) for queue in requeue.values())
+    for transfer_id, status in r:
+        pending[requeue[status]].append(transfer_id)
+
+    for queue, transfer_ids in pending.items():
+        if transfer_ids:
+            log.info('Recovery: adding %s transfers to the %s queue'
+                     % (len(transfer_ids), queue))
+            yield publisher.publish_many(queue, transfer_ids)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Share transfer capacity fairly between source and destination pairs."""
+# Copyright 2017  University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function  # for python 2
+
+from collections import deque
+from twisted.internet.defer import Deferred
+from twisted.logger import Logger
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+
+class PairScheduler (object):
+    """Schedule transfers between pairs of source and destination hosts.
+
+    Transfers waiting to start are kept in a separate queue for each
+    (source host, destination host) pair, and each pair has its own limit on
+    the number of transfers it may have in progress.  Whenever slots become
+    available the pairs with waiting transfers are served in round-robin
+    order, so that a single slow pair cannot hold up transfers between other
+    hosts.
+
+    The throughput achieved by each pair is recorded as its transfers
+    complete, and its limit is adapted toward the concurrency giving the
+    best bandwidth: the limit of each pair starts at the maximum, is
+    lowered when the throughput drops or transfers fail, and is raised
+    again while adding transfers still increases the aggregate throughput
+    of the pair.
+
+    The state kept is local to this instance of the service; limits on the
+    total number of transfers are enforced separately.
+    """
+
+    def __init__(self, limit_min=1, limit_max=None):
+        """Initialize the scheduler.
+
+        Arguments:
+        limit_min -- Minimum limit on the number of transfers in progress
+          for a pair
+        limit_max -- Maximum (and initial) limit on the number of transfers
+          in progress for a pair, or None for no maximum (in which case the
+          initial limit is limit_min)
+        """
+        self._log = Logger()
+        self._limit_min = max(int(limit_min), 1)
+        self._limit_max = int(limit_max) if limit_max else None
+        if self._limit_max is not None:
+            self._limit_max = max(self._limit_max, self._limit_min)
+        self._pairs = {}
+        self._rotation = deque()
+        self._dispatching = False
+        self._redispatch = False
+
+    def _pair(self, pair):
+        """Return the state of a pair, creating it if necessary."""
+        if pair not in self._pairs:
+            self._pairs[pair] = {
+              'waiting': deque(),
+              'active': 0,
+              'limit': self._limit_max or self._limit_min,
+              'throughput': None,
+            }
+            self._rotation.append(pair)
+        return self._pairs[pair]
+
+    def acquire(self, pair):
+        """Wait for a slot to become available for a pair.
+
+        Arguments:
+        pair -- Tuple of the source and destination hosts of the transfer
+
+        Return value:
+        A deferred which fires once the transfer may be started.  The slot
+        must be returned using release() once the transfer has ended.
+        """
+        d = Deferred()
+        self._pair(pair)['waiting'].append(d)
+        self._dispatch()
+        return d
+
+    def release(self, pair):
+        """Return the slot used by a transfer which has ended."""
+        state = self._pair(pair)
+        state['active'] = max(state['active'] - 1, 0)
+        self._dispatch()
+
+    def record(self, pair, nbytes, duration, success=True):
+        """Record the outcome of a transfer and adapt the limit of its pair.
+
+        This should be called before the slot used by the transfer is
+        released.
+
+        Arguments:
+        pair -- Tuple of the source and destination hosts of the transfer
+        nbytes -- Number of bytes transferred
+        duration -- Time in seconds taken by the transfer
+        success -- Whether or not the transfer succeeded
+        """
+        state = self._pair(pair)
+        if not success:
+            state['limit'] = max(state['limit'] - 1, self._limit_min)
+            return
+        if nbytes <= 0 or duration <= 0:
+            return
+
+        # Estimate the aggregate throughput of the pair from the throughput
+        # of this transfer and the number of transfers sharing the link
+        concurrency = max(state['active'], 1)
+        sample = nbytes * concurrency / float(duration)
+        previous = state['throughput']
+        if previous is None:
+            state['throughput'] = sample
+        else:
+            state['throughput'] = 0.8 * previous + 0.2 * sample
+
+        if previous is None or sample >= 0.95 * previous:
+            if concurrency >= state['limit'] and \
+                    (self._limit_max is None or
+                     state['limit'] < self._limit_max):
+                state['limit'] += 1
+        elif sample < 0.75 * previous:
+            state['limit'] = max(state['limit'] - 1, self._limit_min)
+
+        self._log.info('Throughput from %s to %s: %.0f bytes/s with %s '
+                       'transfers (limit now %s)'
+                       % (pair[0], pair[1], state['throughput'],
+                          concurrency, state['limit']))
+        self._dispatch()
+
+    def _dispatch(self):
+        """Start waiting transfers, taking one from each pair in turn.
+
+        Starting a transfer may cause this to be called again (e.g. if the
+        transfer ends immediately), in which case the outer call repeats
+        the dispatch instead.
+        """
+        if self._dispatching:
+            self._redispatch = True
+            return
+        self._dispatching = True
+        try:
+            started = True
+            while started or self._redispatch:
+                started = False
+                self._redispatch = False
+                for _ in range(len(self._rotation)):
+                    pair = self._rotation[0]
+                    self._rotation.rotate(-1)
+                    state = self._pairs[pair]
+                    if state['waiting'] and state['active'] < state['limit']:
+                        state['active'] += 1
+                        state['waiting'].popleft().callback(None)
+                        started = True
+        finally:
+            self._dispatching = False
+
+        # Forget idle pairs for which nothing has been learnt
+        for pair in list(self._rotation):
+            state = self._pairs[pair]
+            if not state['waiting'] and not state['active'] and \
+                    state['limit'] == self._limit_min:
+                self._rotation.remove(pair)
+                del self._pairs[pair]
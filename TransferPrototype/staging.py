@@ -18,32 +18,138 @@
 from __future__ import print_function  # for python 2
 
 import json
-import pika
-import random
-import requests
-import twisted
-
-from string import lowercase
-from sys import stderr
-from twisted.internet import defer, reactor, threads
-from twisted.internet.defer import DeferredSemaphore, inlineCallbacks, \
+
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList, inlineCallbacks, \
                                    returnValue
 from twisted.logger import Logger
 
+from admission import AdmissionController
+from batcher import Batcher
+from consumer import QueueConsumer
+from statemachine import transition, transition_txn, transitioned
+
 __author__ = "David Aikema, <david.aikema@uct.ac.za>"
 
 
+def _record_completions(txn, completions):
+    """Apply the transitions reported by staging completions (in a txn).
+
+    Return value:
+    A list containing, for each completion, a tuple of the new status and
+    the fields set, or None if the transfer wasn't being staged.
+    """
+    changes = []
+    for completion in completions:
+        success = completion['stager_success']
+        if not success or success == 'False':
+            to_state = 'ERROR'
+            fields = {'stager_status': completion['msg'],
+                      'extra_status': 'Staging failed'}
+        else:
+            to_state = 'STAGINGDONE'
+            fields = {'stager_path': completion['path'],
+                      'stager_hostname': completion['staged_to'],
+                      'stager_status': completion['msg']}
+        updated = transition_txn(txn, completion['transfer_id'], 'STAGING',
+                                 to_state, fields)
+        changes.append(None if updated is None else (to_state, fields))
+    return changes
+
+
+@inlineCallbacks
+def finish_staging_many(completions):
+    """Update status when a batch of staging tasks have been completed.
+
+    This is called by StagingFinish when it has received notification from
+    the stager that tasks have been completed.  The updates for all of the
+    completions are made in a single transaction, and the transfers staged
+    successfully are then published to the prepare queue together.
+
+    The function frees space for other transfers to enter the STAGING
+    portion of the transfer process.
+
+    Parameters:
+    completions -- List of dictionaries containing the parameters of
+      finish_staging for each completion
+
+    Return value (via deferred):
+    A list containing a dictionary for each completion with the
+    transfer_id, whether it was successfully processed ('success') and a
+    message.
+    """
+    global _admission
+    global _dbpool
+    global _prepare_queue
+    global _publisher
+
+    def _result(completion, success, msg):
+        return {'transfer_id': completion['transfer_id'], 'success': success,
+                'msg': msg}
+
+    try:
+        try:
+            changes = yield _dbpool.runInteraction(_record_completions,
+                                                   completions)
+        except Exception, e:
+            yield _log.error('Error updating DB to report staging finished '
+                             'for transfers %s' % ', '.join(
+                                 c['transfer_id'] for c in completions))
+            yield _log.error(str(e))
+            returnValue([_result(c, False, 'Error updating database')
+                         for c in completions])
+
+        results = []
+        staged = []
+        for completion, change in zip(completions, changes):
+            transfer_id = completion['transfer_id']
+            if change is None:
+                _log.info('Ignoring completion of staging for transfer %s as '
+                          'it is not being staged' % transfer_id)
+                results.append(_result(completion, False,
+                                       'Transfer is not being staged'))
+                continue
+            transitioned(transfer_id, *change)
+            if change[0] == 'ERROR':
+                _log.error('The stager reported failure staging transfer %s'
+                           % transfer_id)
+                results.append(_result(completion, False,
+                                       'Staging failure recorded'))
+            else:
+                results.append(_result(completion, True,
+                                       'Staging completion recorded'))
+                staged.append(len(results) - 1)
+
+        # Add to prepare queue, publishing all messages before waiting for
+        # them to be confirmed
+        published = yield DeferredList(
+            [_publisher.publish(_prepare_queue, results[i]['transfer_id'])
+             for i in staged], consumeErrors=True)
+        for i, (ok, value) in zip(staged, published):
+            if ok:
+                _log.info("Completed staging of %s"
+                          % results[i]['transfer_id'])
+                continue
+            _log.error('Error adding transfer %s to rabbitmq prepare queue'
+                       % results[i]['transfer_id'])
+            _log.error(str(value.value))
+            results[i].update({'success': False,
+                               'msg': 'Error adding transfer to prepare '
+                                      'queue'})
+        returnValue(results)
+    finally:
+        # Let other transfers into staging
+        _admission.notify()
+
+
 @inlineCallbacks
 def finish_staging(transfer_id, product_id, stager_success,
                    staged_to, path, msg):
     """Update status when a staging task has been completed.
 
     This is called by StagingFinish when it has received notification from
-    the stager that a task has been completed.
-
-    The function updates the database to reflect the completion of the task,
-    and updates the semaphore to allow another transfer to enter the STAGING
-    portion of the transfer process.
+    the stager that a task has been completed, and is equivalent to calling
+    finish_staging_many with a single completion.
 
     Required parameters:
     transfer_id -- ID of the transfer the product was staged as part of
@@ -56,106 +162,76 @@ def finish_staging(transfer_id, product_id, stager_success,
     Return value:
     A boolean indicating whether or not an error was successfully processed.
     """
-    global _dbpool
-    global _prepare_queue
-    global _pika_conn
-    global _sem_staging
+    results = yield finish_staging_many([{
+      'transfer_id': transfer_id, 'product_id': product_id,
+      'stager_success': stager_success, 'staged_to': staged_to,
+      'path': path, 'msg': msg}])
+    returnValue(results[0]['success'])
 
-    try:
-        # Report stager failure is something other than success was reported
-        if not stager_success:
-            _log.error('The stager reported failure staging transfer %s'
-                       % transfer_id)
-            returnValue(False)
 
-        # Update database information
-        try:
-            r = yield _dbpool.runQuery("UPDATE transfers SET "
-                                       "status = 'STAGINGDONE', "
-                                       "stager_path = %s, "
-                                       "stager_hostname = %s, "
-                                       "stager_status = %s "
-                                       "WHERE transfer_id = %s",
-                                       [path, staged_to, msg, transfer_id])
-        except Exception, e:
-            yield _log.error('Error updating DB to report staging finished '
-                             'for transfer %s' % transfer_id)
-            yield _log.error(str(e))
-            returnValue(False)
+@inlineCallbacks
+def _stage_batch(transfers):
+    """Submit a batch of transfers to the stager in a single request.
 
-        # Add to prepare queue
-        try:
-            send_properties = pika.BasicProperties(content_type='text/plain',
-                                                   delivery_mode=1)
-            channel = yield _pika_conn.channel()
-            yield channel.queue_declare(queue=_prepare_queue,
-                                        exclusive=False, durable=True)
-            yield channel.basic_publish('', _prepare_queue, transfer_id,
-                                        send_properties)
-        except Exception, e:
-            yield _log.error('Error adding transfer %s to rabbitmq prepare '
-                             'queue' % transfer_id)
-            yield _log.error(str(e))
-            returnValue(False)
-        finally:
-            yield channel.close()
+    Submitting many products at once allows stagers to order their recalls
+    (e.g. by tape and position on tape).  The stager reports whether it
+    accepted each transfer, and later reports the completion of each one
+    separately to the callback, identified by its transfer ID.
 
-        # Allow next transfer into staging and report results
-        yield _log.info("Completed staging of %s" % transfer_id)
-        returnValue(True)
-    finally:
-        # Remember to release the semaphore once done
-        yield _sem_staging.release()
+    Params:
+    transfers -- List of tuples of the transfer ID and product ID of each
+      transfer to stage
+
+    Return value (via deferred):
+    A list containing None for each transfer accepted by the stager, or an
+    exception for each transfer which wasn't.
+    """
+    global _http_client
+    global _stager_batch_uri
+    global _stager_callback
+
+    params = {
+      'transfers': json.dumps([{'transfer_id': transfer_id,
+                                'product_id': product_id}
+                               for transfer_id, product_id in transfers]),
+      'callback': _stager_callback,
+    }
+    r = yield _http_client.post(_stager_batch_uri, params)
+    if int(r.status_code) >= 400:
+        raise Exception('The stager reported an error - status was %s'
+                        % r.status_code)
+    accepted = dict((result['transfer_id'], result)
+                    for result in json.loads(r.text)['transfers'])
+
+    results = []
+    for transfer_id, product_id in transfers:
+        result = accepted.get(transfer_id, {})
+        if result.get('queued'):
+            results.append(None)
+        else:
+            results.append(Exception(result.get('msg', 'Not accepted by '
+                                                'the stager')))
+    _log.info('Submitted batch of %s transfers to stager (%s accepted)'
+              % (len(transfers), results.count(None)))
+    returnValue(results)
 
 
 @inlineCallbacks
-def _send_to_staging(transfer_id):
+def _send_to_staging(transfer_id, product_id):
     """Make call to stager to process transfer and update DB accordingly.
 
+    If batching is enabled the transfer is added to the current batch,
+    which is submitted once it is full or its window has passed.
+
     Params:
     transfer_id -- Identifier of the transfer to stage
+    product_id -- Identifier of the product to stage
     """
+    global _batcher
     global _log
-    global _dbpool
-    global _sem_staging
     global _stager_uri
     global _stager_callback
-    global _staging_cert
-    global _staging_key
-
-    # Get transfer details from DB
-    try:
-        r = yield _dbpool.runQuery("SELECT product_id FROM transfers WHERE "
-                                   "transfer_id = %s", [transfer_id])
-        product_id = r[0][0]
-    except Exception, e:
-        yield _log.error('Error retrieving product ID for transfer ID %s'
-                         % transfer_id)
-        yield _log.error(e)
-        try:
-            yield _dbpool.runQuery("UPDATE transfers SET status = 'ERROR', "
-                                   "extra_status = 'Error retrieving product "
-                                   "ID when preparing to stage transfer' "
-                                   "WHERE transfer_id = %s", [transfer_id])
-        except Exception:
-            # Just _log this one as it might have been a broken DB that
-            # triggered the original error.
-            _log.error('Error updating DB with staging error for transfer %s'
-                       % transfer_id)
-        # Abort the staging request as it's impossible without a product ID
-        yield _sem_staging.release()
-        returnValue(None)
-
-    # Update transfer status to staging
-    try:
-        yield _dbpool.runQuery("UPDATE transfers SET status = 'STAGING' "
-                               "WHERE transfer_id = %s", [transfer_id])
-    except Exception, e:
-        _log.error(str(e))
-        yield _log.error('Error updating status for transfer %s'
-                         % transfer_id)
-        yield _sem_staging.release()
-        returnValue(None)
+    global _http_client
 
     # Contact the stager to initiate the transfer process
     params = {
@@ -164,67 +240,62 @@ def _send_to_staging(transfer_id):
       'callback': _stager_callback,
     }
     try:
-        r = yield threads.deferToThread(requests.post, _stager_uri,
-                                        data=params,
-                                        cert=(_staging_cert, _staging_key))
-        if int(r.status_code) >= 400:
-            raise Exception('The stager reported an error - status was %s'
-                            % r.code)
+        if _batcher is not None:
+            yield _batcher.add((transfer_id, product_id))
+        else:
+            r = yield _http_client.post(_stager_uri, params)
+            if int(r.status_code) >= 400:
+                raise Exception('The stager reported an error - status was '
+                                '%s' % r.status_code)
     except Exception, e:
         _log.error('Error contacting stager at %s to submit request to stage '
                    'product ID %s for transfer ID %s'
                    % (_stager_callback, product_id, transfer_id))
         _log.error(e)
-        yield _dbpool.runQuery("UPDATE transfers SET status = 'ERROR', "
-                               "extra_status = 'Error contacting stager' "
-                               "WHERE transfer_id = %s", [transfer_id])
+        yield transition(transfer_id, 'STAGING', 'ERROR',
+                         {'extra_status': 'Error contacting stager'})
+        _admission.notify()
+        returnValue(None)
 
     yield _log.info('Finished submitting transfer %s to stager' % transfer_id)
 
 
 @inlineCallbacks
-def _staging_queue_listener():
-    """Listen to the staging queue and handle requests.
-
-    Actual processing of the incoming requests is done in a separate thread
-    as setup here. Note that a semaphore is used to ensure that only a fixed
-    number of transfers can be in staging process at one time.
+def _handle_staging_request(transfer_id):
+    """Handle a request from the staging queue.
+
+    Note that an admission controller is used to ensure that only a fixed
+    number of transfers can be in staging process at one time.  Admission
+    changes the status of the transfer to STAGING and returns the product
+    ID, and requests for transfers which weren't waiting to be staged are
+    ignored.
     """
-    global _log
-    global _pika_conn
-    global _staging_queue
-    global _sem_staging
-
-    channel = yield _pika_conn.channel()
-    queue = yield channel.queue_declare(queue=_staging_queue,
-                                        exclusive=False,
-                                        durable=True)
-    yield channel.basic_qos(prefetch_count=1)
+    global _admission
 
-    queue, _ = yield channel.basic_consume(queue=_staging_queue,
-                                           no_ack=False)
-
-    while True:
-        ch, method, properties, body = yield queue.get()
-        if body:
-            yield _sem_staging.acquire()
-            reactor.callFromThread(_send_to_staging, body)
-            yield ch.basic_ack(delivery_tag=method.delivery_tag)
+    transfer = yield _admission.admit(transfer_id)
+    if transfer is not None:
+        yield _send_to_staging(transfer_id, transfer['product_id'])
+    else:
+        _log.info('Ignoring request to stage %s as it is not waiting to be '
+                  'staged' % transfer_id)
 
 
 @inlineCallbacks
-def init_staging(pika_conn, dbpool, staging_queue, max_concurrent,
-                 prepare_queue, stager_uri, stager_callback, staging_cert,
-                 staging_key):
+def init_staging(pika_conn, publisher, dbpool, staging_queue,
+                 max_concurrent, prepare_queue, stager_uri, stager_callback,
+                 http_client, prefetch=None, workers=None,
+                 max_per_host=None, batch_size=1, batch_window=0.5,
+                 batch_path='stageBatch', timeout=None):
     """Initialize thread to manage the staging process.
 
-    Note that this function also initializes a semaphore used to enforce a
-    limit on the maximum number of staging tasks which are permitted to be
-    done in parallel.
+    Note that this function also initializes an admission controller used to
+    enforce a limit on the maximum number of staging tasks which are
+    permitted to be done in parallel across all instances of the service.
 
     Parameters:
     pika_conn -- Globally shared RabbitMQ connection
-    l_dbpool -- Globally shared database connection pool
+    publisher -- Globally shared RabbitMQ publisher
+    dbpool -- Globally shared database connection pool
     staging_queue -- Name of RabbitMQ queue to which staging requests are
       beging sent.
     max_concurrent -- Maximum number of transfers permitted to be in the
@@ -233,19 +304,35 @@ def init_staging(pika_conn, dbpool, staging_queue, max_concurrent,
       should be sent.
     stager_uri -- URI of the stager
     stager_callback -- Callback for stager to contact once staging complete
-    staging_cert -- Path to an X.509 cert to authenticate to stager with
-    staging_key -- Key corresponding to the staging_cert
+    http_client -- Globally shared HTTPClient, which authenticates to the
+      stager using the staging certificate
+    prefetch -- Maximum number of unacknowledged messages delivered from the
+      staging queue (defaults to the number of workers)
+    workers -- Number of staging requests handled concurrently (defaults to
+      max_concurrent)
+    max_per_host -- Maximum number of transfers to any one destination host
+      permitted to be in the STAGING state (None for no limit)
+    batch_size -- Maximum number of transfers submitted to the stager in a
+      single request (1 to submit each transfer separately)
+    batch_window -- Maximum time in seconds for which a transfer waits for
+      a batch to fill before it is submitted
+    batch_path -- Path relative to stager_uri of the stager's interface for
+      batches of transfers
+    timeout -- Time in seconds after which transfers in the STAGING state
+      are returned to the staging queue (None to never return them)
     """
+    global _admission
+    global _batcher
     global _dbpool
     global _log
     global _pika_conn
     global _prepare_queue
-    global _sem_staging
+    global _publisher
     global _staging_queue
     global _stager_uri
+    global _stager_batch_uri
     global _stager_callback
-    global _staging_cert
-    global _staging_key
+    global _http_client
 
     _log = Logger()
 
@@ -255,11 +342,23 @@ def init_staging(pika_conn, dbpool, staging_queue, max_concurrent,
     _pika_conn = pika_conn
     _dbpool = dbpool
     _prepare_queue = prepare_queue
-    _sem_staging = DeferredSemaphore(int(max_concurrent))
+    _publisher = publisher
+    _admission = AdmissionController(
+        dbpool, 'SUBMITTED', 'STAGING', max_concurrent, max_per_host,
+        returning=['product_id'], timeout=timeout,
+        requeue=lambda ids: publisher.publish_many(staging_queue, ids))
     _staging_queue = staging_queue
     _stager_uri = stager_uri
+    _stager_batch_uri = '%s/%s' % (stager_uri.rstrip('/'), batch_path)
     _stager_callback = stager_callback
-    _staging_cert = staging_cert
-    _staging_key = staging_key
+    _http_client = http_client
+
+    _batcher = None
+    if int(batch_size or 1) > 1:
+        _batcher = Batcher(_stage_batch, batch_size, batch_window)
 
-    reactor.callFromThread(_staging_queue_listener)
+    workers = workers or max_concurrent
+    consumer = QueueConsumer(pika_conn, staging_queue,
+                             _handle_staging_request,
+                             prefetch or workers, workers)
+    reactor.callFromThread(consumer.start)
@@ -17,13 +17,13 @@
 
 from __future__ import print_function  # for python 2
 
-from staging import finish_staging
+from staging import finish_staging, finish_staging_many
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.logger import Logger
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 
-from util import check_auth
+from util import check_auth, is_json_request, render_batch
 
 __author__ = "David Aikema, <david.aikema@uct.ac.za>"
 
@@ -33,6 +33,9 @@ __author__ = "David Aikema, <david.aikema@uct.ac.za>"
 class StagingFinish (Resource):
     """Used to signal that a transfer has finished staging.
 
+    Completions may be reported one at a time using form parameters, or
+    in batches by POSTing a JSON array of completions.
+
     Mounted at /doneStaging.
     """
 
@@ -88,6 +91,7 @@ class StagingFinish (Resource):
             request.setResponseCode(403)
             request.write('Unauthorized')
             request.finish()
+            return NOT_DONE_YET
 
         # Setup deferred to manage finish_staging asynchronously
         d = finish_staging(**params)
@@ -96,5 +100,21 @@ class StagingFinish (Resource):
         return NOT_DONE_YET
 
     def render_POST(self, request):
-        """If a POST request was received, process as if requested by GET."""
+        """Handle POST request reporting stager completion.
+
+        If the body of the request is JSON, it must be an array of objects
+        each containing the parameters of a single completion, which are
+        processed together.  The response is JSON containing a list of
+        results, each with the transfer_id, whether the completion was
+        successfully processed ('success') and a message.  Otherwise the
+        request is processed as if requested by GET.
+        """
+        if is_json_request(request):
+            return render_batch(request, self.stager_dn,
+                                {'transfer_id': 'transfer_id',
+                                 'product_id': 'product_id',
+                                 'success': 'stager_success',
+                                 'staged_to': 'staged_to',
+                                 'path': 'path', 'msg': 'msg'},
+                                finish_staging_many)
         return self.render_GET(request)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Change the state of transfers."""
+# Copyright 2017  University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function  # for python 2
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from events import publish_event
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+_EVENT_FIELDS = ['extra_status']
+"""Fields changed by a transition which are included in its event."""
+
+
+def transition_txn(txn, transfer_id, from_states, to_state, fields=None,
+                   returning=None):
+    """Change the state of a transfer within a transaction.
+
+    The transfer is only updated if its status is one of from_states, so
+    that transitions made by duplicate requests or callbacks (or by other
+    instances of the service) cannot be applied twice.  Whether the
+    transfer matched is determined from the row count of the update, so the
+    connection must report matched rather than changed rows (i.e. use the
+    CLIENT.FOUND_ROWS flag).  The caller must call transitioned() once the
+    transaction has been committed.
+
+    Arguments:
+    txn -- Database cursor of the transaction
+    transfer_id -- ID of the transfer
+    from_states -- A status or list of statuses the transfer must have
+    to_state -- New status of the transfer, or None to leave it unchanged
+    fields -- Dictionary of other columns of the transfers table to set
+    returning -- List of columns of the transfers table to return
+
+    Return value:
+    None if the transfer didn't have one of from_states, otherwise a
+    dictionary of the columns in returning (read after the update).
+    """
+    if isinstance(from_states, basestring):
+        from_states = [from_states]
+    changes = dict(fields or {})
+    if to_state is not None:
+        changes['status'] = to_state
+    columns = sorted(changes)
+
+    txn.execute("UPDATE transfers SET " +
+                ", ".join("%s = %%s" % column for column in columns) +
+                " WHERE transfer_id = %s AND status IN (" +
+                ", ".join(["%s"] * len(from_states)) + ")",
+                [changes[column] for column in columns] + [transfer_id] +
+                list(from_states))
+    if txn.rowcount < 1:
+        return None
+
+    if not returning:
+        return {}
+    txn.execute("SELECT " + ", ".join(returning) + " FROM transfers WHERE "
+                "transfer_id = %s", [transfer_id])
+    return dict(zip(returning, txn.fetchone()))
+
+
+def transitioned(transfer_id, to_state, fields=None, returned=None):
+    """Record a transition which has been committed to the DB.
+
+    This updates the cache of transfer details and publishes an event for
+    the change of status.
+
+    Arguments:
+    transfer_id -- ID of the transfer
+    to_state -- New status of the transfer, or None if it didn't change
+    fields -- Other columns of the transfers table which were set
+    returned -- Columns of the transfers table read after the transition
+    """
+    global _cache
+
+    changes = dict(returned or {})
+    changes.update(fields or {})
+    if to_state is not None:
+        changes['status'] = to_state
+    _cache.set(transfer_id, changes)
+
+    if to_state is not None:
+        details = dict((field, changes[field]) for field in _EVENT_FIELDS
+                       if changes.get(field) is not None)
+        publish_event(transfer_id, to_state, **details)
+
+
+def cached_fields(transfer_id, returning):
+    """Return the cached values of columns, or None if not all are cached.
+
+    Used to avoid reading columns which are already known when making a
+    transition.
+    """
+    global _cache
+
+    if not returning:
+        return {}
+    return _cache.peek(transfer_id, returning)
+
+
+@inlineCallbacks
+def transition(transfer_id, from_states, to_state, fields=None,
+               returning=None):
+    """Change the state of a transfer.
+
+    The transfer is only updated if its status is one of from_states.  The
+    update and reading of any columns not held in the cache are done in a
+    single interaction with the DB.
+
+    Arguments:
+    transfer_id -- ID of the transfer
+    from_states -- A status or list of statuses the transfer must have
+    to_state -- New status of the transfer, or None to leave it unchanged
+    fields -- Dictionary of other columns of the transfers table to set
+    returning -- List of columns of the transfers table to return
+
+    Return value (via deferred):
+    None if the transfer didn't have one of from_states, otherwise a
+    dictionary of the columns in returning.
+    """
+    global _dbpool
+
+    cached = cached_fields(transfer_id, returning)
+    result = yield _dbpool.runInteraction(
+        transition_txn, transfer_id, from_states, to_state, fields,
+        None if cached is not None else returning)
+    if result is None:
+        returnValue(None)
+    result.update(cached or {})
+    transitioned(transfer_id, to_state, fields, result)
+    returnValue(result)
+
+
+def init_state_machine(dbpool, cache):
+    """Initialize the state machine.
+
+    Parameters:
+    dbpool -- Global shared database connection pool
+    cache -- Global shared cache of transfer details
+    """
+    global _cache
+    global _dbpool
+
+    _cache = cache
+    _dbpool = dbpool
@@ -24,6 +24,7 @@ import time
 import twisted
 
 from OpenSSL import crypto, SSL
+from MySQLdb.constants import CLIENT
 from OpenSSL.crypto import X509StoreFlags
 from os.path import dirname, exists, expanduser, join, realpath
 from pika import ConnectionParameters
@@ -40,10 +41,11 @@ from twisted.web.resource import Resource
 from twisted.web.server import Site
 
 # The web pages
+from events import TransferEvents
 from preparefinish import PrepareFinish
 from rootpage import RootPage
 from stagingfinish import StagingFinish
-from transfersubmit import TransferSubmit
+from transfersubmit import TransferBatchSubmit, TransferSubmit
 from transferstatus import TransferStatus
 
 # FTS, Prepare and Staging backends
@@ -51,8 +53,16 @@ from staging import init_staging
 from prepare import init_prepare
 from ftsmanager import init_fts_manager
 
+# Shared cache, HTTP clients, RabbitMQ publisher and recovery following
+# restarts
+from cache import TransferCache
+from httpclient import HTTPClient
+from publisher import Publisher
+from recovery import recover_transfers
+from statemachine import init_state_machine
+
 # Util methods
-from util import load_allowed_DNs
+from util import config_get, load_admin_DNs, load_allowed_DNs
 
 __author__ = "David Aikema, <david.aikema@uct.ac.za>"
 
@@ -63,6 +73,7 @@ def main():
 
     This function:
     * initializes connections to database and RabbitMQ
+    * recovers transfers left in an intermediate state by a restart
     * sets up the web interface linkage
     * calls staging and FTS initialization routines
     * listens on the desired port
@@ -81,14 +92,22 @@ def main():
     configData = ConfigParser.ConfigParser()
     configData.read(cfg_file)
 
-    # Establish DB connection
+    # Establish DB connection.  The row count of an UPDATE is the number of
+    # rows matched rather than changed, so that transitions which set
+    # columns to their current values are still seen to have succeeded.
     dbpool = adbapi.ConnectionPool('MySQLdb',
                                    host=configData.get('mysql', 'hostname'),
                                    user=configData.get('mysql', 'username'),
                                    passwd=configData.get('mysql', 'password'),
-                                   db=configData.get('mysql', 'db'))
+                                   db=configData.get('mysql', 'db'),
+                                   client_flag=CLIENT.FOUND_ROWS)
     log.info("DB Connection Established")
 
+    # Setup shared cache of transfer details
+    cache = TransferCache(dbpool,
+                          config_get(configData, 'mysql', 'cache_size', 10000))
+    init_state_machine(dbpool, cache)
+
     # Retrieve values needed for rabbit mq connections
     prepare_queue = configData.get('amqp', 'prepare_queue')
     staging_queue = configData.get('amqp', 'staging_queue')
@@ -101,6 +120,19 @@ def main():
     pika_conn = yield pika_cc.connectTCP(pika_hostname, 5672)
     yield pika_conn.ready
 
+    # Setup shared publisher, declaring the queues used
+    publisher = Publisher(pika_conn,
+                          [staging_queue, prepare_queue, transfer_queue],
+                          config_get(configData, 'amqp', 'channels', 4))
+    yield publisher.start()
+
+    # Recover transfers left in an intermediate state by a restart.  This
+    # must be done before the queue listeners are started.
+    staging_timeout = config_get(configData, 'staging', 'timeout', 86400)
+    prepare_timeout = config_get(configData, 'prepare', 'timeout', 86400)
+    yield recover_transfers(dbpool, publisher, staging_queue, prepare_queue,
+                            transfer_queue, staging_timeout, prepare_timeout)
+
     # Create root webpage
     root = RootPage()
     root.putChild('', root)
@@ -109,30 +141,54 @@ def main():
     prepare_dn = configData.get('prepare', 'x509dn')
 
     # Add child web pages
-    t_submit = TransferSubmit(dbpool, staging_queue, pika_conn)
+    t_submit = TransferSubmit(dbpool, cache, staging_queue, publisher)
     root.putChild('submitTransfer', t_submit)
+    root.putChild('submitTransfers',
+                  TransferBatchSubmit(dbpool, cache, staging_queue, publisher))
     root.putChild('transferStatus', TransferStatus(dbpool))
+    root.putChild('transferEvents', TransferEvents(dbpool))
     root.putChild('doneStaging', StagingFinish(stager_dn))
     root.putChild('donePrepare', PrepareFinish(prepare_dn))
 
+    # Setup shared HTTPS clients for calls to the stager and transfer agents,
+    # which keep connections open between requests
+    http_options = dict(
+        (option, config_get(configData, 'http', option, default))
+        for option, default in [('max_per_host', 8), ('timeout', 60),
+                                ('connect_timeout', 30),
+                                ('idle_timeout', 240),
+                                ('max_retry_wait', 300)])
+    staging_cert = configData.get('staging', 'cert')
+    staging_key = configData.get('staging', 'key')
+    staging_client = HTTPClient((staging_cert, staging_key), **http_options)
+    prepare_cert = configData.get('prepare', 'cert')
+    prepare_key = configData.get('prepare', 'key')
+    prepare_client = HTTPClient((prepare_cert, prepare_key), **http_options)
+
     # Setup staging manager
     staging_concurrent_max = configData.get('staging', 'concurrent_max')
     staging_url = configData.get('staging', 'server')
     staging_callback = configData.get('staging', 'callback')
-    staging_cert = configData.get('staging', 'cert')
-    staging_key = configData.get('staging', 'key')
-    init_staging(pika_conn, dbpool, staging_queue, staging_concurrent_max,
-                 prepare_queue, staging_url, staging_callback,
-                 staging_cert, staging_key)
+    init_staging(pika_conn, publisher, dbpool, staging_queue,
+                 staging_concurrent_max, prepare_queue, staging_url,
+                 staging_callback, staging_client,
+                 config_get(configData, 'staging', 'prefetch'),
+                 config_get(configData, 'staging', 'workers'),
+                 config_get(configData, 'staging', 'concurrent_max_per_host'),
+                 config_get(configData, 'staging', 'batch_size', 1),
+                 config_get(configData, 'staging', 'batch_window', 0.5),
+                 timeout=staging_timeout)
 
     # Setup prepare manager
     prepare_concurrent_max = configData.get('prepare', 'concurrent_max')
-    prepare_cert = configData.get('prepare', 'cert')
-    prepare_key = configData.get('prepare', 'key')
     prepare_callback = configData.get('prepare', 'callback')
-    init_prepare(pika_conn, dbpool, prepare_queue, transfer_queue,
-                 prepare_concurrent_max, (prepare_cert, prepare_key),
-                 prepare_callback)
+    init_prepare(pika_conn, publisher, dbpool, prepare_queue,
+                 transfer_queue, prepare_concurrent_max,
+                 prepare_client, prepare_callback,
+                 config_get(configData, 'prepare', 'prefetch'),
+                 config_get(configData, 'prepare', 'workers'),
+                 config_get(configData, 'prepare', 'concurrent_max_per_host'),
+                 prepare_timeout)
 
     # Setup FTS manager
     fts_concurrent_max = configData.get('fts', 'concurrent_max')
@@ -142,9 +198,24 @@ def main():
                   configData.get('fts', 'key')  # key
                  ]
     fts_interval = configData.get('fts', 'polling_interval')
-    init_fts_manager(pika_conn, dbpool, fts_params, transfer_queue,
-                     fts_concurrent_max, fts_interval,
-                     (prepare_cert, prepare_key))
+    fts_batch_size = config_get(configData, 'fts', 'status_batch_size', 50)
+    fts_threads = config_get(configData, 'fts', 'threads', 4)
+    fts_interval_max = config_get(configData, 'fts', 'polling_interval_max',
+                                  300)
+    fts_state_queue = config_get(configData, 'fts', 'state_queue')
+    fts_pair_min = config_get(configData, 'fts', 'concurrent_min_per_pair', 1)
+    fts_pair_max = config_get(configData, 'fts', 'concurrent_max_per_pair')
+    fts_retry_max = config_get(configData, 'fts', 'retry_max', 3)
+    fts_retry_delay = config_get(configData, 'fts', 'retry_delay', 60)
+    init_fts_manager(pika_conn, publisher, dbpool, cache, fts_params,
+                     transfer_queue, fts_concurrent_max, fts_interval,
+                     prepare_client, fts_batch_size,
+                     fts_threads, fts_interval_max, fts_state_queue,
+                     config_get(configData, 'fts', 'prefetch'),
+                     config_get(configData, 'fts', 'workers'),
+                     config_get(configData, 'fts', 'concurrent_max_per_host'),
+                     fts_pair_min, fts_pair_max, fts_retry_max,
+                     fts_retry_delay)
 
     # Create factory for site
     factory = Site(root)
@@ -194,6 +265,9 @@ def main():
     # the system
     load_allowed_DNs(configData.get('auth', 'permitted'))
 
+    # ... and of those which may see the transfers of all submitters
+    load_admin_DNs(config_get(configData, 'auth', 'admin', ''))
+
     sslendpoint = endpoints.SSL4ServerEndpoint(reactor, 8443,
                                                ssl_ctx_factory)
     sslendpoint.listen(factory)
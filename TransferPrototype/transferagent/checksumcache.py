@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cache the checksums of files on a transfer node."""
+# Copyright 2017 University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function  # for python 2
+
+import os
+import sqlite3
+import threading
+import zlib
+
+from time import time
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+
+class ChecksumCache (object):
+    """Persistent cache of the ADLER32 checksums of files.
+
+    Checksums are stored in an SQLite database keyed by the device and inode
+    of each file, and are only reused while the size and modification time
+    of the file are unchanged.  As staged products are hard links to (or
+    copies of) the same source files, checksums computed for one staging
+    are reused by later stagings of the same product, and by the different
+    services on a node sharing the database.
+
+    The least recently used checksums are evicted once the number of
+    entries exceeds a limit.
+    """
+
+    batch_size = 500
+    """Number of files looked up and stored in each transaction."""
+
+    def __init__(self, path, max_entries=1000000, read_size=4194304):
+        """Open (creating if necessary) the checksum cache.
+
+        Arguments:
+        path -- Path of the SQLite database
+        max_entries -- Maximum number of checksums retained
+        read_size -- Size of the blocks in which files are read
+        """
+        self._path = path
+        self._max_entries = int(max_entries)
+        self._read_size = int(read_size)
+        self._local = threading.local()
+
+        conn = self._connection()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS checksums ("
+                         "device INTEGER NOT NULL, inode INTEGER NOT NULL, "
+                         "size INTEGER NOT NULL, mtime REAL NOT NULL, "
+                         "checksum TEXT NOT NULL, last_used REAL NOT NULL, "
+                         "PRIMARY KEY (device, inode))")
+            conn.execute("CREATE INDEX IF NOT EXISTS checksums_last_used "
+                         "ON checksums (last_used)")
+
+    def _connection(self):
+        """Return the connection to the database used by this thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _compute(self, path):
+        """Compute the checksum of a file, reading it sequentially."""
+        checksum = 1
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(self._read_size)
+                if not data:
+                    break
+                checksum = zlib.adler32(data, checksum)
+        return 'ADLER32:%08x' % (checksum & 0xffffffff)
+
+    def _describe_batch(self, paths, pool):
+        """Describe a batch of files, computing missing checksums."""
+        conn = self._connection()
+        stats = dict((path, os.stat(path)) for path in paths)
+        checksums = {}
+        missing = []
+        for path in paths:
+            st = stats[path]
+            row = conn.execute("SELECT checksum FROM checksums WHERE "
+                               "device = ? AND inode = ? AND size = ? AND "
+                               "mtime = ?", (st.st_dev, st.st_ino,
+                                             st.st_size,
+                                             st.st_mtime)).fetchone()
+            if row is not None:
+                checksums[path] = row[0]
+            else:
+                missing.append(path)
+
+        computed = (pool.map if pool else map)(self._compute, missing)
+        computed_paths = set(missing)
+        now = time()
+        rows = []
+        for path, checksum in zip(missing, computed):
+            checksums[path] = checksum
+            # Don't store the checksum if the file changed while being read
+            st = os.stat(path)
+            before = stats[path]
+            if (st.st_size, st.st_mtime) == (before.st_size, before.st_mtime):
+                rows.append((st.st_dev, st.st_ino, st.st_size, st.st_mtime,
+                             checksum, now))
+        with conn:
+            conn.executemany("UPDATE checksums SET last_used = ? WHERE "
+                             "device = ? AND inode = ?",
+                             [(now, stats[path].st_dev, stats[path].st_ino)
+                              for path in paths if path not in computed_paths])
+            conn.executemany("INSERT OR REPLACE INTO checksums VALUES "
+                             "(?, ?, ?, ?, ?, ?)", rows)
+
+        return [(path, (stats[path].st_size, int(stats[path].st_mtime),
+                        checksums[path])) for path in paths]
+
+    def describe_many(self, paths, pool=None):
+        """Return the size, modification time and checksum of files.
+
+        Files are processed in batches, and the checksums of files which
+        aren't cached are computed using the pool of workers if given.
+
+        Arguments:
+        paths -- Iterable of the paths of the files
+        pool -- A multiprocessing.pool.ThreadPool used to compute checksums
+
+        Yields:
+        A tuple of the path of each file (in order) and a tuple of its size,
+        modification time and checksum.
+        """
+        batch = []
+        for path in paths:
+            batch.append(path)
+            if len(batch) >= self.batch_size:
+                for result in self._describe_batch(batch, pool):
+                    yield result
+                batch = []
+        if batch:
+            for result in self._describe_batch(batch, pool):
+                yield result
+        self.evict()
+
+    def describe(self, path):
+        """Return the size, modification time and checksum of a file."""
+        return self._describe_batch([path], None)[0][1]
+
+    def warm(self, paths, pool=None):
+        """Compute and cache the checksums of files which aren't cached.
+
+        Return value:
+        The number of files processed.
+        """
+        count = 0
+        for _ in self.describe_many(paths, pool):
+            count += 1
+        return count
+
+    def evict(self):
+        """Evict the least recently used checksums beyond the limit."""
+        conn = self._connection()
+        with conn:
+            excess = (conn.execute("SELECT COUNT(*) FROM checksums")
+                      .fetchone()[0] - self._max_entries)
+            if excess > 0:
+                conn.execute("DELETE FROM checksums WHERE rowid IN (SELECT "
+                             "rowid FROM checksums ORDER BY last_used LIMIT "
+                             "?)", (excess,))
@@ -27,15 +27,22 @@ import os
 import requests
 import sys
 
+from checksumcache import ChecksumCache
 from klein import Klein
+from multiprocessing.pool import ThreadPool
 from OpenSSL import crypto
-from os import walk
 from os.path import dirname, exists, expanduser, isdir, join, relpath as \
                     relativepath, samefile
 from twisted.internet import endpoints, reactor, ssl, threads
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.python import log
 from twisted.web.server import Site
+from workqueue import QueueFull, WorkQueue, respond_busy
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir  # backport for python 2
 
 __author__ = "David Aikema, <david.aikema@uct.ac.za>"
 
@@ -67,6 +74,48 @@ allowedDNs = filter(lambda x: x != '', config_dns.splitlines())
 creds = (configData.get('credentials', 'cert'),
          configData.get('credentials', 'key'))
 
+# Number of files written in each chunk of a streamed file listing
+FILES_CHUNK_SIZE = 1000
+
+# Manifests of staged products are written by the stager next to the
+# product, in a file with the same name and this suffix
+MANIFEST_SUFFIX = '.manifest'
+
+# Cache of checksums (shared with other services on the node) and pool of
+# workers used to compute them
+checksum_options = {
+  'cache': '~/.transfer_checksums.sqlite',
+  'max_entries': 1000000,
+  'read_size': 4 * 1024 * 1024,
+  'workers': 4,
+}
+for option in checksum_options:
+    if configData.has_option('checksums', option):
+        checksum_options[option] = configData.get('checksums', option)
+checksums = ChecksumCache(expanduser(checksum_options['cache']),
+                          checksum_options['max_entries'],
+                          checksum_options['read_size'])
+checksum_pool = ThreadPool(int(checksum_options['workers']))
+
+# Bounded queues of work, each done by its own pool of threads: CPU work
+# (preprocessing and warming the checksum cache), disk I/O (listing files)
+# and callbacks to the transfer service
+queue_options = {
+  'cpu_workers': 4,
+  'cpu_max_queued': 100,
+  'io_workers': 8,
+  'io_max_queued': 100,
+  'callback_workers': 4,
+}
+for option in queue_options:
+    if configData.has_option('queues', option):
+        queue_options[option] = configData.get('queues', option)
+cpu_queue = WorkQueue('cpu', queue_options['cpu_workers'],
+                      queue_options['cpu_max_queued'])
+io_queue = WorkQueue('io', queue_options['io_workers'],
+                     queue_options['io_max_queued'])
+callback_queue = WorkQueue('callback', queue_options['callback_workers'])
+
 
 def is_authorized(request, handle_unauthorized=True):
     """Assess if a request is authorized and optionally write error msg.
@@ -147,8 +196,11 @@ def validate_product_directory(dir=None, request=None):
     if not isdir(dir):
         if request is not None:
             request.setResponseCode(404)
-            return (json.dumps({'success': False,
-                                'msg': 'Staged product not found'}) + "\n")
+            request.write(json.dumps({'success': False,
+                                      'msg': 'Staged product not found'}) +
+                          "\n")
+            request.finish()
+            return False
         else:
             return 'nonexistant'
 
@@ -156,6 +208,72 @@ def validate_product_directory(dir=None, request=None):
     return True
 
 
+def iter_files(path):
+    """Iterate over the files contained in a directory and its subdirectories.
+
+    Directories are read one at a time using scandir, so that the files are
+    produced without building a list of them.  Symbolic links to directories
+    are not followed.
+
+    Params:
+    path -- Directory in which to find the files
+
+    Yields:
+    A tuple of the path of each file relative to the directory, and its size
+    in bytes (or None if it couldn't be determined).
+    """
+    prefix = len(join(path, ''))
+    dirs = [path]
+    while dirs:
+        for entry in scandir(dirs.pop()):
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    dirs.append(entry.path)
+                continue
+            try:
+                size = entry.stat().st_size
+            except OSError:
+                size = None
+            yield entry.path[prefix:], size
+
+
+def manifest_path(dir):
+    """Return the path of the manifest of a staged product directory."""
+    return dir.rstrip(os.sep) + MANIFEST_SUFFIX
+
+
+def update_manifest(dir, names):
+    """Update the manifest of a product for files which have been changed.
+
+    This should be called whenever files of a staged product are created or
+    modified, so that the manifest continues to describe the product.  It
+    does nothing if the product has no manifest.
+
+    Params:
+    dir -- Directory of the staged product
+    names -- Paths of the changed files, relative to dir
+    """
+    manifest = manifest_path(dir)
+    if not exists(manifest):
+        return
+    names = set(names)
+    count = 0
+    with open(manifest) as src, open(manifest + '.tmp', 'w') as dst:
+        for line in src:
+            entry = json.loads(line)
+            if 'path' in entry and entry['path'] not in names:
+                dst.write(line)
+                count += 1
+        for name in sorted(names):
+            size, mtime, checksum = checksums.describe(join(dir, name))
+            dst.write(json.dumps({'path': name, 'size': size,
+                                  'mtime': mtime, 'checksum': checksum}) +
+                      "\n")
+            count += 1
+        dst.write(json.dumps({'success': True, 'count': count}) + "\n")
+    os.rename(manifest + '.tmp', manifest)
+
+
 def validate_prepare_task(prepare, dir, transfer_id):
     """Validate whether or not the transfer request is well-formed.
 
@@ -171,14 +289,16 @@ def validate_prepare_task(prepare, dir, transfer_id):
     return 'Valid'
 
 
-def do_prepare(prepare, dir, transfer_id, callback):
-    """Perform preprocessing task and report results to the callback.
+def do_prepare(prepare, dir, transfer_id):
+    """Perform preprocessing task.
 
     Params:
     prepare -- Description of the prepare task to be executed
     dir -- Directory containing the files
     transfer_id -- Transfer ID
-    callback -- URL to report results of preprocessing to
+
+    Return Value:
+    A dictionary of the results to report to the transfer service.
 
     Note that this function is expected to be called in a separate
     thread and calls blocking operations.
@@ -191,33 +311,37 @@ def do_prepare(prepare, dir, transfer_id, callback):
             f.write(str(prepare) + "\n\n")
             f.write("Transfer ID:\t%s\n\n" % transfer_id)
             f.write("Could email Brad a reminder to send list of tasks\n")
+        update_manifest(dir, ['preprocessed.txt'])
     except Exception, e:
         log.err(e)
-        # Report error to callback
-        params = {'transfer_id': transfer_id,
-                  'success': False,
-                  'msg': str(e)}
-        try:
-            r = requests.post(callback, data=params, cert=creds)
-            log.msg('Reported error in preprocessing %s to %s (result: %s)'
-                    % (transfer_id, callback, r.status_code))
-        except Exception, e:
-            log.err('Error reporting preprocessing failure for %s to %s'
-                    % (transfer_id, callback))
-        return None
+        return {'transfer_id': transfer_id,
+                'success': False,
+                'msg': str(e)}
+
+    return {'transfer_id': transfer_id,
+            'success': True,
+            'msg': 'Preprocessing task "%s" completed successfully'
+                   % prepare}
+
+
+def report_prepare(params, callback):
+    """Report the results of preprocessing to the callback.
 
-    # Report success to callback
-    params = {'transfer_id': transfer_id,
-              'success': True,
-              'msg': 'Preprocessing task "%s" completed successfully'
-                     % prepare}
+    Params:
+    params -- Results returned by do_prepare
+    callback -- URL to report results of preprocessing to
+
+    Note that this function is expected to be called in a separate
+    thread and calls blocking operations.
+    """
+    outcome = 'success' if params['success'] else 'error'
     try:
         r = requests.post(callback, data=params, cert=creds)
-        log.msg('Reported success preprocessing %s to %s (result: %s)'
-                % (transfer_id, callback, r.status_code))
-    except Exception, e:
-        log.err('Error reporting preprocessing success for %s to %s'
-                % (transfer_id, callback))
+        log.msg('Reported %s in preprocessing %s to %s (result: %s)'
+                % (outcome, params['transfer_id'], callback, r.status_code))
+    except Exception:
+        log.err('Error reporting preprocessing %s for %s to %s'
+                % (outcome, params['transfer_id'], callback))
 
 
 @app.route('/')
@@ -226,12 +350,37 @@ def root(request):
     return "Transfer Agent\n"
 
 
+@app.route('/status')
+def _status_page_handler(request):
+    """Return the state of the queues of work of the agent as JSON."""
+    # Check authorization
+    if not is_authorized(request):
+        return None
+
+    request.setHeader('Content-Type', 'application/json')
+    return json.dumps({'success': True,
+                       'queues': {'cpu': cpu_queue.status(),
+                                  'io': io_queue.status(),
+                                  'callback': callback_queue.status()}}) + "\n"
+
+
 @app.route('/files')
 def _files_page_handler(request):
     """Return a JSONified list of the files involved in a transfer.
 
     Request parameters:
     dir -- Base directory in which the product(s) are to be found.
+    checksums -- If 'true', the modification time and checksum of each file
+      are also included in streamed listings (using the checksum cache).
+
+    If the request accepts application/x-ndjson, the files are streamed as
+    they are found, with one JSON object containing the path and size of a
+    file per line.  The listing ends with a line containing the success of
+    the listing and the number of files, so that incomplete listings can be
+    detected.  If the stager wrote a manifest of the product, the manifest
+    (which also contains the modification time and checksum of each file)
+    is streamed instead of listing the directory.  Otherwise a single JSON
+    document containing a list of the files is returned.
 
     Explanation of return status codes:
     200 -- A valid list of files was found and is included with the reply
@@ -241,15 +390,59 @@ def _files_page_handler(request):
     403 -- Authorization failed
     404 -- The data product was not found
     500 -- Server Error
+    503 -- Too many requests are queued; retry after the number of seconds
+           given in the Retry-After header
     """
     def _get_list_of_files(path):
         # Build list of files
-        files = []
-        for dir, _, filenames in walk(path):
-            full = map(lambda x: join(dir, x), filenames)
-            noprefix = map(lambda x: x[len(path) + len(os.sep):], full)
-            files += noprefix
-        return files
+        return [name for name, _ in iter_files(path)]
+
+    def _describe_files(path):
+        # Add the modification time and checksum to each file found
+        prefix = len(join(path, ''))
+        names = (join(path, name) for name, _ in iter_files(path))
+        for name, (size, mtime, checksum) in \
+                checksums.describe_many(names, checksum_pool):
+            yield name[prefix:], {'size': size, 'mtime': mtime,
+                                  'checksum': checksum}
+
+    def _stream_files(path, request, finished, with_checksums):
+        # Write the files to the request in chunks as they are found (this
+        # is run in a thread, and stops if the connection is lost)
+        count = 0
+        chunk = []
+        if with_checksums:
+            files = _describe_files(path)
+        else:
+            files = ((name, {'size': size}) for name, size in iter_files(path))
+        for name, details in files:
+            if finished:
+                return
+            details['path'] = name
+            chunk.append(json.dumps(details))
+            count += 1
+            if len(chunk) >= FILES_CHUNK_SIZE:
+                threads.blockingCallFromThread(reactor, request.write,
+                                               "\n".join(chunk) + "\n")
+                chunk = []
+        chunk.append(json.dumps({'success': True, 'count': count}))
+        threads.blockingCallFromThread(reactor, request.write,
+                                       "\n".join(chunk) + "\n")
+
+    def _stream_manifest(manifest, request, finished):
+        # Write the manifest of the product to the request in chunks (this
+        # is run in a thread, and stops if the connection is lost)
+        with open(manifest) as f:
+            while not finished:
+                lines = f.readlines(FILES_CHUNK_SIZE * 128)
+                if not lines:
+                    break
+                threads.blockingCallFromThread(reactor, request.write,
+                                               ''.join(lines))
+
+    def _handle_end_of_stream(_, request):
+        if not finished:
+            request.finish()
 
     def _handle_list_of_files(files, request):
         r = {'success': True, 'files': files}
@@ -258,7 +451,10 @@ def _files_page_handler(request):
 
     def _handle_error(f, request):
         log.err(f)
-        request.setResponseCode(500)
+        if finished:
+            return
+        if not request.startedWriting:
+            request.setResponseCode(500)
         request.write(json.dumps({'success': False,
                                   'msg': 'Internal server error'}) + "\n")
         request.finish()
@@ -270,14 +466,75 @@ def _files_page_handler(request):
     # Process the request
     if validate_product_directory(request=request):
         dir = request.args.get('dir')[0]
+        if io_queue.full():
+            return respond_busy(request, io_queue)
+
+        # Note if the connection is lost so that streaming can be stopped
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
 
         # Launch function to handle request and return a deferred
-        d = threads.deferToThread(_get_list_of_files, dir)
-        d.addCallback(_handle_list_of_files, request)
+        accept = request.getHeader('Accept') or ''
+        if 'application/x-ndjson' in accept:
+            request.setHeader('Content-Type', 'application/x-ndjson')
+            if exists(manifest_path(dir)):
+                d = io_queue.submit(_stream_manifest, manifest_path(dir),
+                                    request, finished)
+            else:
+                with_checksums = (request.args.get('checksums', ['false'])[0]
+                                  .lower() == 'true')
+                d = io_queue.submit(_stream_files, dir, request, finished,
+                                    with_checksums)
+            d.addCallback(_handle_end_of_stream, request)
+        else:
+            d = io_queue.submit(_get_list_of_files, dir)
+            d.addCallback(_handle_list_of_files, request)
         d.addErrback(_handle_error, request)
         return d
 
 
+@app.route('/warmChecksums')
+def _warm_checksums_page_handler(request):
+    """Compute and cache the checksums of the files in a directory.
+
+    This allows the checksum cache to be filled in bulk, e.g. for products
+    which are expected to be requested, in advance of their files being
+    listed.  The checksums are computed in the background.
+
+    Request parameters:
+    dir -- Directory containing the files.
+
+    Explanation of return status codes:
+    202 -- The checksums will be computed
+    400 -- Invalid directory
+    403 -- Authorization failed
+    404 -- The directory was not found
+    503 -- Too many requests are queued; retry after the number of seconds
+           given in the Retry-After header
+    """
+    def _warm(path):
+        count = checksums.warm((join(path, name)
+                                for name, _ in iter_files(path)),
+                               checksum_pool)
+        log.msg('Checksums of %s files in %s cached' % (count, path))
+
+    # Check authorization
+    if not is_authorized(request):
+        return None
+
+    if validate_product_directory(request=request):
+        dir = request.args.get('dir')[0]
+        try:
+            d = cpu_queue.submit(_warm, dir)
+        except QueueFull:
+            return respond_busy(request, cpu_queue)
+        d.addErrback(log.err)
+        request.setResponseCode(202)
+        return json.dumps({'success': True,
+                           'msg': 'Computing checksums of files in %s'
+                                  % dir}) + "\n"
+
+
 @app.route('/prepare')
 def _prepare_page_handler(request):
     """Do preprocessing for the specified tasks.
@@ -297,7 +554,8 @@ def _prepare_page_handler(request):
     404 -- The data product was not found
     422 -- Invalid preprocessing tasks specified.
     500 -- Server Error
-
+    503 -- Too many requests are queued; retry after the number of seconds
+           given in the Retry-After header
     """
     # Check authorization
     if not is_authorized(request):
@@ -331,7 +589,14 @@ def _prepare_page_handler(request):
         request.finish()
         return None
 
-    reactor.callInThread(do_prepare, prepare, dir, transfer_id, callback)
+    # Do the preprocessing, then report the results using a separate pool
+    try:
+        d = cpu_queue.submit(do_prepare, prepare, dir, transfer_id)
+    except QueueFull:
+        return respond_busy(request, cpu_queue)
+    d.addCallback(lambda params: callback_queue.submit(report_prepare,
+                                                       params, callback))
+    d.addErrback(log.err)
 
 
 # Setup SSL
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Bounded queues of work done in dedicated pools of threads."""
+# Copyright 2017 University of Cape Town
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function  # for python 2
+
+import json
+import math
+
+from time import time
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+__author__ = "David Aikema, <david.aikema@uct.ac.za>"
+
+
+class QueueFull (Exception):
+    """Raised when work is submitted to a queue which is full."""
+
+    pass
+
+
+class WorkQueue (object):
+    """A bounded queue of work done by a dedicated pool of threads.
+
+    Each kind of work done by an agent (e.g. disk I/O, CPU intensive work
+    and callbacks to the transfer service) is given its own queue, so that
+    a burst of one kind of request cannot take all of the threads needed
+    by another.  Once a queue is full further work is rejected, so that the
+    agent can ask clients to retry later rather than queueing work without
+    limit.
+
+    Work must be submitted from the reactor thread.
+    """
+
+    def __init__(self, name, workers, max_queued=None):
+        """Initialize the queue and start its pool of threads.
+
+        Arguments:
+        name -- Name of the queue (used to name its threads)
+        workers -- Number of threads doing work from the queue
+        max_queued -- Maximum number of items of work waiting for a thread,
+          or None for no limit
+        """
+        self.name = name
+        self._workers = int(workers)
+        self._max_queued = None if max_queued is None else int(max_queued)
+        self._pool = ThreadPool(0, self._workers, name)
+        self._duration = None
+
+        self.pending = 0
+        """Number of items of work queued or in progress."""
+        self.rejected = 0
+        """Number of items of work rejected as the queue was full."""
+
+        reactor.callWhenRunning(self._pool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', self._pool.stop)
+
+    def full(self):
+        """Check whether further work would be rejected."""
+        return (self._max_queued is not None and
+                self.pending >= self._workers + self._max_queued)
+
+    def _record(self, duration):
+        """Update the moving average of the time taken by each item."""
+        if self._duration is None:
+            self._duration = duration
+        else:
+            self._duration = 0.9 * self._duration + 0.1 * duration
+
+    def _done(self, result):
+        self.pending -= 1
+        return result
+
+    def submit(self, f, *args, **kwargs):
+        """Call a function in a thread of the pool.
+
+        Return value:
+        A deferred firing with the result of the function.
+
+        Raises QueueFull if the queue is full.
+        """
+        if self.full():
+            self.rejected += 1
+            raise QueueFull('The %s queue is full' % self.name)
+
+        def _timed():
+            start = time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                reactor.callFromThread(self._record, time() - start)
+
+        self.pending += 1
+        d = threads.deferToThreadPool(reactor, self._pool, _timed)
+        d.addBoth(self._done)
+        return d
+
+    def retry_after(self):
+        """Estimate the number of seconds until the queue has space."""
+        waiting = max(self.pending - self._workers + 1, 1)
+        duration = self._duration or 1.0
+        return max(1, int(math.ceil(duration * waiting / self._workers)))
+
+    def status(self):
+        """Return a dictionary describing the state of the queue."""
+        return {'workers': self._workers, 'max_queued': self._max_queued,
+                'pending': self.pending, 'rejected': self.rejected,
+                'duration': self._duration}
+
+
+def respond_busy(request, queue):
+    """Reject a request as a queue is full, asking the client to retry.
+
+    Return value:
+    The body of the response.
+    """
+    retry_after = queue.retry_after()
+    request.setResponseCode(503)
+    request.setHeader('Retry-After', str(retry_after))
+    return json.dumps({'success': False,
+                       'msg': 'Too many requests are queued; retry in %s '
+                              'seconds' % retry_after}) + "\n"
@@ -17,6 +17,7 @@
 
 from __future__ import print_function  # for python 2
 
+import base64
 import json
 
 from datetime import datetime
@@ -24,19 +25,144 @@ from twisted.logger import Logger
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 
-from util import check_auth
+from util import check_auth, match_against_admin
 
 __author__ = "David Aikema, <david.aikema@uct.ac.za>"
 
+_FIELDS = ['transfer_id', 'product_id', 'status', 'extra_status',
+           'destination_path', 'submitter', 'fts_id', 'fts_details',
+           'fts_retries', 'stager_path', 'stager_hostname', 'stager_status',
+           'prepare_activity', 'time_submitted', 'time_staging',
+           'time_staging_done', 'time_transferring', 'time_error',
+           'time_success']
+"""Fields of the transfers table reported to users."""
+
+_STATUSES = ['INIT', 'SUBMITTED', 'STAGING', 'STAGINGDONE', 'PREPARING',
+             'PREPARINGDONE', 'TRANSFERRING', 'ERROR', 'SUCCESS']
+
+_TIME_FIELDS = ['time_submitted', 'time_staging', 'time_staging_done',
+                'time_preparing', 'time_preparing_done', 'time_transferring',
+                'time_error', 'time_success']
+
+_FILE_FIELDS = ['path', 'size', 'state', 'reason']
+"""Fields of the transfer_files table reported to users."""
+
+_LIST_PARAMS = ['status', 'submitter', 'since', 'until', 'time_field',
+                'order', 'limit', 'cursor']
+"""Parameters which select the list mode of /transferStatus."""
+
+
+def _serialize_with_dt(obj):
+    """Serialize datetimes in ISO format when encoding JSON."""
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError("Type not serializable")
+
+
+def _transfer_record(row):
+    """Convert a row of the transfers table into a dictionary to report.
+
+    The summary of the FTS job held in fts_details is decoded so that it is
+    reported as an object.  Transfers recorded before these summaries were
+    introduced hold a textual dump of the job, which is reported as is.
+    """
+    record = dict(zip(_FIELDS, row))
+    if record['fts_details']:
+        try:
+            record['fts_details'] = json.loads(record['fts_details'])
+        except ValueError:
+            pass
+    return record
+
+
+def _transfer_progress(txn, record, elapsed):
+    """Summarize the progress of the files of a transfer.
+
+    Arguments:
+    txn -- Database cursor
+    record -- Dictionary of the fields of the transfer
+    elapsed -- Seconds for which the transfer has been (or was) transferring
+
+    Return value:
+    A dictionary containing the number of files and bytes of the transfer,
+    those which have been transferred, the number of failed files and, for
+    transfers which have been transferring, the throughput (in bytes per
+    second) and estimated seconds remaining.  None is returned if the files
+    of the transfer aren't known.
+    """
+    txn.execute("SELECT COUNT(*), SUM(state = 'FINISHED'), "
+                "SUM(state = 'FAILED'), SUM(size), "
+                "SUM(IF(state = 'FINISHED', size, 0)) FROM transfer_files "
+                "WHERE transfer_id = %s", [record['transfer_id']])
+    files, files_done, files_failed, size, size_done = txn.fetchone()
+    if not files:
+        return None
+
+    progress = {
+      'files': int(files),
+      'files_done': int(files_done or 0),
+      'files_failed': int(files_failed or 0),
+      'bytes': int(size or 0),
+      'bytes_done': int(size_done or 0),
+      'throughput': None,
+      'eta': None,
+    }
+    if elapsed and elapsed > 0:
+        progress['throughput'] = progress['bytes_done'] / float(elapsed)
+        if record['status'] == 'TRANSFERRING' and progress['throughput']:
+            progress['eta'] = int((progress['bytes'] -
+                                   progress['bytes_done']) /
+                                  progress['throughput'])
+    return progress
+
+
+def _parse_time(value):
+    """Parse a date or date and time in ISO 8601 format."""
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Invalid time '%s'" % value)
+
+
+def _encode_cursor(time_value, transfer_id):
+    """Encode the position following a transfer as an opaque cursor."""
+    position = [time_value.strftime('%Y-%m-%d %H:%M:%S'), transfer_id]
+    return base64.urlsafe_b64encode(json.dumps(position))
+
+
+def _decode_cursor(cursor):
+    """Decode a cursor into the time and transfer ID it follows."""
+    try:
+        time_value, transfer_id = json.loads(
+            base64.urlsafe_b64decode(str(cursor)))
+        return _parse_time(time_value), transfer_id
+    except Exception:
+        raise ValueError('Invalid cursor')
+
 
 class TransferStatus (Resource):
     """Allow users to query the results of their transfer request.
 
+    Besides reporting the status of a single transfer, a list mode allows
+    the status of several transfers to be retrieved at once, either by ID
+    or by filtering on submitter, status and time range.  Filtered results
+    are paginated using keyset cursors, so that each page is retrieved
+    using an index rather than by skipping over earlier results.
+
     Mounted at /transferStatus.
     """
 
     isLeaf = True
 
+    max_ids = 1000
+    """Maximum number of transfer IDs which may be queried at once."""
+
+    default_limit = 100
+    max_limit = 1000
+    """Default and maximum number of transfers returned per page."""
+
     def __init__(self, dbpool):
         """Initialize transfer status query REST interface.
 
@@ -52,7 +178,19 @@ class TransferStatus (Resource):
 
         Required parameter:
         transfer_id -- identifier of the transfer to get status of.
+
+        Optional parameter:
+        files -- If 'true', the path, size, state and reason for failure of
+          each file of the transfer are also reported.
+
+        The progress of the files of the transfer is reported along with
+        its status.  The list mode is used if several transfer IDs or any of
+        the parameters of the list mode are given (see _render_list).
         """
+        if len(request.args.get('transfer_id', [])) > 1 or \
+                any(p in request.args for p in _LIST_PARAMS):
+            return self._render_list(request)
+
         if 'transfer_id' not in request.args:
             result = {
               'error': True,
@@ -64,27 +202,19 @@ class TransferStatus (Resource):
         # Check auth
         x509dn = check_auth(request, request.args['transfer_id'][0],
                             returnError=False)
+        list_files = (request.args.get('files', ['false'])[0].lower() in
+                      ('true', '1'))
 
         def _report_results(txn):
             """Query DB for transfer and report results to user."""
             transfer_id = request.args['transfer_id'][0]
-            txn.execute("SELECT transfer_id, product_id, status, "
-                        "extra_status, destination_path, submitter, fts_id, "
-                        "fts_details, stager_path, stager_hostname, "
-                        "stager_status, prepare_activity, time_submitted, "
-                        "time_staging, time_staging_done, time_transferring, "
-                        "time_error, time_success FROM transfers WHERE "
-                        "transfer_id = %s", [transfer_id])
+            txn.execute("SELECT " + ", ".join(_FIELDS) + ", "
+                        "TIMESTAMPDIFF(SECOND, time_transferring, "
+                        "COALESCE(time_success, time_error, NOW())) FROM "
+                        "transfers WHERE transfer_id = %s", [transfer_id])
             result = txn.fetchone()
             if result:
-                fields = ['transfer_id', 'product_id', 'status',
-                          'extra_status', 'destination_path', 'submitter',
-                          'fts_id', 'fts_details', 'stager_path',
-                          'stager_hostname', 'stager_status',
-                          'prepare_activity', 'time_submitted',
-                          'time_staging', 'time_staging_done',
-                          'time_transferring', 'time_error', 'time_success']
-                results = dict(zip(fields, result))
+                results = _transfer_record(result)
 
                 # Check authZ
                 if results['submitter'] != x509dn:
@@ -95,10 +225,14 @@ class TransferStatus (Resource):
                     request.finish()
                     return
 
-                def _serialize_with_dt(obj):
-                    if isinstance(obj, datetime):
-                        return obj.isoformat()
-                    raise TypeError("Type not serializable")
+                results['progress'] = _transfer_progress(txn, results,
+                                                         result[-1])
+                if list_files:
+                    txn.execute("SELECT " + ", ".join(_FILE_FIELDS) +
+                                " FROM transfer_files WHERE transfer_id = %s "
+                                "ORDER BY file_index", [transfer_id])
+                    results['files'] = [dict(zip(_FILE_FIELDS, row))
+                                        for row in txn.fetchall()]
                 request.write(json.dumps(results,
                                          default=_serialize_with_dt) + "\n")
             else:
@@ -122,3 +256,172 @@ class TransferStatus (Resource):
         d = self.dbpool.runInteraction(_report_results)
         d.addErrback(_report_db_error)
         return NOT_DONE_YET
+
+    def render_POST(self, request):
+        """Process POST request for transfer status.
+
+        This accepts the same parameters as a GET request, allowing large
+        numbers of transfer IDs to be sent in the body of the request.
+        """
+        return self.render_GET(request)
+
+    def _error(self, request, code, msg):
+        """Set the response code and return a JSON error message."""
+        request.setResponseCode(code)
+        return json.dumps({'error': True, 'msg': msg}) + "\n"
+
+    def _render_list(self, request):
+        """Report the status of several transfers.
+
+        Optional parameters:
+        transfer_id -- (may be repeated) Identifiers of the transfers to get
+          the status of.  If given, all of these transfers are reported on
+          and the other parameters are ignored.
+        submitter -- X.509 DN of the submitter of the transfers (defaults to
+          the DN of the certificate used).  Only admin DNs may query
+          transfers submitted by others, and these get the transfers of all
+          submitters if this isn't given.
+        status -- (may be repeated) Only report transfers with this status
+        time_field -- Time column used to filter and order the transfers
+          (defaults to time_submitted).  Transfers for which it isn't set
+          are not reported.
+        since -- Only report transfers whose time_field is at or after this
+          time (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS, UTC)
+        until -- Only report transfers whose time_field is before this time
+        order -- Order of the transfers by time_field, 'asc' or 'desc'
+          (defaults to 'asc')
+        limit -- Maximum number of transfers to report
+        cursor -- Cursor returned with the previous page of results
+
+        Return value:
+        JSON containing a list of transfers and either a cursor for the
+        next page of results (null on the last page) or, if transfer IDs
+        were given, a list of those which weren't found.
+        """
+        x509dn = check_auth(request, None, returnError=False)
+        if not x509dn:
+            return self._error(request, 403, 'Unauthorized')
+        privileged = match_against_admin(x509dn)
+
+        submitter = request.args.get('submitter', [None])[0]
+        if submitter is None and not privileged:
+            submitter = x509dn
+        elif submitter != x509dn and not privileged:
+            return self._error(request, 403, "'%s' may not query transfers "
+                               "submitted by '%s'" % (x509dn, submitter))
+
+        conditions = []
+        values = []
+        if submitter is not None:
+            conditions.append("submitter = %s")
+            values.append(submitter)
+
+        transfer_ids = request.args.get('transfer_id', [])
+        if transfer_ids:
+            if len(transfer_ids) > self.max_ids:
+                return self._error(request, 400, 'At most %s transfer IDs may '
+                                   'be queried at once' % self.max_ids)
+            conditions.append("transfer_id IN (%s)"
+                              % ", ".join(["%s"] * len(transfer_ids)))
+            values.extend(transfer_ids)
+            query = ("SELECT " + ", ".join(_FIELDS) + " FROM transfers "
+                     "WHERE " + " AND ".join(conditions))
+            limit = None
+        else:
+            try:
+                query, limit = self._list_query(request, conditions, values)
+            except ValueError, e:
+                return self._error(request, 400, str(e))
+
+        def _report_results(txn):
+            """Query DB for transfers and report results to user."""
+            txn.execute(query, values)
+            rows = txn.fetchall()
+            result = {}
+            if limit is None:
+                found = set(row[0] for row in rows)
+                result['not_found'] = [t for t in transfer_ids
+                                       if t not in found]
+            else:
+                result['next'] = None
+                if len(rows) > limit:
+                    rows = rows[:limit]
+                    result['next'] = _encode_cursor(rows[-1][-1], rows[-1][0])
+            result['transfers'] = [_transfer_record(row) for row in rows]
+            request.write(json.dumps(result, default=_serialize_with_dt) +
+                          "\n")
+            request.finish()
+
+        def _report_db_error(e):
+            """Report error if issue encountered getting transfer status."""
+            self.log.error(e)
+            request.setResponseCode(500)
+            request.write(json.dumps({'error': True, 'msg': 'An unknown '
+                                      'database error occurred'}) + "\n")
+            request.finish()
+
+        d = self.dbpool.runInteraction(_report_results)
+        d.addErrback(_report_db_error)
+        return NOT_DONE_YET
+
+    def _list_query(self, request, conditions, values):
+        """Build the query for a page of transfers matching filters.
+
+        Arguments:
+        request -- The request containing the filters
+        conditions -- Conditions already applied to the query (extended)
+        values -- Values for the conditions (extended)
+
+        Return value:
+        A tuple of the query and the number of transfers in the page.  One
+        more transfer than this is retrieved to detect whether there is a
+        next page, and the value of the time field is appended to each row.
+
+        Raises a ValueError if any of the filters are invalid.
+        """
+        args = request.args
+
+        time_field = args.get('time_field', ['time_submitted'])[0]
+        if time_field not in _TIME_FIELDS:
+            raise ValueError("Invalid time_field '%s'" % time_field)
+        conditions.append(time_field + " IS NOT NULL")
+
+        statuses = args.get('status', [])
+        for status in statuses:
+            if status not in _STATUSES:
+                raise ValueError("Invalid status '%s'" % status)
+        if statuses:
+            conditions.append("status IN (%s)"
+                              % ", ".join(["%s"] * len(statuses)))
+            values.extend(statuses)
+
+        if 'since' in args:
+            conditions.append(time_field + " >= %s")
+            values.append(_parse_time(args['since'][0]))
+        if 'until' in args:
+            conditions.append(time_field + " < %s")
+            values.append(_parse_time(args['until'][0]))
+
+        order = args.get('order', ['asc'])[0].lower()
+        if order not in ('asc', 'desc'):
+            raise ValueError("Invalid order '%s'" % order)
+        op = '>' if order == 'asc' else '<'
+        if 'cursor' in args:
+            after_time, after_id = _decode_cursor(args['cursor'][0])
+            conditions.append("(%s %s %%s OR (%s = %%s AND transfer_id %s "
+                              "%%s))" % (time_field, op, time_field, op))
+            values.extend([after_time, after_time, after_id])
+
+        try:
+            limit = int(args.get('limit', [self.default_limit])[0])
+        except ValueError:
+            raise ValueError('Invalid limit')
+        if limit < 1 or limit > self.max_limit:
+            raise ValueError('limit must be between 1 and %s'
+                             % self.max_limit)
+
+        query = ("SELECT " + ", ".join(_FIELDS + [time_field]) + " FROM "
+                 "transfers WHERE " + " AND ".join(conditions) +
+                 " ORDER BY %s %s, transfer_id %s LIMIT %d"
+                 % (time_field, order.upper(), order.upper(), limit + 1))
+        return query, limit
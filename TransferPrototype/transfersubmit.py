@@ -18,19 +18,15 @@
 from __future__ import print_function  # for python 2
 
 import json
-import pika
-import random
-import string
 import uuid
 
-from pika import exceptions
-from pika.adapters import twisted_connection
-from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.logger import Logger
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 from urlparse import urlparse
 
+from events import publish_event
+from statemachine import transition, transition_txn, transitioned
 from util import check_auth, match_against_allowed
 
 __author__ = "David Aikema, <david.aikema@uct.ac.za>"
@@ -54,6 +50,21 @@ class SubmitException (Exception):
         return json.dumps(result) + "\n"
 
 
+def validate_destination_path(path):
+    """Check that a destination path is a URL specifying a GridFTP server.
+
+    Return value:
+    The normalized URL, or None if the path is invalid.
+    """
+    try:
+        up = urlparse(path)
+        if up.scheme != 'gsiftp' or up.netloc == '':
+            return None
+        return up.geturl()
+    except Exception:
+        return None
+
+
 class TransferSubmit (Resource):
     """Manage transfer submission, updating DB and RabbitMQ.
 
@@ -62,25 +73,25 @@ class TransferSubmit (Resource):
 
     isLeaf = True
 
-    def __init__(self, dbpool, staging_queue, pika_conn):
+    def __init__(self, dbpool, cache, staging_queue, publisher):
         """Initialize transfer submission REST interface.
 
         Arguments:
         dbpool -- shared database connection pool
+        cache -- shared cache of transfer details
         staging_queue -- named of the RabbitMQ queue to submit transfers to
-        pika_conn -- shared connection to RabbitMQ
+        publisher -- shared publisher for RabbitMQ
         """
         Resource.__init__(self)
 
-        # Use global logger and database pool
+        # Use global logger, database pool and cache
         self._log = Logger()
         self._dbpool = dbpool
+        self._cache = cache
 
-        # Setup local connection to rabbitmq
+        # Use shared publisher for rabbitmq
         self._staging_queue = staging_queue
-        self._pika_conn = pika_conn
-        self._pika_bp = pika.BasicProperties(content_type='text/plain',
-                                             delivery_mode=1)
+        self._publisher = publisher
 
     def render_POST(self, request):
         """Manage POST request with transfer submission.
@@ -114,14 +125,9 @@ class TransferSubmit (Resource):
                 return json.dumps(result) + "\n"
 
         # Validate URL
-        try:
-            up = urlparse(request.args['destination_path'][0])
-            if up.scheme != 'gsiftp' or up.netloc == '':
-                raise SubmitException()
-            destination_path = up.geturl()
-        except Exception, e:
-            if not isinstance(e, SubmitException):
-                self._log.error(e)
+        destination_path = validate_destination_path(
+            request.args['destination_path'][0])
+        if destination_path is None:
             request.setResponseCode(400)
             result = {
               'msg': 'destination_path must be a URL specifying '
@@ -139,6 +145,7 @@ class TransferSubmit (Resource):
             prepare_activity = request.args['prepare'][0]
 
         transfer_id = str(uuid.uuid1())
+        destination_host = urlparse(destination_path).hostname
 
         def _add_initial(txn):
             """Create initial database record for transfer.
@@ -146,17 +153,19 @@ class TransferSubmit (Resource):
             Argument:
             txn --- database cursor
 
-            Note that the status of the record will be set to INIT until
-            the transfer has been successfully added to the RabbitMQ transfer
-            queue.
+            The record is created with the status SUBMITTED.  If the
+            transfer can't then be added to the RabbitMQ staging queue it is
+            marked as failed, and if the service stops before it has been
+            added it will be queued again when the service is restarted.
             """
             try:
                 txn.execute("INSERT INTO transfers (transfer_id, product_id, "
-                            "status, destination_path, submitter, "
-                            "prepare_activity) VALUES (%s, %s, 'INIT', %s, "
-                            "%s, %s)", [transfer_id, product_id,
-                                        destination_path, x509dn,
-                                        prepare_activity])
+                            "status, time_submitted, destination_path, "
+                            "destination_host, submitter, prepare_activity) "
+                            "VALUES (%s, %s, 'SUBMITTED', NOW(), %s, %s, %s, "
+                            "%s)",
+                            [transfer_id, product_id, destination_path,
+                             destination_host, x509dn, prepare_activity])
             except Exception, e:
                 self._log.error(e)
                 request.setResponseCode(500)
@@ -164,34 +173,30 @@ class TransferSubmit (Resource):
                                       transfer_id)
 
         # Add to rabbitmq
-        @inlineCallbacks
         def _add_to_rabbitmq(_):
-            """Add the transfer to RabbitMQ."""
-            channel = yield self._pika_conn.channel()
-            yield channel.queue_declare(queue=self._staging_queue,
-                                        exclusive=False, durable=True)
-            yield channel.basic_publish('', self._staging_queue, transfer_id,
-                                        self._pika_bp)
-
-        def _update_status(txn):
-            """Update status of the transfer in the DB to SUBMITTED."""
-            try:
-                txn.execute("UPDATE transfers SET status = 'SUBMITTED' WHERE "
-                            "transfer_id = %s", [transfer_id])
-            except Exception, e:
-                self._log.error(e)
-                request.setResponseCode(500)
-                msg = 'Error updating transfer status to STAGING'
-                result = {
-                  'msg': msg,
-                  'transfer_id': transfer_id,
-                  'error': True
-                }
-                return json.dumps(result) + "\n"
+            """Cache the transfer and add it to RabbitMQ."""
+            self._cache.add(transfer_id, product_id=product_id,
+                            destination_path=destination_path,
+                            destination_host=destination_host,
+                            submitter=x509dn,
+                            prepare_activity=prepare_activity)
+            d = self._publisher.publish(self._staging_queue, transfer_id)
+            d.addErrback(_mark_failed)
+            return d
+
+        def _mark_failed(failure):
+            """Mark the transfer as failed if it couldn't be queued."""
+            self._log.error(failure)
+            d = transition(transfer_id, 'SUBMITTED', 'ERROR',
+                           {'extra_status': 'Error adding transfer to '
+                                            'staging queue'})
+            d.addBoth(lambda _: failure)
+            return d
 
         # Report results
         def _report_transfer_creation(_):
             """Report that transfer submission was accepted with no errors."""
+            publish_event(transfer_id, 'SUBMITTED')
             result = {
               'msg': 'Transfer submission processed successfully',
               'error': False,
@@ -206,8 +211,8 @@ class TransferSubmit (Resource):
         def _handleCreationError(e):
             """Report that an error occured when processing the transfer."""
             request.setResponseCode(500)
-            if isinstance(e, SubmitException):
-                request.write(e.toJSON())
+            if e.check(SubmitException):
+                request.write(e.value.toJSON())
             else:
                 self._log.error(e)
                 result = {
@@ -221,7 +226,176 @@ class TransferSubmit (Resource):
         # Add callbacks to handle the transfer submission asynchronously
         d = self._dbpool.runInteraction(_add_initial)
         d.addCallback(_add_to_rabbitmq)
-        d.addCallback(lambda _: self._dbpool.runInteraction(_update_status))
         d.addCallback(_report_transfer_creation)
         d.addErrback(_handleCreationError)
         return NOT_DONE_YET
+
+
+class TransferBatchSubmit (Resource):
+    """Manage submission of several transfers in a single request.
+
+    All transfers are recorded in the DB using a single multi-row INSERT
+    and added to RabbitMQ together.
+
+    Mounted at /submitTransfers.
+    """
+
+    isLeaf = True
+
+    max_batch_size = 10000
+    """Maximum number of transfers which may be submitted in one request."""
+
+    def __init__(self, dbpool, cache, staging_queue, publisher):
+        """Initialize batch transfer submission REST interface.
+
+        Arguments:
+        dbpool -- shared database connection pool
+        cache -- shared cache of transfer details
+        staging_queue -- named of the RabbitMQ queue to submit transfers to
+        publisher -- shared publisher for RabbitMQ
+        """
+        Resource.__init__(self)
+        self._log = Logger()
+        self._dbpool = dbpool
+        self._cache = cache
+        self._staging_queue = staging_queue
+        self._publisher = publisher
+
+    def _error(self, request, code, msg):
+        """Set the response code and return a JSON error message."""
+        request.setResponseCode(code)
+        result = {'msg': msg, 'transfer_ids': None, 'error': True}
+        return json.dumps(result) + "\n"
+
+    def render_POST(self, request):
+        """Manage POST request with a batch of transfer submissions.
+
+        The body of the request must be a JSON list of objects, each of
+        which contains the following fields (all strings):
+        product_id --- Unique identifier of the product being requested
+        destination_path --- A URI specifying a GridFTP server location
+            to transfer the product to.
+        prepare --- (optional) Details of any preprocessing to be done
+
+        The transfer IDs are reported in the same order as the products
+        were listed in the request.
+        """
+        x509dn = check_auth(request, None, returnError=False)
+        if x509dn == NOT_DONE_YET:
+            return NOT_DONE_YET
+        if not x509dn or not match_against_allowed(x509dn):
+            return self._error(request, 403, 'Unauthorized')
+
+        # Parse and validate the list of products
+        try:
+            products = json.loads(request.content.read())
+            if not isinstance(products, list):
+                raise ValueError('not a list')
+        except Exception:
+            return self._error(request, 400, 'Request body must be a JSON '
+                               'list of transfer requests')
+        if len(products) == 0 or len(products) > self.max_batch_size:
+            return self._error(request, 400, 'A batch must contain between 1 '
+                               'and %s transfer requests'
+                               % self.max_batch_size)
+
+        rows = []
+        for i, product in enumerate(products):
+            if not isinstance(product, dict) or \
+                    'product_id' not in product or \
+                    'destination_path' not in product:
+                return self._error(request, 400, 'Transfer request %s did not '
+                                   'specify product_id and destination_path'
+                                   % i)
+            if not isinstance(product['product_id'], basestring):
+                return self._error(request, 400, 'product_id of transfer '
+                                   'request %s must be a string' % i)
+            if not isinstance(product.get('prepare', ''), basestring):
+                return self._error(request, 400, 'prepare of transfer '
+                                   'request %s must be a string' % i)
+            destination_path = validate_destination_path(
+                product['destination_path'])
+            if destination_path is None:
+                return self._error(request, 400, 'destination_path of '
+                                   'transfer request %s must be a URL '
+                                   'specifying a GridFTP server' % i)
+            rows.append((str(uuid.uuid1()), product['product_id'],
+                         destination_path, urlparse(destination_path).hostname,
+                         x509dn, product.get('prepare')))
+        transfer_ids = [row[0] for row in rows]
+
+        def _add_initial(txn):
+            """Create initial database records for all transfers.
+
+            The records are created with the status SUBMITTED, as for
+            single submissions.
+            """
+            values = ', '.join(["(%s, %s, 'SUBMITTED', NOW(), %s, %s, %s, "
+                                "%s)"] * len(rows))
+            txn.execute("INSERT INTO transfers (transfer_id, product_id, "
+                        "status, time_submitted, destination_path, "
+                        "destination_host, submitter, prepare_activity) "
+                        "VALUES " + values,
+                        [field for row in rows for field in row])
+
+        def _add_to_rabbitmq(_):
+            """Cache all transfers and add them to RabbitMQ."""
+            for row in rows:
+                self._cache.add(row[0], product_id=row[1],
+                                destination_path=row[2],
+                                destination_host=row[3], submitter=row[4],
+                                prepare_activity=row[5])
+            d = self._publisher.publish_many(self._staging_queue,
+                                             transfer_ids)
+            d.addErrback(_mark_failed)
+            return d
+
+        def _mark_failed(failure):
+            """Mark the transfers as failed if they couldn't be queued."""
+            self._log.error(failure)
+            fields = {'extra_status': 'Error adding transfer to staging '
+                                      'queue'}
+
+            def _fail_all(txn):
+                return [transfer_id for transfer_id in transfer_ids
+                        if transition_txn(txn, transfer_id, 'SUBMITTED',
+                                          'ERROR', fields) is not None]
+
+            def _failed(failed_ids):
+                for transfer_id in failed_ids:
+                    transitioned(transfer_id, 'ERROR', fields)
+
+            d = self._dbpool.runInteraction(_fail_all)
+            d.addCallback(_failed)
+            d.addBoth(lambda _: failure)
+            return d
+
+        def _report_transfer_creation(_):
+            """Report that the batch was accepted with no errors."""
+            for transfer_id in transfer_ids:
+                publish_event(transfer_id, 'SUBMITTED')
+            result = {
+              'msg': 'Batch of %s transfer submissions processed '
+                     'successfully' % len(transfer_ids),
+              'error': False,
+              'transfer_ids': transfer_ids
+            }
+            request.setResponseCode(202)
+            request.write(json.dumps(result) + "\n")
+            request.finish()
+            self._log.info("Batch submission of %s transfers processed "
+                           "successfully" % len(transfer_ids))
+
+        def _handle_creation_error(failure):
+            """Report that an error occured when processing the batch."""
+            self._log.error(failure)
+            request.write(self._error(request, 500, 'Error handling batch '
+                                      'transfer submission'))
+            request.finish()
+
+        # Add callbacks to handle the transfer submission asynchronously
+        d = self._dbpool.runInteraction(_add_initial)
+        d.addCallback(_add_to_rabbitmq)
+        d.addCallback(_report_transfer_creation)
+        d.addErrback(_handle_creation_error)
+        return NOT_DONE_YET
@@ -22,6 +22,7 @@ import os.path
 import json
 
 from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred, succeed
 from twisted.logger import Logger
 from twisted.web.server import NOT_DONE_YET
 
@@ -29,6 +30,15 @@ from twisted.web.server import NOT_DONE_YET
 log = Logger()
 allowedDNs = None
 """List of X.509 DNs of certificates which are permitted access."""
+adminDNs = None
+"""List of X.509 DNs of certificates which may see all users' transfers."""
+
+
+def config_get(configData, section, option, default=None):
+    """Return a configuration value, or a default if it isn't specified."""
+    if configData.has_option(section, option):
+        return configData.get(section, option)
+    return default
 
 
 def load_allowed_DNs(val):
@@ -46,6 +56,21 @@ def match_against_allowed(dn):
         return False
 
 
+def load_admin_DNs(val):
+    """Load into memory a list of X.509 distinguished names of admins."""
+    global adminDNs
+    adminDNs = filter(lambda x: x != '', val.splitlines())
+
+
+def match_against_admin(dn):
+    """Check if a particular X.509 distinguished name is an admin."""
+    global adminDNs
+    if isinstance(adminDNs, list):
+        return (dn in adminDNs)
+    else:
+        return False
+
+
 def check_auth(request=None, transfer=None, returnError=True, mustMatch=None):
     """Check if request is authorized to do transfer.
 
@@ -111,3 +136,91 @@ def check_auth(request=None, transfer=None, returnError=True, mustMatch=None):
         return NOT_DONE_YET
     else:
         return False
+
+
+def is_json_request(request):
+    """Check whether the body of a request is JSON."""
+    content_type = request.getHeader('Content-Type') or ''
+    return content_type.split(';')[0].strip() == 'application/json'
+
+
+def render_batch(request, mustMatch, fields, handler, max_items=1000):
+    """Handle a request whose body is a JSON array of items.
+
+    Used by internal calls which accept batches of reports (e.g. of the
+    completion of staging), so that the client certificate is checked once
+    for the whole batch and the items are processed together.
+
+    Arguments:
+    request -- The request being handled
+    mustMatch -- The X.509 DN the client certificate must have
+    fields -- A dictionary mapping the keys each item must have to the names
+      under which they are passed to the handler
+    handler -- Function called with a list of dictionaries of the fields of
+      the valid items, which returns (via deferred) a list of the results
+      for each item
+    max_items -- Maximum number of items in a request
+
+    Return Value:
+    NOT_DONE_YET or an error message; the response is JSON containing a
+    list of results, one for each item (in order).
+    """
+    request.setHeader('Content-Type', 'application/json')
+
+    def _error(code, msg):
+        request.setResponseCode(code)
+        return json.dumps({'error': True, 'msg': msg}) + "\n"
+
+    try:
+        authorized = check_auth(request, None, False, mustMatch)
+    except Exception:
+        authorized = False
+    if not authorized:
+        return _error(403, 'Unauthorized')
+
+    try:
+        request.content.seek(0)
+        items = json.loads(request.content.read())
+        if not isinstance(items, list):
+            raise ValueError('Not a list')
+    except ValueError:
+        return _error(400, 'The body must be a JSON array')
+    if len(items) > max_items:
+        return _error(400, 'At most %s items may be reported at once'
+                      % max_items)
+
+    def _value(value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+    results = [None] * len(items)
+    valid = []
+    params = []
+    for i, item in enumerate(items):
+        try:
+            params.append(dict((name, _value(item[key]))
+                               for key, name in fields.items()))
+        except (KeyError, TypeError):
+            results[i] = {'transfer_id': item.get('transfer_id')
+                          if isinstance(item, dict) else None,
+                          'success': False, 'msg': 'Invalid arguments'}
+            continue
+        valid.append(i)
+
+    def _respond(handled):
+        for i, result in zip(valid, handled):
+            results[i] = result
+        request.write(json.dumps({'results': results}) + "\n")
+        request.finish()
+
+    def _report_error(failure):
+        log.error(failure)
+        request.setResponseCode(500)
+        request.write(json.dumps({'error': True, 'msg': 'Error processing '
+                                  'reports'}) + "\n")
+        request.finish()
+
+    d = maybeDeferred(handler, params) if params else succeed([])
+    d.addCallbacks(_respond, _report_error)
+    return NOT_DONE_YET